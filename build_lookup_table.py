@@ -0,0 +1,34 @@
+from mirror.coordinate_transformation import TargetToMirrorLookupTable
+import time
+
+
+# Parameters
+d = 0 # distance between mirror surface and rotation center
+MIRROR_ROTATION_DEG = 45 # incidence angle of incoming laser ray (degree)
+CALIBRATION_SAVE_PATH = "calibration_parameters" # lookup table is saved next to calibration results
+X_RANGE_MM = (-500, 500) # target plane x range covered by the table
+Y_RANGE_MM = (-500, 500) # target plane y range covered by the table
+D_RANGE_MM = (200, 1000) # target distance range covered by the table
+STEP_MM = 5 # grid spacing in target plane
+D_STEP_MM = 10 # grid spacing along target distance
+ERROR_SAMPLE_COUNT = 10000 # number of random points used to measure the interpolation error
+# Parameters
+
+
+def main():
+    path = TargetToMirrorLookupTable.path(CALIBRATION_SAVE_PATH, d, MIRROR_ROTATION_DEG)
+
+    start = time.time()
+    lookup_table = TargetToMirrorLookupTable.build(d, MIRROR_ROTATION_DEG, X_RANGE_MM, Y_RANGE_MM, D_RANGE_MM, STEP_MM, D_STEP_MM)
+    print("Build time (s): ", time.time() - start)
+    print("Grid shape: ", lookup_table.grid.shape)
+    lookup_table.save(path)
+    print("Saved to: ", path)
+
+    lookup_table = TargetToMirrorLookupTable.load(path)
+    print("Estimated interpolation error bound: ", lookup_table.error_bound)
+    print("Maximum interpolation error against exact transform: ", lookup_table.max_error(ERROR_SAMPLE_COUNT))
+
+
+if __name__ == "__main__":
+    main()
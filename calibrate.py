@@ -7,7 +7,7 @@ from pykinect_azure import (
     k4a_float2_t,
 )
 import numpy as np
-from circle_detector_library.circle_detector_module import *
+from circle_detector_library.circle_detector import *
 import optoMDC
 from mirror.coordinate_transformation import CoordinateTransform
 import time
@@ -16,6 +16,10 @@ import pickle
 import sys
 import matplotlib.pyplot as plt
 from image_processing.local_maxima_finding import find_local_maxima
+from image_processing.depth_deprojection import BrownConradyCamera, color_pixels_to_3d
+from image_processing.capture_source import open_capture_source
+from photodiode.stream import PhotodiodeStream, match_setpoints
+from photodiode.client import SensorClient
 import tkinter as tk
 
 
@@ -28,6 +32,14 @@ ITER_COUNT = 10 # number of calibration iterations / number of calibration posit
 PI_COM_PORT = "COM7" # COM  port used by raspberry pi pico
 SENSOR_POS_WRT_MARKER = -55 # location of middle sensor with respect to center of chessboard calibration pattern (mm)
 SENSOR_DISTANCE = 75 # distance between sensors (mm)
+SENSOR_TIMEOUT = 0.1 # time to wait for a photodiode reading before the pico is considered stuck (s)
+SENSOR_OVERSAMPLING = 16 # photodiode samples taken by the pico for every reading
+SENSOR_OVERSAMPLING_METHOD = "mean" # "mean" or "median" of the samples
+SENSOR_STREAMING = True # raster scans stream the sensors and match the samples to the setpoints afterwards instead of one request per point
+SCAN_SAMPLE_RATE = 2000 # photodiode stream rate during raster scans (Hz)
+SCAN_DWELL = 0.002 # time the laser stays at each raster scan point (s)
+SCAN_SETTLE = 0.001 # samples taken earlier than this after a mirror move are not used (s)
+REPLAY_PATH = None # session recorded by image_processing/record_depth_images.py (COLOR_RESOLUTION = 1080P like the camera configuration below) instead of the azure kinect. mirrors and pico are not connected then, only test_detect_multiple_circles runs
 # Parameters
 
 
@@ -36,9 +48,6 @@ mirror_x = 0
 mirror_y = 0
 mirror_z = 0
 
-# Initialize the pykinect library, if the library is not found, add the library path as argument
-pykinect.initialize_libraries()
-
 # Modify camera configuration
 device_config = pykinect.default_configuration
 device_config.color_format = pykinect.K4A_IMAGE_FORMAT_COLOR_MJPG
@@ -46,41 +55,98 @@ device_config.color_resolution = pykinect.K4A_COLOR_RESOLUTION_1080P
 device_config.depth_mode = pykinect.K4A_DEPTH_MODE_NFOV_2X2BINNED
 # print(device_config)
 
-# Start device
-device = pykinect.start_device(config=device_config)
+# Start device, or the recorded session if REPLAY_PATH is set
+device = open_capture_source(device_config, REPLAY_PATH, loop=True)
+
+# color camera intrinsics and distortion are read once for the batch deprojection
+color_camera = BrownConradyCamera.from_k4a(device.calibration.handle().color_camera_calibration)
+
+# mirrors and pico are only used with the camera, a replayed session can not be calibrated against them
+if REPLAY_PATH is None:
+    # initialize mirrors
+    mre2 = optoMDC.connect()
+    mre2.reset()
+
+    # Set up mirror in closed loop control mode(XY)
+    ch_0 = mre2.Mirror.Channel_0
+    ch_0.StaticInput.SetAsInput()  # (1) here we tell the Manager that we will use a static input
+    ch_0.SetControlMode(optoMDC.Units.XY)
+    ch_0.Manager.CheckSignalFlow()  # This is a useful method to make sure the signal flow is configured correctly.
+    si_0 = mre2.Mirror.Channel_0.StaticInput
 
-# initialize mirrors
-mre2 = optoMDC.connect()
-mre2.reset()
+    ch_1 = mre2.Mirror.Channel_1
 
-# Set up mirror in closed loop control mode(XY)
-ch_0 = mre2.Mirror.Channel_0
-ch_0.StaticInput.SetAsInput()  # (1) here we tell the Manager that we will use a static input
-ch_0.SetControlMode(optoMDC.Units.XY)
-ch_0.Manager.CheckSignalFlow()  # This is a useful method to make sure the signal flow is configured correctly.
-si_0 = mre2.Mirror.Channel_0.StaticInput
+    ch_1.StaticInput.SetAsInput()  # (1) here we tell the Manager that we will use a static input
+    ch_1.SetControlMode(optoMDC.Units.XY)
+    ch_1.Manager.CheckSignalFlow()  # This is a useful method to make sure the signal flow is configured correctly.
+    si_1 = mre2.Mirror.Channel_1.StaticInput
 
-ch_1 = mre2.Mirror.Channel_1
 
-ch_1.StaticInput.SetAsInput()  # (1) here we tell the Manager that we will use a static input
-ch_1.SetControlMode(optoMDC.Units.XY)
-ch_1.Manager.CheckSignalFlow()  # This is a useful method to make sure the signal flow is configured correctly.
-si_1 = mre2.Mirror.Channel_1.StaticInput
+    # initilaize serial port to PICO
+    s = serial.Serial(port=PI_COM_PORT, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE, timeout=1)
 
 
-# initilaize serial port to PICO
-s = serial.Serial(port=PI_COM_PORT, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE, timeout=1)
+    # replies are read on a background thread of the client
+    sensor_client = SensorClient(s, timeout=SENSOR_TIMEOUT)
+    sensor_client.set_oversampling(SENSOR_OVERSAMPLING, SENSOR_OVERSAMPLING_METHOD)
 
+    photodiode_stream = PhotodiodeStream(s, rate=SCAN_SAMPLE_RATE)
 
 
-def get_sensor_reading(sensor_id): 
+def scan_setpoints(y_m, x_m, sensor_ids):
     """
-    sensor_id: int
-    """   
-    s.flush()
-    s.write(f"pd_{sensor_id}\n".encode())
-    mes = s.read_until()
-    return float(mes.decode().strip("\r\n"))
+        y_m, x_m: mirror setpoints
+        moves the laser through all setpoints, SCAN_DWELL per point, while the pico streams the sensors. samples are
+        matched to the setpoints by time after the sweep, there is no serial round trip per point. points without
+        samples (e.g. SetXY took longer than SCAN_DWELL) are measured again one by one, without oversampling like
+        the stream.
+        returns (N, len(sensor_ids)) readings
+    """
+    # oversampling on the pico would limit the stream far below SCAN_SAMPLE_RATE, the samples of each point are
+    # averaged here instead
+    sensor_client.set_oversampling(1)
+    try:
+        # the stream uses the serial port of the sensor client
+        with sensor_client.suspended():
+            photodiode_stream.start()
+            # the pico has to stop streaming whatever happens, otherwise the next request reads binary frames
+            try:
+                if not photodiode_stream.wait_until(time.perf_counter()):
+                    raise TimeoutError("photodiode stream did not start")
+
+                set_times = np.zeros(len(x_m))
+                start = time.perf_counter()
+                for i in range(len(x_m)):
+                    # busy wait, time.sleep is not accurate enough for millisecond steps on windows. sleep(0)
+                    # releases the GIL for the reader thread of the stream
+                    while time.perf_counter() < start + i * SCAN_DWELL:
+                        time.sleep(0)
+                    # Point the laser
+                    si_0.SetXY(y_m[i])
+                    si_1.SetXY(x_m[i])
+                    set_times[i] = time.perf_counter()
+                end_times = np.append(set_times[1:], set_times[-1] + SCAN_DWELL)
+
+                while time.perf_counter() < end_times[-1]:
+                    time.sleep(0)
+                photodiode_stream.wait_until(end_times[-1])
+            finally:
+                photodiode_stream.stop()
+
+        # device times are converted with the clock offset of the whole sweep
+        times, sequences, values = photodiode_stream.snapshot()
+        if len(times) == 0:
+            raise RuntimeError("photodiode stream delivered no samples")
+        readings, counts = match_setpoints(times, values[:, np.array(sensor_ids) - 1], set_times + SCAN_SETTLE, end_times)
+        print(f"Stream rate: {len(times) / (end_times[-1] - set_times[0]):.0f} Hz, samples per scan point: {np.median(counts):.0f}")
+
+        missing = np.flatnonzero(counts == 0)
+        if len(missing):
+            print("Scan points without samples, measured again: ", len(missing))
+            readings[missing] = sensor_client.read_at_points(lambda i: (si_0.SetXY(y_m[missing[i]]), si_1.SetXY(x_m[missing[i]])), len(missing), sensor_ids)
+    finally:
+        sensor_client.set_oversampling(SENSOR_OVERSAMPLING, SENSOR_OVERSAMPLING_METHOD)
+    return readings
 
 
 def search_for_laser_position(initial_position_mm, width_mm, height_mm, delta_mm, sensor_id=1):
@@ -108,15 +174,11 @@ def search_for_laser_position(initial_position_mm, width_mm, height_mm, delta_mm
         y_t, x_t
     )  
 
-    sensor_readings = []
-
-    for i in range(len(x_m)):
-        # Point the laser
-        si_0.SetXY(y_m[i])
-        si_1.SetXY(x_m[i])
-
-        time.sleep(0.001)
-        sensor_readings.append(get_sensor_reading(sensor_id))
+    if SENSOR_STREAMING:
+        sensor_readings = scan_setpoints(y_m, x_m, [sensor_id])[:, 0]
+    else:
+        # the next point is moved to while the reply of the previous point is in flight
+        sensor_readings = np.array(sensor_client.read_at_points(lambda i: (si_0.SetXY(y_m[i]), si_1.SetXY(x_m[i])), len(x_m), [sensor_id]))[:, 0]
 
     sensor_readings = np.array(sensor_readings)
     max_idx = np.argmax(sensor_readings)
@@ -156,21 +218,11 @@ def search_for_multiple_laser_position(initial_position_mm, width_mm, height_mm,
         y_t, x_t
     )  
 
-    multiple_sensor_readings = []
-    
-       
-    for i in range(len(x_m)):
-        sensor_readings = []
-        for id in sensor_ids:
-            # Point the laser
-            si_0.SetXY(y_m[i])
-            si_1.SetXY(x_m[i])
-
-            time.sleep(0.001)
-            sensor_readings.append(get_sensor_reading(id))
-
-        multiple_sensor_readings.append(sensor_readings)
-
+    if SENSOR_STREAMING:
+        multiple_sensor_readings = scan_setpoints(y_m, x_m, sensor_ids)
+    else:
+        # one request for all sensors, the next point is moved to while the reply of the previous point is in flight
+        multiple_sensor_readings = sensor_client.read_at_points(lambda i: (si_0.SetXY(y_m[i]), si_1.SetXY(x_m[i])), len(x_m), sensor_ids)
 
     multiple_sensor_readings = np.array(multiple_sensor_readings)
     max_indices = np.argmax(multiple_sensor_readings, axis=0)
@@ -216,90 +268,46 @@ def get_fine_laser_positions(rough_laser_coords, search_length_mm=10, delta_mm=0
 class Multiple_Circle_Detector:
     def __init__(self, max_detection_count=3):
         self.max_detection_count = max_detection_count 
-        self.previous_circles = []
-
-    def get_surrounding_ellipse_points(self, detected_circle):
-        points = []
-        
-        x = detected_circle.x
-        y = detected_circle.y
-        v0 = detected_circle.v0
-        m0 = detected_circle.m0
-        v1 = detected_circle.v1
-        m1 = detected_circle.m1
-
-        e = 0
-        while e <= 2 * np.pi:
-            fx = x + np.cos(e) * v0 * m0 * 2 + v1 * m1 * 2 * np.sin(e)
-            fy = y + np.cos(e) * v1 * m0 * 2 - v0 * m1 * 2 * np.sin(e)
-            fxi = (int)(fx + 0.5)
-            fyi = (int)(fy + 0.5)
-            if fxi >= 0 and fxi < self.img_width and fyi >= 0 and fyi < self.img_height:
-                points.append([fxi, fyi])
-
-            e += 0.05
-
-        points = np.array(points, np.int32)
-        return points
+        self.many_circle_detector = None # created for the image size of the first image
 
-    def get_circle_coordinates(self, circles):
+    def get_surrounding_ellipse_points(self, detected_circle, filled_mask=False):
         """
-            circles: list of detected circles
+            detected_circle: row of the structured array returned by detect_multiple_circles
+            returns (N, 2) int32 contour points of the outer ellipse that are inside the image,
+            if filled_mask is True returns uint8 mask of the image size with the filled ellipse (255) instead
         """
-        circle_coordinates = []
-        for circle in circles:
-            circle_coordinates.append([circle.x, circle.y])
+        points = outer_ellipse_points(*(detected_circle[key] for key in ("x", "y", "m0", "m1", "v0", "v1")))
+
+        if filled_mask:
+            # fillPoly clips the polygon itself, clipping the contour first would cut the ellipse wrongly
+            mask = np.zeros((self.img_height, self.img_width), dtype=np.uint8)
+            cv2.fillPoly(mask, [points.reshape((-1, 1, 2))], 255)
+            return mask
 
-        return circle_coordinates
+        inside = (points[:, 0] >= 0) & (points[:, 0] < self.img_width) & (points[:, 1] >= 0) & (points[:, 1] < self.img_height)
+        return points[inside]
 
-    def detect_multiple_circles(self, image, ):
+    def get_circle_coordinates(self, circles):
         """
-            returns detected circle coordinates as a list
+            circles: structured array of detected circles
+            returns (N, 2) array of circle coordinates
         """
-        img = image.copy()
-        self.img_height = img.shape[0]
-        self.img_width = img.shape[1]
-
-        print(img.shape)
-        detected_circles = []
-        i = 0
-
-        detected_circle_objects = []
-        while i < self.max_detection_count:
-            if len(self.previous_circles) > 0:
-                prevCircle = self.previous_circles.pop()
-            else:
-                prevCircle = CircleClass()
-
-            circle_detector = CircleDetectorClass(self.img_width, self.img_height)
-            detected_circle = circle_detector.detect_np(img, prevCircle)
-            
+        return np.stack((circles["x"], circles["y"]), axis=1)
 
+    def detect_multiple_circles(self, image):
+        """
+            returns detected circles as numpy structured array with fields x, y, m0, m1, v0, v1, size, valid
+            circles are tracked from their positions in the previous image
+        """
+        self.img_height = image.shape[0]
+        self.img_width = image.shape[1]
 
-            if detected_circle.x == 0 and detected_circle.y == 0:
-                break
+        if self.many_circle_detector is None or self.detector_size != (self.img_width, self.img_height):
+            self.many_circle_detector = ManyCircleDetectorClass(self.max_detection_count, self.img_width, self.img_height)
+            self.detector_size = (self.img_width, self.img_height)
 
-            detected_circle_objects.append(detected_circle)
-            
-                
-            detected_circles.append([detected_circle.x, detected_circle.y])
-
-            img = cv2.circle(
-                img,
-                (int(detected_circle.x), int(detected_circle.y)),
-                radius=10,
-                color=(0, 255, 0),
-                thickness=2,
-            )
-
-            points = self.get_surrounding_ellipse_points(detected_circle=detected_circle)
-            points = points.reshape((-1, 1, 2))
-            cv2.fillPoly(img, [points], (0,0,255))
-            # plt.imshow(img)
-            # plt.show()
-            i += 1
-        self.previous_circles = detected_circle_objects
-        return detected_circle_objects, img
+        circles = self.many_circle_detector.detect_np(image)
+        return circles[circles["valid"]]
 
 
 def find_distances_from_mirror_center(point_1_mm, point_2_mm, point_3_mm, distances_mm, eps_mm=0.01, is_colinear=True):
@@ -469,15 +477,11 @@ def identify_points(point1, point2, point3, is_colinear=True):
 
 
 def get3d_coords_from_pixel_coords(pix_coords, transformed_depth_img):
-    pix_x, pix_y = pix_coords
-    pix_x = int(pix_x)
-    pix_y = int(pix_y)
-    
-    rgb_depth = transformed_depth_img[pix_y, pix_x]
-    pixels = k4a_float2_t((pix_x, pix_y))
-    pos3d_color = device.calibration.convert_2d_to_3d(pixels, rgb_depth, K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_COLOR)
-    coordinates_3d = np.array([pos3d_color.xyz.x, pos3d_color.xyz.y, pos3d_color.xyz.z]).reshape((3, 1))
-    return coordinates_3d
+    """
+        pix_coords: (x, y) or (N, 2) pixel coordinates
+        returns (3, N) coordinates in color camera coordinate system
+    """
+    return color_pixels_to_3d(color_camera, pix_coords, transformed_depth_img).T
 
 
 def get_sensor_pos_from_marker_pos(marker_positions, distance_of_sensor_from_marker_mm, distance_of_second_sensor_from_first_sensor_mm):
@@ -686,9 +690,7 @@ def calibrate(width_mm, height_mm, delta_mm, sensor_ids):
                 num_color_img += 1
 
                 
-                for i, point in enumerate(corners2):          
-                    point_cam_3d = get3d_coords_from_pixel_coords((point[0, 0], point[0, 1]), transformed_depth_img=transformed_depth_image).reshape((-1))
-                    avg_points_cam_3d[:, i] += point_cam_3d     
+                avg_points_cam_3d += get3d_coords_from_pixel_coords(corners2.reshape((-1, 2)), transformed_depth_img=transformed_depth_image)
 
                 
       
@@ -865,10 +867,11 @@ def test_detect_multiple_circles():
         gray = np.expand_dims(gray, axis=2)
         gray = np.concatenate([gray, gray, gray], axis=2)
 
-        detected_circles, marked_image = multiple_circle_detector.detect_multiple_circles(gray)   
+        detected_circles = multiple_circle_detector.detect_multiple_circles(gray)   
         circle_coordinates = multiple_circle_detector.get_circle_coordinates(detected_circles)
-        circle_coordinates = np.array(circle_coordinates)
 
+        for circle in detected_circles:
+            gray[multiple_circle_detector.get_surrounding_ellipse_points(circle, filled_mask=True) > 0] = (0, 0, 255)
         for circle in circle_coordinates:
             cv2.circle(gray, center=(int(circle[0]), int(circle[1])), radius=10, color=(0, 255, 0), thickness=2)
         cv2.imshow("image", gray)
@@ -895,15 +898,35 @@ def test_search_for_multiple_laser_position():
 
 def test_sensor_reading():
     while True:
-        print("Sensor 1: ", get_sensor_reading(1))
+        print("Sensor 1: ", sensor_client.get_sensor_reading(1))
         time.sleep(0.05)
-        print("Sensor 2: ", get_sensor_reading(2))
+        print("Sensor 2: ", sensor_client.get_sensor_reading(2))
         time.sleep(0.05)
-        print("Sensor 3: ", get_sensor_reading(3))
+        print("Sensor 3: ", sensor_client.get_sensor_reading(3))
         time.sleep(1)
 
 
+def test_sensor_readings(sample_count=1000):
+    """
+        serial round trip time of one batched read compared with reading the sensors one by one
+    """
+    start = time.perf_counter()
+    for i in range(sample_count):
+        for id in [1, 2, 3]:
+            sensor_client.get_sensor_reading(id)
+    single_time = (time.perf_counter() - start) / sample_count
+    start = time.perf_counter()
+    for i in range(sample_count):
+        readings = sensor_client.get_sensor_readings([1, 2, 3])
+    batch_time = (time.perf_counter() - start) / sample_count
+    print("Last readings: ", readings)
+    print(f"3 single reads (ms): {1000 * single_time:.3f}, pd_1,2,3 (ms): {1000 * batch_time:.3f}")
+
+
 if __name__ == "__main__":
-    calibrate(width_mm=60, height_mm=240, delta_mm=3, sensor_ids=[1, 2, 3])
+    if REPLAY_PATH is None:
+        calibrate(width_mm=60, height_mm=240, delta_mm=3, sensor_ids=[1, 2, 3])
+    else:
+        test_detect_multiple_circles()
 
 
@@ -0,0 +1,104 @@
+# Circle detector used by the scripts. Python loads a compiled circle_detector_module (.pyd/.so) instead of
+# circle_detector_module.py when both exist, so a module built from older pywhycon sources would be used even
+# if it lacks methods the scripts call. Such a module is still used for detection: the missing methods are
+# added around its compiled CircleDetectorClass (full frame detection instead of the roi search, one detector
+# per marker instead of ManyCircleDetectorClass). Rebuild the module from pywhycon (see README.md) to get them.
+import warnings
+import numpy as np
+import cv2
+from . import circle_detector_module
+from .circle_detector_fallback import CIRCLE_DTYPE, WHYCON_DEFAULT_DIAMETER_RATIO
+
+__all__ = ["CircleClass", "CircleDetectorClass", "ManyCircleDetectorClass", "outer_ellipse_points"]
+
+
+def to_bgr(image):
+    """
+        contiguous (height, width, 3) uint8 image, modules built from older pywhycon sources read every image as
+        c-contiguous BGR
+    """
+    image = np.asarray(image, dtype=np.uint8)
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.ndim != 3 or image.shape[2] < 3:
+        raise ValueError("image must have shape (height, width), (height, width, 3) or (height, width, 4)")
+    return np.ascontiguousarray(image[:, :, :3])
+
+
+def outer_ellipse_points(x, y, m0, m1, v0, v1):
+    """
+        (N, 2) int32 contour points of the outer ellipse of a detected circle, not clipped to the image
+    """
+    e = np.arange(0, 2 * np.pi, 0.05)
+    cos_e = np.cos(e)
+    sin_e = np.sin(e)
+    fx = x + cos_e * v0 * m0 * 2 + v1 * m1 * 2 * sin_e
+    fy = y + cos_e * v1 * m0 * 2 - v0 * m1 * 2 * sin_e
+    return np.stack(((fx + 0.5).astype(np.int32), (fy + 0.5).astype(np.int32)), axis=1)
+
+
+CircleClass = circle_detector_module.CircleClass
+
+if hasattr(circle_detector_module.CircleDetectorClass, "detect_roi_np"):
+    CircleDetectorClass = circle_detector_module.CircleDetectorClass
+else:
+    warnings.warn("compiled circle_detector_module has no CircleDetectorClass.detect_roi_np, detect_roi_np searches the full frame, rebuild the module from pywhycon (see README.md)")
+
+    class CircleDetectorClass(circle_detector_module.CircleDetectorClass):
+        """
+            compiled CircleDetectorClass of an older module, detect_roi_np runs the full frame detection
+        """
+
+        def detect_np(self, image, previous_circle=None):
+            if previous_circle is None:
+                previous_circle = CircleClass()
+            return super().detect_np(to_bgr(image), previous_circle)
+
+        def detect_roi_np(self, image, previous_circle=None, predicted_x=-1, predicted_y=-1, roi_size=None, roi_growth=None):
+            return self.detect_np(image, previous_circle)
+
+
+if hasattr(getattr(circle_detector_module, "ManyCircleDetectorClass", None), "detect_np"):
+    ManyCircleDetectorClass = circle_detector_module.ManyCircleDetectorClass
+else:
+    warnings.warn("compiled circle_detector_module has no ManyCircleDetectorClass, markers are detected one by one with CircleDetectorClass, rebuild the module from pywhycon (see README.md)")
+
+    class ManyCircleDetectorClass:
+        """
+            ManyCircleDetectorClass built from compiled CircleDetectorClass detectors, one for each marker.
+            detected markers are painted white on a copy of the image before the next marker is searched
+            (instead of being marked in the shared buffer like pywhycon/many_circle_detector.cpp).
+            refine_max_step is not supported, older modules do not expose the threshold.
+        """
+
+        def __init__(self, number_of_circles, width, height, diameter_ratio=WHYCON_DEFAULT_DIAMETER_RATIO):
+            self.number_of_circles = number_of_circles
+            self.detectors = [CircleDetectorClass(width, height, diameter_ratio) for i in range(number_of_circles)]
+            self.previous_circles = [CircleClass() for i in range(number_of_circles)]
+            self.circles = np.zeros(number_of_circles, dtype=CIRCLE_DTYPE)
+
+        def cover(self, image, circle):
+            points = outer_ellipse_points(circle.x, circle.y, circle.m0, circle.m1, circle.v0, circle.v1)
+            cv2.fillPoly(image, [points.reshape((-1, 1, 2))], (255, 255, 255))
+
+        def detect_np(self, image, reset=False, max_attempts=1, refine_max_step=1):
+            # copy, the detected markers are painted over
+            image = to_bgr(image).copy()
+            self.circles["valid"] = False
+            for i in range(self.number_of_circles):
+                if reset:
+                    previous_circle = CircleClass() if i == 0 else self.previous_circles[i - 1]
+                else:
+                    previous_circle = self.previous_circles[i]
+                for attempt in range(max_attempts):
+                    circle = self.detectors[i].detect_np(image, previous_circle)
+                    if circle.valid:
+                        break
+                self.previous_circles[i] = circle
+
+                # the search stops at the first circle that is not found
+                if not circle.valid:
+                    break
+                self.circles[i] = (circle.x, circle.y, circle.m0, circle.m1, circle.v0, circle.v1, getattr(circle, "size", 0), True)
+                self.cover(image, circle)
+            return self.circles.copy()
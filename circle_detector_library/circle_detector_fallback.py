@@ -0,0 +1,348 @@
+import numpy as np
+import cv2
+import time
+
+
+# same parameters as pywhycon/circle_detector.cpp
+WHYCON_DEFAULT_OUTER_DIAMETER = 0.122
+WHYCON_DEFAULT_INNER_DIAMETER = 0.050
+WHYCON_DEFAULT_DIAMETER_RATIO = WHYCON_DEFAULT_INNER_DIAMETER / WHYCON_DEFAULT_OUTER_DIAMETER
+WHYCON_DEFAULT_ROI_SIZE = 128
+WHYCON_DEFAULT_ROI_GROWTH = 2.0
+
+MIN_SIZE = 10
+CIRCULAR_TOLERANCE = 0.3
+RATIO_TOLERANCE = 1.0
+CENTER_DISTANCE_TOLERANCE_RATIO = 0.1
+CENTER_DISTANCE_TOLERANCE_ABS = 5
+CIRCULARITY_TOLERANCE = 0.02
+
+CIRCLE_DTYPE = np.dtype([("x", np.float32), ("y", np.float32), ("m0", np.float32), ("m1", np.float32),
+                         ("v0", np.float32), ("v1", np.float32), ("size", np.int32), ("valid", np.bool_)])
+
+
+def window_side(side):
+    """
+        roi window side rounded up to a power of two (same windows as the native detector)
+    """
+    rounded = 16
+    while rounded < side:
+        rounded *= 2
+    return rounded
+
+
+class CircleClass:
+    """
+        same attributes as CircleClass of the native circle_detector_module
+    """
+
+    def __init__(self):
+        self.x = 0.0
+        self.y = 0.0
+        self.m0 = 0.0
+        self.m1 = 0.0
+        self.v0 = 0.0
+        self.v1 = 0.0
+        self.size = 0
+        self.minx = self.maxx = self.miny = self.maxy = 0
+        self.valid = False
+
+
+class CircleDetectorClass:
+    """
+        numpy/opencv version of the WhyCon detector in pywhycon/circle_detector.cpp for hosts without the compiled
+        module. instead of flood filling from the previous position, black and white pixels are labelled with
+        cv2.connectedComponentsWithStats and every black component is checked with the same ring tests.
+        if several markers are found, the one closest to the previous circle is returned.
+    """
+
+    def __init__(self, width, height, diameter_ratio=WHYCON_DEFAULT_DIAMETER_RATIO):
+        self.width = width
+        self.height = height
+        self.diameter_ratio = diameter_ratio
+        area_ratio_inner_outer = diameter_ratio * diameter_ratio
+        self.outer_area_ratio = np.pi * (1.0 - area_ratio_inner_outer) / 4
+        self.inner_area_ratio = np.pi / 4.0
+        self.areas_ratio = (1.0 - area_ratio_inner_outer) / area_ratio_inner_outer
+
+        self.threshold = (3 * 256) // 2
+        self.threshold_counter = 0
+
+    def change_threshold(self):
+        self.threshold_counter += 1
+        d = self.threshold_counter
+        div = 1
+        while d > 1:
+            d //= 2
+            div *= 2
+        step = 256 // div
+        self.threshold = 3 * (step * (self.threshold_counter - div) + step // 2)
+        if step <= 16:
+            self.threshold_counter = 0
+
+    def get_threshold(self):
+        return self.threshold
+
+    def intensity(self, image):
+        """
+            sum of the B, G, R values of every pixel (same value the native detector thresholds)
+        """
+        image = np.asarray(image)
+        if image.dtype != np.uint8:
+            image = image.astype(np.uint8)
+        if image.ndim == 2:
+            return 3 * image.astype(np.int16)
+        if image.ndim != 3 or image.shape[2] < 3:
+            raise ValueError("image must have shape (height, width), (height, width, 3) or (height, width, 4)")
+        # channel by channel is much faster than sum(axis=2) on the short last axis
+        intensity = np.add(image[:, :, 0], image[:, :, 1], dtype=np.int16)
+        intensity += image[:, :, 2]
+        return intensity
+
+    def check_size(self, image):
+        if image.shape[0] != self.height or image.shape[1] != self.width:
+            raise ValueError("image size does not match detector size")
+
+    def is_round(self, stats, area_ratio):
+        vx = stats[:, cv2.CC_STAT_WIDTH]
+        vy = stats[:, cv2.CC_STAT_HEIGHT]
+        size = stats[:, cv2.CC_STAT_AREA]
+        roundness = vx * vy * area_ratio / np.maximum(size, 1)
+        return (size > MIN_SIZE) & (np.abs(roundness - 1.0) < CIRCULAR_TOLERANCE)
+
+    def find_circles(self, intensity, offset_x=0, offset_y=0):
+        """
+            returns list of valid circles in the intensity image and the threshold estimate of each circle
+        """
+        white = intensity > self.threshold
+        black = ~white
+        # border pixels never belong to a segment (like the -1000 border of the native buffer)
+        black[0, :] = black[-1, :] = black[:, 0] = black[:, -1] = False
+        white[0, :] = white[-1, :] = white[:, 0] = white[:, -1] = False
+
+        count, black_labels, black_stats, _ = cv2.connectedComponentsWithStats(black.view(np.uint8), connectivity=4)
+        candidates = np.nonzero(self.is_round(black_stats, self.outer_area_ratio))[0]
+        candidates = candidates[candidates > 0]
+        if len(candidates) == 0:
+            return [], []
+
+        _, white_labels, white_stats, _ = cv2.connectedComponentsWithStats(white.view(np.uint8), connectivity=4)
+        white_round = self.is_round(white_stats, self.inner_area_ratio)
+
+        circles = []
+        thresholds = []
+        for label in candidates:
+            ox, oy, ow, oh, outer_size = black_stats[label]
+            # center of the bounding box must be white and belong to a round white segment
+            cx = ox + (ow - 1) // 2
+            cy = oy + (oh - 1) // 2
+            inner_label = white_labels[cy, cx]
+            if inner_label == 0 or not white_round[inner_label]:
+                continue
+            ix, iy, iw, ih, inner_size = white_stats[inner_label]
+
+            size_ratio = outer_size / self.areas_ratio / inner_size
+            if not (abs(size_ratio - 1.0) < RATIO_TOLERANCE):
+                continue
+            if abs((ix + (iw - 1) // 2) - cx) > CENTER_DISTANCE_TOLERANCE_ABS + CENTER_DISTANCE_TOLERANCE_RATIO * (ow - 1):
+                continue
+            if abs((iy + (ih - 1) // 2) - cy) > CENTER_DISTANCE_TOLERANCE_ABS + CENTER_DISTANCE_TOLERANCE_RATIO * (oh - 1):
+                continue
+
+            # pixels of the ring and the inner disk are inside the outer bounding box
+            outer_mask = black_labels[oy:oy+oh, ox:ox+ow] == label
+            inner_mask = white_labels[oy:oy+oh, ox:ox+ow] == inner_label
+            ys, xs = np.nonzero(outer_mask | inner_mask)
+            n = len(xs)
+            x = xs.mean()
+            y = ys.mean()
+            tx = xs - x
+            ty = ys - y
+            x += ox
+            y += oy
+            fm0 = np.dot(tx, tx) / n
+            fm1 = np.dot(tx, ty) / n
+            fm2 = np.dot(ty, ty) / n
+
+            trace = fm0 + fm2
+            det = trace * trace - 4 * (fm0 * fm2 - fm1 * fm1)
+            det = np.sqrt(det) if det > 0 else 0
+            f0 = (trace + det) / 2
+            f1 = (trace - det) / 2
+            m0 = np.sqrt(f0)
+            m1 = np.sqrt(max(f1, 0))
+            if fm1 != 0:
+                norm = np.sqrt(fm1 * fm1 + (fm0 - f0) * (fm0 - f0))
+                v0 = -fm1 / norm
+                v1 = (fm0 - f0) / norm
+            else:
+                v0, v1 = (1.0, 0.0) if fm0 > fm2 else (0.0, 1.0)
+
+            circularity = np.pi * 4 * m0 * m1 / n
+            if abs(circularity - 1) >= CIRCULARITY_TOLERANCE:
+                continue
+
+            # pixel leakage correction
+            r = self.diameter_ratio * self.diameter_ratio
+            ratio = inner_size / (outer_size + inner_size)
+            m0i = np.sqrt(ratio) * m0
+            m1i = np.sqrt(ratio) * m1
+            a = 1 - r
+            b = -(m0i + m1i) - (m0 + m1) * r
+            c = m0i * m1i - m0 * m1 * r
+            t = (-b - np.sqrt(b * b - 4 * a * c)) / (2 * a)
+
+            circle = CircleClass()
+            circle.x = float(x + offset_x)
+            circle.y = float(y + offset_y)
+            circle.m0 = float(m0 + t)
+            circle.m1 = float(m1 + t)
+            circle.v0 = float(v0)
+            circle.v1 = float(v1)
+            circle.size = int(n)
+            circle.minx, circle.maxx = int(ox + offset_x), int(ox + ow - 1 + offset_x)
+            circle.miny, circle.maxy = int(oy + offset_y), int(oy + oh - 1 + offset_y)
+            circle.valid = True
+            circles.append(circle)
+
+            outer_mean = intensity[oy:oy+oh, ox:ox+ow][outer_mask].mean()
+            inner_mean = intensity[oy:oy+oh, ox:ox+ow][inner_mask].mean()
+            thresholds.append(int(outer_mean + inner_mean) // 2)
+        return circles, thresholds
+
+    def select(self, circles, thresholds, x, y):
+        """
+            circle closest to (x, y), updates the threshold like the native detector
+        """
+        if len(circles) == 0:
+            self.change_threshold()
+            return CircleClass()
+        distances = [(circle.x - x)**2 + (circle.y - y)**2 for circle in circles]
+        i = int(np.argmin(distances))
+        self.threshold = thresholds[i]
+        self.threshold_counter = 0
+        return circles[i]
+
+    def detect_np(self, image, previous_circle=None):
+        self.check_size(image)
+        circles, thresholds = self.find_circles(self.intensity(image))
+        if previous_circle is not None and previous_circle.valid:
+            return self.select(circles, thresholds, previous_circle.x, previous_circle.y)
+        return self.select(circles, thresholds, 0, 0)
+
+    def detect_roi_np(self, image, previous_circle=None, predicted_x=-1, predicted_y=-1, roi_size=WHYCON_DEFAULT_ROI_SIZE, roi_growth=WHYCON_DEFAULT_ROI_GROWTH):
+        self.check_size(image)
+        previous_valid = previous_circle is not None and previous_circle.valid
+        if previous_valid or (predicted_x >= 0 and predicted_y >= 0):
+            if predicted_x < 0 or predicted_y < 0:
+                predicted_x, predicted_y = previous_circle.x, previous_circle.y
+            cx = min(max(int(predicted_x), 0), self.width - 1)
+            cy = min(max(int(predicted_y), 0), self.height - 1)
+
+            side = max(roi_size, 16)
+            if previous_valid:
+                side = max(side, 3.0 * max(previous_circle.maxx - previous_circle.minx, previous_circle.maxy - previous_circle.miny))
+            side = window_side(side)
+            while side < self.width or side < self.height:
+                x0 = min(max(cx - int(side) // 2, 0), max(self.width - int(side), 0))
+                y0 = min(max(cy - int(side) // 2, 0), max(self.height - int(side), 0))
+                window = image[y0:y0+int(side), x0:x0+int(side)]
+                circles, thresholds = self.find_circles(self.intensity(window), x0, y0)
+                if len(circles) > 0:
+                    return self.select(circles, thresholds, cx, cy)
+                side = window_side(side * max(roi_growth, 1.1))
+
+        return self.detect_np(image, previous_circle)
+
+
+class ManyCircleDetectorClass:
+    """
+        numpy/opencv version of ManyCircleDetectorClass, all markers are found in one labelling pass
+    """
+
+    def __init__(self, number_of_circles, width, height, diameter_ratio=WHYCON_DEFAULT_DIAMETER_RATIO):
+        self.number_of_circles = number_of_circles
+        self.detector = CircleDetectorClass(width, height, diameter_ratio)
+        self.circles = np.zeros(number_of_circles, dtype=CIRCLE_DTYPE)
+
+    def detect_np(self, image, reset=False, max_attempts=1, refine_max_step=1):
+        self.detector.check_size(image)
+        intensity = self.detector.intensity(image)
+        for attempt in range(max_attempts):
+            circles, thresholds = self.detector.find_circles(intensity)
+            if len(circles) >= self.number_of_circles:
+                break
+            self.detector.change_threshold()
+
+        previous = self.circles.copy()
+        self.circles["valid"] = False
+        for i in range(min(len(circles), self.number_of_circles)):
+            # keep the order of the previous call if the circles are tracked
+            if not reset and previous["valid"][i]:
+                distances = [(c.x - previous["x"][i])**2 + (c.y - previous["y"][i])**2 for c in circles]
+                circle = circles.pop(int(np.argmin(distances)))
+            else:
+                circle = circles.pop(0)
+            self.circles[i] = (circle.x, circle.y, circle.m0, circle.m1, circle.v0, circle.v1, circle.size, True)
+        return self.circles.copy()
+
+
+def make_marker_image(width, height, centers, outer_radius=40, diameter_ratio=WHYCON_DEFAULT_DIAMETER_RATIO, noise=10, seed=0):
+    """
+        synthetic BGR image with WhyCon markers at the given centers
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 220, dtype=np.uint8)
+    for x, y in centers:
+        cv2.circle(image, (int(x), int(y)), outer_radius, (20, 20, 20), -1)
+        cv2.circle(image, (int(x), int(y)), int(outer_radius * diameter_ratio), (220, 220, 220), -1)
+    image = image.astype(np.int16) + rng.integers(-noise, noise + 1, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def benchmark(width=1280, height=720, repeat=50):
+    """
+        compares detection time and position of the native module (if it is built for this python) and the fallback
+    """
+    import importlib.machinery
+    import importlib.util
+    import glob
+    import os
+
+    center = (width * 0.6, height * 0.4)
+    image = make_marker_image(width, height, [center])
+
+    detectors = [("fallback", CircleDetectorClass, CircleClass)]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+        paths = glob.glob(os.path.join(directory, "circle_detector_module" + suffix))
+        if len(paths) > 0:
+            spec = importlib.util.spec_from_file_location("circle_detector_module", paths[0])
+            native = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(native)
+            detectors.insert(0, ("native", native.CircleDetectorClass, native.CircleClass))
+            break
+    else:
+        print("Native module is not built for this python, only the fallback is measured")
+
+    print(f"{'detector':>10} {'full frame (ms)':>16} {'tracking roi (ms)':>18} {'x':>9} {'y':>9}")
+    for name, detector_class, circle_class in detectors:
+        detector = detector_class(width, height)
+        circle = detector.detect_np(image, circle_class())
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            detector.detect_np(image, circle_class())
+        full_time = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            detector.detect_roi_np(image, circle)
+        roi_time = (time.perf_counter() - start) / repeat
+
+        print(f"{name:>10} {1000 * full_time:16.3f} {1000 * roi_time:18.3f} {circle.x:9.3f} {circle.y:9.3f}")
+    print(f"{'true':>10} {'':16} {'':18} {center[0]:9.3f} {center[1]:9.3f}")
+
+
+if __name__ == "__main__":
+    benchmark()
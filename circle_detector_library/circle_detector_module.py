@@ -0,0 +1,9 @@
+# Fallback for hosts without a compiled circle_detector_module (e.g. Linux, other python versions).
+# Python prefers extension modules (.pyd/.so) over .py files with the same name, so this file is only
+# imported when no compiled module for the running interpreter is next to it.
+import warnings
+from .circle_detector_fallback import CircleClass, CircleDetectorClass, ManyCircleDetectorClass
+
+__all__ = ["CircleClass", "CircleDetectorClass", "ManyCircleDetectorClass"]
+
+warnings.warn("compiled circle_detector_module not found, using the slower numpy/opencv fallback (see WHYCON Python binding generation in README.md)")
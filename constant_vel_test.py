@@ -3,8 +3,11 @@ import pykinect_azure as pykinect
 from pykinect_azure import K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_DEPTH, k4a_float2_t
 import numpy as np
 from image_processing.circle_detector import detect_circle_position
+from image_processing.depth_deprojection import SparseDepthLookup
 import optoMDC
-from mirror.coordinate_transformation import CoordinateTransform
+from mirror.coordinate_transformation import TargetToMirrorLookupTable, target_to_mirror_point
+from tracking.predictor import AverageVelocityPredictor
+from tracking.stage_timer import StageTimer
 import pickle
 import time
 
@@ -22,6 +25,9 @@ with open('{}/parameters.pkl'.format(save_path), 'rb') as f:
     R = loaded_dict["R"]
     t = loaded_dict["t"]
 
+# target to mirror table of build_lookup_table.py, the exact transform is used if it has not been built
+lookup_table = TargetToMirrorLookupTable.load_if_exists(save_path, d, mirror_rotation_deg)
+
 # initial mouse position
 mouse_x = 500
 mouse_y = 300
@@ -74,30 +80,40 @@ def main():
     # Start device
     device = pykinect.start_device(config=device_config)
 
+    # intrinsics, extrinsics and depth pixel rays are cached, only the depth pixels around the target are transformed
+    depth_lookup = SparseDepthLookup.from_calibration(device.calibration)
+
 
 
     cv2.namedWindow('Laser Detector',cv2.WINDOW_NORMAL)
     cv2.setMouseCallback('Laser Detector', onMousemove)
 
 
-    next_t = 0.085
-    prev_point = 0
-    prev_v = 0
+    # averaged velocity (tracking/predictor.py), the mouse target is predicted ahead of the capture by the
+    # per-frame latency measured by the stage timer plus predictor.latency (the part the timer does not see)
+    predictor = AverageVelocityPredictor()
+    timer = StageTimer()
+    timer.dump_on_exit()
     start = time.time()
 
     while True:
-        
+        stamps = timer.start()
+
         # Get capture
         capture = device.update()
+        capture_time = time.time()
+        timer.mark(stamps, "capture")
 
         # Get the color image from the capture
         ret_color, color_image = capture.get_color_image()
+        timer.mark(stamps, "color")
 
-        # Get the colored depth
-        ret_depth, transformed_depth_image = capture.get_transformed_depth_image()
+        # Get the native depth, only the mouse pixel is transformed into the color camera
+        ret_depth, depth_image = capture.get_depth_image()
         
 
         if not ret_color or not ret_depth:
+            timer.finish(stamps)
             continue  
 
         
@@ -105,14 +121,8 @@ def main():
         pix_y = int(mouse_y)
         color_image = cv2.circle(color_image, (pix_x, pix_y), radius=10, color=(0, 255, 0), thickness=2)
 
-        rgb_depth = transformed_depth_image[pix_y, pix_x]
-
-        pixels = k4a_float2_t((pix_x, pix_y))
-
-        pos3d_color = device.calibration.convert_2d_to_3d(pixels, rgb_depth, K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_COLOR)
-       
-
-        camera_coordinates = np.array([pos3d_color.xyz.x, pos3d_color.xyz.y, pos3d_color.xyz.z]).reshape((3, 1))  
+        camera_coordinates = depth_lookup.color_pixel_to_3d(depth_image, pix_x, pix_y)
+        timer.mark(stamps, "depth")
         
         # rotate and translate
 
@@ -124,24 +134,19 @@ def main():
         updatePos(dt)
 
         start = now
-        v = (camera_coordinates_in_laser_coordinates - prev_point) / dt
-        v_avg = 0.5*v + 0.5*prev_v
-        prev_v = v_avg
-        prev_point = camera_coordinates_in_laser_coordinates
-
-        prediction_coor = camera_coordinates_in_laser_coordinates + v_avg*next_t        
-
-        coordinate_transform = CoordinateTransform(d=d, D=prediction_coor[2].item(), rotation_degree=mirror_rotation_deg)
-
-
+        predictor.update(camera_coordinates_in_laser_coordinates, capture_time)
+        prediction_coor = predictor.predict(capture_time + timer.elapsed(stamps, "capture") + predictor.latency)
 
-        y_m, x_m = coordinate_transform.target_to_mirror(prediction_coor[1], prediction_coor[0]) # order is changed in order to change x and y axis
+        mirror_coor = target_to_mirror_point(prediction_coor[1], prediction_coor[0], prediction_coor[2].item(), d, mirror_rotation_deg, lookup_table) # order is changed in order to change x and y axis
+        timer.mark(stamps, "transform")
 
         
         
-        if(len(y_m) > 0 and len(x_m) > 0):
-            si_0.SetXY(y_m[0])        
-            si_1.SetXY(x_m[0])         
+        if mirror_coor is not None:
+            si_0.SetXY(mirror_coor[0])        
+            si_1.SetXY(mirror_coor[1])         
+        timer.mark(stamps, "actuate")
+        timer.finish(stamps)
         
         # Show detected target position
         cv2.imshow('Laser Detector',color_image)
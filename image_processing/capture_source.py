@@ -0,0 +1,237 @@
+"""
+    capture sources with the same interface as a started pykinect device:
+
+        source.update() -> capture with get_color_image(), get_depth_image(), get_transformed_depth_image()
+                           and timestamp (s), None when a recording is finished
+        source.calibration.handle() -> depth_camera_calibration, color_camera_calibration, extrinsics
+
+    KinectSource reads from the azure kinect, ReplaySource plays a session recorded by
+    image_processing/record_depth_images.py (calibration.json and chunk files of image_processing/chunked_recording.py)
+    so that the tracking scripts can run without a camera.
+"""
+
+import os
+import sys
+import json
+import time
+from types import SimpleNamespace
+import numpy as np
+import pykinect_azure as pykinect
+from pykinect_azure import K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_DEPTH
+from image_processing.chunked_recording import ChunkedRecording
+
+
+INTRINSIC_PARAMETERS = ("cx", "cy", "fx", "fy", "k1", "k2", "k3", "k4", "k5", "k6", "codx", "cody", "p2", "p1")
+
+
+class KinectCapture:
+    """
+        pykinect capture with the host time at which it was received
+    """
+
+    def __init__(self, capture, timestamp):
+        self.capture = capture
+        self.timestamp = timestamp
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+class KinectSource:
+
+    def __init__(self, device_config):
+        # Initialize the library, if the library is not found, add the library path as argument
+        pykinect.initialize_libraries()
+        self.device = pykinect.start_device(config=device_config)
+        self.calibration = self.device.calibration
+
+    def update(self):
+        capture = self.device.update()
+        return KinectCapture(capture, time.time())
+
+
+def camera_calibration_to_dict(camera_calibration):
+    param = camera_calibration.intrinsics.parameters.param
+    values = {name: getattr(param, name) for name in INTRINSIC_PARAMETERS}
+    values["metric_radius"] = camera_calibration.metric_radius
+    values["resolution_width"] = camera_calibration.resolution_width
+    values["resolution_height"] = camera_calibration.resolution_height
+    return values
+
+
+def calibration_to_dict(calibration):
+    """
+        calibration: pykinect_azure Calibration (device.calibration)
+        returns the parts of the calibration used by image_processing/depth_deprojection.py as plain numbers
+    """
+    handle = calibration.handle()
+    extrinsics = handle.extrinsics[K4A_CALIBRATION_TYPE_DEPTH][K4A_CALIBRATION_TYPE_COLOR]
+    return {"depth_camera_calibration": camera_calibration_to_dict(handle.depth_camera_calibration),
+            "color_camera_calibration": camera_calibration_to_dict(handle.color_camera_calibration),
+            "depth_to_color": {"rotation": list(extrinsics.rotation), "translation": list(extrinsics.translation)}}
+
+
+def save_calibration(path, calibration):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "calibration.json"), "w") as f:
+        json.dump(calibration_to_dict(calibration), f, indent=4)
+
+
+class ReplayCalibration:
+    """
+        recorded calibration with the attribute layout of k4a_calibration_t, only depth -> color extrinsics exist
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+        def camera(values):
+            param = SimpleNamespace(**{name: values[name] for name in INTRINSIC_PARAMETERS})
+            return SimpleNamespace(intrinsics=SimpleNamespace(parameters=SimpleNamespace(param=param)),
+                                   metric_radius=values["metric_radius"],
+                                   resolution_width=values["resolution_width"],
+                                   resolution_height=values["resolution_height"])
+
+        extrinsics = [[None] * 4 for _ in range(4)]
+        extrinsics[K4A_CALIBRATION_TYPE_DEPTH][K4A_CALIBRATION_TYPE_COLOR] = SimpleNamespace(**values["depth_to_color"])
+        self._handle = SimpleNamespace(depth_camera_calibration=camera(values["depth_camera_calibration"]),
+                                       color_camera_calibration=camera(values["color_camera_calibration"]),
+                                       extrinsics=extrinsics)
+
+    def handle(self):
+        return self._handle
+
+
+class ReplayCapture:
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+        self.timestamp = source.timestamps[index]
+
+    def get_color_image(self):
+        return self.source.load("color", self.index)
+
+    def get_depth_image(self):
+        return self.source.load("depth", self.index)
+
+    def get_transformed_depth_image(self):
+        return self.source.load("transformed_depth", self.index)
+
+
+class ReplaySource:
+    """
+        plays a recorded session. with realtime=True frames are returned at the recorded frame times, otherwise as
+        fast as update is called. timestamps of the captures are shifted so that the session starts at the time of
+        the first update, the tracking scripts can use them like capture times.
+
+        preload=True decodes all images once so that only the processing is measured when benchmarking.
+    """
+
+    def __init__(self, path, realtime=True, loop=False, preload=False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+
+        with open(os.path.join(path, "calibration.json")) as f:
+            self.calibration = ReplayCalibration(json.load(f))
+
+        self.recording = ChunkedRecording(path)
+        self.recorded_timestamps = self.recording.timestamps
+        self.timestamps = self.recorded_timestamps
+        self.frame_count = len(self.recording)
+
+        self.cache = None
+        if preload:
+            self.cache = {}
+            for i in range(self.frame_count):
+                for kind in ("color", "depth", "transformed_depth"):
+                    self.cache[kind, i] = self.read(kind, i)
+
+        self.index = 0
+        self.start_time = None
+
+    def read(self, kind, index):
+        if kind not in self.recording.streams:
+            return False, None
+        ret, image = self.recording.read(index, kind)
+        # raw streams are read-only views of the chunk files, the scripts draw on the images like on camera images
+        return ret, (image.copy() if ret else None)
+
+    def load(self, kind, index):
+        if self.cache is not None:
+            return self.cache[kind, index]
+        return self.read(kind, index)
+
+    def update(self):
+        if self.index == self.frame_count:
+            if not self.loop:
+                return None
+            self.index = 0
+            self.start_time = None
+
+        if self.start_time is None:
+            self.start_time = time.time()
+            self.timestamps = self.recorded_timestamps - self.recorded_timestamps[0] + self.start_time
+
+        if self.realtime:
+            delay = self.timestamps[self.index] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        capture = ReplayCapture(self, self.index)
+        self.index += 1
+        return capture
+
+
+def open_capture_source(device_config=None, replay_path=None, realtime=True, loop=False):
+    """
+        azure kinect if replay_path is None, otherwise the recorded session at replay_path
+    """
+    if replay_path is None:
+        return KinectSource(device_config)
+    return ReplaySource(replay_path, realtime=realtime, loop=loop)
+
+
+def test_replay_source(path, realtime=False):
+    """
+        detection and depth lookup throughput on a recorded session, no camera or mirrors needed
+    """
+    from image_processing.depth_deprojection import SparseDepthLookup
+    from circle_detector_library.circle_detector import CircleDetectorClass, CircleClass
+
+    source = ReplaySource(path, realtime=realtime, preload=not realtime)
+    depth_lookup = SparseDepthLookup.from_calibration(source.calibration)
+    calibration = source.calibration.handle().color_camera_calibration
+    circle_detector = CircleDetectorClass(calibration.resolution_width, calibration.resolution_height)
+
+    circle = CircleClass()
+    detect_times = []
+    depth_times = []
+    found = 0
+    start = time.perf_counter()
+    while True:
+        capture = source.update()
+        if capture is None:
+            break
+        ret_color, color_image = capture.get_color_image()
+        ret_depth, depth_image = capture.get_depth_image()
+        if not ret_color or not ret_depth:
+            continue
+
+        detect_start = time.perf_counter()
+        circle = circle_detector.detect_roi_np(color_image, circle)
+        depth_start = time.perf_counter()
+        camera_coordinates = depth_lookup.color_pixel_to_3d(depth_image, int(circle.x), int(circle.y))
+        depth_times.append(time.perf_counter() - depth_start)
+        detect_times.append(depth_start - detect_start)
+        found += camera_coordinates[2, 0] > 0
+    duration = time.perf_counter() - start
+
+    print(f"{len(detect_times)} frames in {duration:.2f} s ({len(detect_times) / duration:.1f} fps), target with depth in {found}")
+    print(f"Detection time (ms) p50: {1000 * np.median(detect_times):.3f} max: {1000 * np.max(detect_times):.3f}")
+    print(f"Depth lookup time (ms) p50: {1000 * np.median(depth_times):.3f} max: {1000 * np.max(depth_times):.3f}")
+
+
+if __name__ == "__main__":
+    test_replay_source(sys.argv[1])
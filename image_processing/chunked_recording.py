@@ -0,0 +1,258 @@
+"""
+    recording format for image streams:
+
+        header.json         stream names, encodings, shapes and dtypes
+        index.bin           one index_dtype record per frame: timestamp, chunk and (offset, size) of every stream
+        chunk_{k}.bin       frames appended to preallocated memory-mapped files, truncated to the used size on close
+
+    a frame is listed in the index only after all of its streams are written, so a recording that was interrupted
+    can still be read up to the last complete frame.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+
+# no encoding is fastest and keeps the exact pixels, png is lossless but smaller, jpg is lossy
+ENCODINGS = ("raw", "png", "jpg")
+
+
+def index_dtype(stream_count):
+    return np.dtype([("timestamp", "<f8"), ("chunk", "<i4"), ("offset", "<i8", (stream_count,)), ("size", "<i8", (stream_count,))])
+
+
+def encode(image, encoding):
+    if encoding == "raw":
+        return np.ascontiguousarray(image).reshape(-1).view(np.uint8)
+    if encoding == "png":
+        ret, buffer = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    else:
+        ret, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return buffer.reshape(-1)
+
+
+class ChunkedRecorder:
+    """
+        appends frames of several image streams to memory-mapped chunk files. write only queues the images,
+        encoding runs on a pool of encoder threads and copying into the chunks on a writer thread, so the capture
+        loop is not slowed down. frames are stored in the order they were written. if the writer falls behind by
+        more than queue_size frames, new frames are dropped and counted.
+
+        usage:
+            recorder = ChunkedRecorder(path, {"color": "png", "depth": "raw"})
+            recorder.write(timestamp, color=color_image, depth=depth_image)
+            recorder.close()
+    """
+
+    def __init__(self, path, encodings, chunk_size=256 * 2**20, queue_size=64, encoder_threads=4):
+        """
+            encodings: dict stream name -> encoding (ENCODINGS), fixes the order of the streams in the index
+            chunk_size: size of a chunk file (bytes), a frame never spans two chunks
+            encoder_threads: png encoding of a 720p frame takes longer than a frame period, opencv releases
+                             the GIL so several frames can be encoded in parallel
+        """
+        for encoding in encodings.values():
+            if encoding not in ENCODINGS:
+                raise ValueError(f"unknown encoding {encoding}, expected one of {ENCODINGS}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.streams = list(encodings)
+        self.encodings = encodings
+        self.chunk_size = chunk_size
+        self.dtype = index_dtype(len(self.streams))
+
+        self.header = {"streams": {name: {"encoding": encodings[name], "shape": None, "dtype": None} for name in self.streams}}
+        self.index_file = open(os.path.join(path, "index.bin"), "wb")
+        self.chunk = None
+        self.chunk_number = -1
+        self.chunk_used = 0
+
+        self.frame_count = 0 # frames written to disk
+        self.dropped = 0 # frames dropped because the writer thread was behind
+        self.encoder = ThreadPoolExecutor(max_workers=encoder_threads, thread_name_prefix="encoder")
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, name="recorder", daemon=True)
+        self.thread.start()
+
+    def write(self, timestamp, **images):
+        """
+            images: stream name -> image, streams that are not given (or None) are stored as empty.
+            the images are copied, the camera library may reuse their buffers before the frame is encoded
+        """
+        if self.queue.full():
+            self.dropped += 1
+            return
+        images = {name: (None if image is None else np.array(image, copy=True)) for name, image in images.items()}
+        self.queue.put_nowait((timestamp, self.encoder.submit(self.encode_frame, images)))
+
+    def encode_frame(self, images):
+        frame = []
+        for name in self.streams:
+            image = images.get(name)
+            if image is None:
+                frame.append(None)
+            else:
+                frame.append((encode(image, self.encodings[name]), list(image.shape), image.dtype.str))
+        return frame
+
+    def new_chunk(self, size):
+        self.finish_chunk()
+        self.chunk_number += 1
+        self.chunk = np.memmap(os.path.join(self.path, f"chunk_{self.chunk_number}.bin"), dtype=np.uint8, mode="w+", shape=(size,))
+        self.chunk_used = 0
+
+    def finish_chunk(self):
+        if self.chunk is None:
+            return
+        self.chunk.flush()
+        filename = self.chunk.filename
+        del self.chunk
+        self.chunk = None
+        # unused preallocated space is given back
+        with open(filename, "r+b") as f:
+            f.truncate(self.chunk_used)
+
+    def store(self, timestamp, frame):
+        for name, stream in zip(self.streams, frame):
+            header = self.header["streams"][name]
+            if stream is not None and header["shape"] is None:
+                header["shape"] = stream[1]
+                header["dtype"] = stream[2]
+                self.save_header()
+
+        frame_size = sum(len(stream[0]) for stream in frame if stream is not None)
+        if self.chunk is None or self.chunk_used + frame_size > len(self.chunk):
+            self.new_chunk(max(self.chunk_size, frame_size))
+
+        record = np.zeros(1, dtype=self.dtype)
+        record["timestamp"] = timestamp
+        record["chunk"] = self.chunk_number
+        for i, stream in enumerate(frame):
+            if stream is None:
+                continue
+            buffer = stream[0]
+            record["offset"][0, i] = self.chunk_used
+            record["size"][0, i] = len(buffer)
+            self.chunk[self.chunk_used:self.chunk_used + len(buffer)] = buffer
+            self.chunk_used += len(buffer)
+
+        self.index_file.write(record.tobytes())
+        self.index_file.flush()
+        self.frame_count += 1
+
+    def save_header(self):
+        with open(os.path.join(self.path, "header.json"), "w") as f:
+            json.dump(self.header, f, indent=4)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, future = item
+            self.store(timestamp, future.result())
+
+    def close(self):
+        # frames already queued are written before the files are closed
+        self.queue.put(None)
+        self.thread.join()
+        self.encoder.shutdown()
+        self.finish_chunk()
+        self.index_file.close()
+        self.save_header()
+
+
+class ChunkedRecording:
+    """
+        random access reader for recordings of ChunkedRecorder. chunks are memory-mapped, reading a frame only
+        decodes the requested stream of that frame. raw streams are returned as read-only views of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "header.json")) as f:
+            self.header = json.load(f)
+        self.streams = list(self.header["streams"])
+        self.index = np.fromfile(os.path.join(path, "index.bin"), dtype=index_dtype(len(self.streams)))
+        self.timestamps = self.index["timestamp"]
+        self.chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_chunk(self, number):
+        if number not in self.chunks:
+            self.chunks[number] = np.memmap(os.path.join(self.path, f"chunk_{number}.bin"), dtype=np.uint8, mode="r")
+        return self.chunks[number]
+
+    def read(self, frame, stream):
+        """
+            returns (ret, image) of the stream in frame, ret is False if the stream was not recorded for this frame
+        """
+        record = self.index[frame]
+        i = self.streams.index(stream)
+        size = record["size"][i]
+        if size == 0:
+            return False, None
+        offset = record["offset"][i]
+        buffer = self.get_chunk(int(record["chunk"]))[offset:offset + size]
+
+        header = self.header["streams"][stream]
+        if header["encoding"] == "raw":
+            return True, buffer.view(np.dtype(header["dtype"])).reshape(header["shape"])
+        return True, cv2.imdecode(np.asarray(buffer), cv2.IMREAD_UNCHANGED)
+
+    def find(self, timestamp):
+        """
+            returns the index of the last frame captured at or before timestamp
+        """
+        return max(int(np.searchsorted(self.timestamps, timestamp, side="right")) - 1, 0)
+
+
+def test_chunked_recording(path="recordings/test_chunked_recording", frame_count=300, encoding="png"):
+    """
+        writes synthetic 720p color and native depth frames at 30 fps and reads them back in random order
+    """
+    rng = np.random.default_rng(0)
+    # gradient with sensor noise, compresses like a camera image
+    color_image = np.broadcast_to(np.linspace(0, 200, 1280, dtype=np.uint8)[np.newaxis, :, np.newaxis], (720, 1280, 3))
+    color_image = color_image + rng.integers(0, 10, (720, 1280, 3), dtype=np.uint8)
+    depth_image = rng.integers(500, 1500, (288, 320), dtype=np.uint16)
+
+    recorder = ChunkedRecorder(path, {"color": encoding, "depth": "raw"}, chunk_size=64 * 2**20)
+    write_times = []
+    start = time.perf_counter()
+    for i in range(frame_count):
+        write_start = time.perf_counter()
+        color = color_image.copy()
+        color[0, 0, 0] = i % 256 # frame number
+        recorder.write(i / 30, color=color, depth=depth_image)
+        write_times.append(time.perf_counter() - write_start)
+        time.sleep(max(0, start + (i + 1) / 30 - time.perf_counter()))
+    recorder.close()
+    print(f"Frames written: {recorder.frame_count}, dropped: {recorder.dropped}, chunks: {recorder.chunk_number + 1}")
+    print(f"write call (ms) p50: {1000 * np.median(write_times):.3f} max: {1000 * np.max(write_times):.3f}")
+
+    recording = ChunkedRecording(path)
+    frames = rng.permutation(len(recording))[:50]
+    start = time.perf_counter()
+    for i in frames:
+        ret, color = recording.read(i, "color")
+        ret, depth = recording.read(i, "depth")
+        if encoding != "jpg":
+            assert color[0, 0, 0] == round(recording.timestamps[i] * 30) % 256
+            assert np.array_equal(color[1:], color_image[1:])
+        assert np.array_equal(depth, depth_image)
+    print(f"random frame read (ms): {1000 * (time.perf_counter() - start) / len(frames):.3f}")
+    assert recording.timestamps[recording.find(recording.timestamps[10] + 0.001)] == recording.timestamps[10]
+
+
+if __name__ == "__main__":
+    test_chunked_recording(*sys.argv[1:2])
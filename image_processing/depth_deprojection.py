@@ -0,0 +1,340 @@
+import numpy as np
+import time
+from pykinect_azure import K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_DEPTH
+
+
+class BrownConradyCamera:
+    """
+        numpy version of the azure kinect camera model (brown conrady lens distortion), uses the same equations as the
+        k4a sdk so results can be compared with device.calibration.convert_2d_to_3d/convert_3d_to_2d.
+        all functions work on arrays of points.
+    """
+
+    def __init__(self, fx, fy, cx, cy, k, p1, p2, codx, cody, metric_radius, width, height):
+        self.fx = fx
+        self.fy = fy
+        self.cx = cx
+        self.cy = cy
+        self.k = k # k1 - k6
+        self.p1 = p1
+        self.p2 = p2
+        self.codx = codx
+        self.cody = cody
+        self.metric_radius = metric_radius
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_k4a(cls, camera_calibration):
+        """
+            camera_calibration: k4a_calibration_camera_t (e.g. device.calibration.handle().color_camera_calibration)
+        """
+        param = camera_calibration.intrinsics.parameters.param
+        return cls(param.fx, param.fy, param.cx, param.cy,
+                   (param.k1, param.k2, param.k3, param.k4, param.k5, param.k6),
+                   param.p1, param.p2, param.codx, param.cody, camera_calibration.metric_radius,
+                   camera_calibration.resolution_width, camera_calibration.resolution_height)
+
+    def distort(self, x, y):
+        """
+            x, y: undistorted normalized image coordinates (x/z, y/z)
+            returns distorted normalized image coordinates and validity mask (inside metric radius)
+        """
+        k1, k2, k3, k4, k5, k6 = self.k
+        xp = x - self.codx
+        yp = y - self.cody
+        xp2 = xp * xp
+        yp2 = yp * yp
+        xyp = xp * yp
+        rs = xp2 + yp2
+        valid = rs <= self.metric_radius * self.metric_radius
+        rss = rs * rs
+        rsc = rss * rs
+        a = 1 + k1 * rs + k2 * rss + k3 * rsc
+        b = 1 + k4 * rs + k5 * rss + k6 * rsc
+        d = a / b
+
+        xp_d = xp * d + (rs + 2 * xp2) * self.p2 + 2 * xyp * self.p1 + self.codx
+        yp_d = yp * d + (rs + 2 * yp2) * self.p1 + 2 * xyp * self.p2 + self.cody
+        return xp_d, yp_d, valid
+
+    def project(self, points):
+        """
+            points: (N, 3) points in camera coordinates (mm)
+            returns (N, 2) pixel coordinates and validity mask
+        """
+        z = points[:, 2]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_d, y_d, valid = self.distort(points[:, 0] / z, points[:, 1] / z)
+        uv = np.stack((x_d * self.fx + self.cx, y_d * self.fy + self.cy), axis=1)
+        return uv, valid & (z > 0)
+
+    def unproject(self, uv, iterations=20, tol=1e-10):
+        """
+            uv: (N, 2) pixel coordinates
+            returns (N, 2) undistorted normalized image coordinates (point on the ray with z = 1) and validity mask.
+            distortion is inverted with newton iterations, jacobian is computed with finite differences.
+        """
+        x_d = (uv[:, 0] - self.cx) / self.fx
+        y_d = (uv[:, 1] - self.cy) / self.fy
+        x = x_d.copy()
+        y = y_d.copy()
+        eps = 1e-7
+        for i in range(iterations):
+            fx, fy, _ = self.distort(x, y)
+            ex = fx - x_d
+            ey = fy - y_d
+            if np.all(np.abs(ex) + np.abs(ey) < tol):
+                break
+            fx_x, fy_x, _ = self.distort(x + eps, y)
+            fx_y, fy_y, _ = self.distort(x, y + eps)
+            j11 = (fx_x - fx) / eps
+            j21 = (fy_x - fy) / eps
+            j12 = (fx_y - fx) / eps
+            j22 = (fy_y - fy) / eps
+            det = j11 * j22 - j12 * j21
+            x = x - (j22 * ex - j12 * ey) / det
+            y = y - (j11 * ey - j21 * ex) / det
+
+        fx, fy, valid = self.distort(x, y)
+        valid &= np.abs(fx - x_d) + np.abs(fy - y_d) < 1e-6
+        return np.stack((x, y), axis=1), valid
+
+    def deproject(self, uv, depth):
+        """
+            uv: (N, 2) pixel coordinates, depth: (N,) depth along the camera z axis (mm)
+            returns (N, 3) points in camera coordinates (mm), zeros where depth is 0 or the pixel is outside of the lens area
+        """
+        xy, valid = self.unproject(uv)
+        depth = np.asarray(depth, dtype=np.float64)
+        points = np.stack((xy[:, 0] * depth, xy[:, 1] * depth, depth), axis=1)
+        points[~valid | (depth <= 0)] = 0
+        return points
+
+
+class SparseDepthLookup:
+    """
+        depth of single color pixels without transforming the whole depth image into the color camera
+        (capture.get_transformed_depth_image()).
+
+        for a color pixel, the part of the native depth image that can map onto it (epipolar segment between z_range)
+        is projected into the color image, the depth of the closest foreground depth pixel is used and the color pixel
+        is deprojected with that depth. intrinsics, extrinsics and the depth pixel rays are computed once.
+    """
+
+    def __init__(self, depth_camera, color_camera, rotation, translation, z_range=(250, 5000), search_radius=None, foreground_tolerance=20):
+        """
+            rotation, translation: depth camera -> color camera extrinsics (translation in mm)
+            z_range: depth range (mm) that is searched when no depth hint is given
+            search_radius: max distance (color pixels) between the color pixel and projected depth pixels,
+                           default is the size of one depth pixel in the color image
+            foreground_tolerance: depth pixels farther than this (mm) behind the closest one are treated as occluded
+        """
+        self.depth_camera = depth_camera
+        self.color_camera = color_camera
+        self.rotation = np.asarray(rotation, dtype=np.float64).reshape((3, 3))
+        self.translation = np.asarray(translation, dtype=np.float64).reshape((3,))
+        self.z_range = z_range
+        if search_radius is None:
+            search_radius = max(1.0, color_camera.fx / depth_camera.fx)
+        self.search_radius = search_radius
+        self.foreground_tolerance = foreground_tolerance
+
+        # ray (z = 1) of every depth pixel, nan outside of the valid lens area
+        u, v = np.meshgrid(np.arange(depth_camera.width), np.arange(depth_camera.height))
+        xy, valid = depth_camera.unproject(np.stack((u.ravel(), v.ravel()), axis=1).astype(np.float64))
+        xy[~valid] = np.nan
+        self.depth_rays = np.concatenate((xy, np.ones((len(xy), 1))), axis=1).reshape((depth_camera.height, depth_camera.width, 3))
+
+    @classmethod
+    def from_calibration(cls, calibration, **kwargs):
+        """
+            calibration: pykinect_azure Calibration (device.calibration)
+        """
+        handle = calibration.handle()
+        extrinsics = handle.extrinsics[K4A_CALIBRATION_TYPE_DEPTH][K4A_CALIBRATION_TYPE_COLOR]
+        return cls(BrownConradyCamera.from_k4a(handle.depth_camera_calibration),
+                   BrownConradyCamera.from_k4a(handle.color_camera_calibration),
+                   list(extrinsics.rotation), list(extrinsics.translation), **kwargs)
+
+    def color_ray(self, pix_x, pix_y):
+        """
+            returns ray (x, y) with z = 1 of the color pixel in color camera coordinates, None if outside of the lens area
+        """
+        xy, valid = self.color_camera.unproject(np.array([[pix_x, pix_y]], dtype=np.float64))
+        if not valid[0]:
+            return None
+        return xy[0]
+
+    def depth_window(self, ray, z_range, margin=2, samples=8):
+        """
+            returns bounding box (u0, u1, v0, v1) of the native depth pixels that can map onto the color pixel ray
+        """
+        # sample uniformly in inverse depth, the epipolar line is slightly curved because of lens distortion
+        z = 1 / np.linspace(1 / z_range[0], 1 / z_range[1], samples)
+        points_color = np.stack((ray[0] * z, ray[1] * z, z), axis=1)
+        points_depth = (points_color - self.translation) @ self.rotation # inverse of R @ p + t
+        uv, valid = self.depth_camera.project(points_depth)
+        if not np.any(valid):
+            return None
+        uv = uv[valid]
+        u0 = max(int(np.floor(np.min(uv[:, 0]))) - margin, 0)
+        u1 = min(int(np.ceil(np.max(uv[:, 0]))) + margin + 1, self.depth_camera.width)
+        v0 = max(int(np.floor(np.min(uv[:, 1]))) - margin, 0)
+        v1 = min(int(np.ceil(np.max(uv[:, 1]))) + margin + 1, self.depth_camera.height)
+        if u0 >= u1 or v0 >= v1:
+            return None
+        return u0, u1, v0, v1
+
+    def get_depth(self, depth_image, pix_x, pix_y, z_hint=None, ray=None):
+        """
+            depth_image: native depth image (capture.get_depth_image())
+            z_hint: expected depth (mm), e.g. from the previous frame. z_hint +-25% is searched first
+            ray: color_ray(pix_x, pix_y) if it is already computed
+            returns depth of the color pixel in the color camera (same value as transformed_depth_image[pix_y, pix_x]),
+            0 if no depth pixel maps onto it
+        """
+        if ray is None:
+            ray = self.color_ray(pix_x, pix_y)
+            if ray is None:
+                return 0
+        if z_hint is not None and z_hint > 0:
+            z = self.get_depth_in_range(depth_image, pix_x, pix_y, ray, (0.75 * z_hint, 1.25 * z_hint))
+            if z > 0:
+                return z
+            # target moved out of the hinted range
+        return self.get_depth_in_range(depth_image, pix_x, pix_y, ray, self.z_range)
+
+    def get_depth_in_range(self, depth_image, pix_x, pix_y, ray, z_range):
+        window = self.depth_window(ray, z_range)
+        if window is None:
+            return 0
+        u0, u1, v0, v1 = window
+
+        depth = depth_image[v0:v1, u0:u1]
+        valid = depth > 0
+        if not np.any(valid):
+            return 0
+        points_depth = self.depth_rays[v0:v1, u0:u1][valid] * depth[valid, np.newaxis]
+        points_color = points_depth @ self.rotation.T + self.translation
+        uv, valid = self.color_camera.project(points_color)
+
+        distance = np.hypot(uv[:, 0] - pix_x, uv[:, 1] - pix_y)
+        near = valid & (distance <= self.search_radius)
+        if not np.any(near):
+            return 0
+        z = points_color[near, 2]
+        distance = distance[near]
+        # like the z-buffer of the sdk transformation, pixels hidden behind closer surfaces are ignored
+        foreground = z <= np.min(z) + self.foreground_tolerance
+        return z[foreground][np.argmin(distance[foreground])]
+
+    def color_pixel_to_3d(self, depth_image, pix_x, pix_y, z_hint=None):
+        """
+            returns (3, 1) position of the color pixel in color camera coordinates (mm), zeros if depth is not found
+            (same as device.calibration.convert_2d_to_3d with depth 0)
+        """
+        ray = self.color_ray(pix_x, pix_y)
+        if ray is None:
+            return np.zeros((3, 1))
+        z = self.get_depth(depth_image, pix_x, pix_y, z_hint, ray)
+        return np.array([ray[0] * z, ray[1] * z, z]).reshape((3, 1))
+
+
+def color_pixels_to_3d(color_camera, pixels, transformed_depth_image):
+    """
+        batch version of device.calibration.convert_2d_to_3d(pixel, transformed_depth_image[y, x], COLOR, COLOR)
+        color_camera: BrownConradyCamera of the color camera, create once with BrownConradyCamera.from_k4a
+        pixels: (N, 2) color pixel coordinates (x, y), truncated to int to read the depth
+        transformed_depth_image: depth image in the color camera (capture.get_transformed_depth_image())
+        returns (N, 3) positions in color camera coordinates (mm), zeros where depth is missing
+    """
+    pixels = np.asarray(pixels).reshape((-1, 2)).astype(int)
+    depth = transformed_depth_image[pixels[:, 1], pixels[:, 0]]
+    return color_camera.deproject(pixels.astype(np.float64), depth)
+
+
+def test_color_pixels_to_3d(device, point_count=1000):
+    """
+        compares the batch deprojection with the sdk on random pixels of a live depth frame
+    """
+    from pykinect_azure import k4a_float2_t
+
+    color_camera = BrownConradyCamera.from_k4a(device.calibration.handle().color_camera_calibration)
+    capture = device.update()
+    ret_depth, transformed_depth_image = capture.get_transformed_depth_image()
+    if not ret_depth:
+        print("No depth image")
+        return
+
+    height, width = transformed_depth_image.shape[:2]
+    pixels = np.stack((np.random.randint(0, width, point_count), np.random.randint(0, height, point_count)), axis=1)
+
+    start = time.perf_counter()
+    points = color_pixels_to_3d(color_camera, pixels, transformed_depth_image)
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    points_sdk = np.zeros((point_count, 3))
+    for i, (x, y) in enumerate(pixels):
+        pos3d_color = device.calibration.convert_2d_to_3d(k4a_float2_t((x, y)), transformed_depth_image[y, x], K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_COLOR)
+        points_sdk[i] = [pos3d_color.xyz.x, pos3d_color.xyz.y, pos3d_color.xyz.z]
+    sdk_time = time.perf_counter() - start
+
+    valid = transformed_depth_image[pixels[:, 1], pixels[:, 0]] > 0
+    errors = np.linalg.norm(points[valid] - points_sdk[valid], axis=1)
+    print(f"Batch (ms): {1000 * batch_time:.3f}, sdk loop (ms): {1000 * sdk_time:.3f} for {point_count} pixels")
+    if len(errors) > 0:
+        print(f"Compared {len(errors)} pixels with depth, max error (mm): {np.max(errors):.6f}")
+        assert np.max(errors) < 1, "batch deprojection does not match the sdk"
+
+
+def test_sparse_depth_lookup(device, point_count=100):
+    """
+        compares the sparse depth lookup with the full frame transformation of the sdk on random pixels
+    """
+    from pykinect_azure import k4a_float2_t
+
+    depth_lookup = SparseDepthLookup.from_calibration(device.calibration)
+    capture = device.update()
+    ret_depth, depth_image = capture.get_depth_image()
+    start = time.perf_counter()
+    ret_transformed, transformed_depth_image = capture.get_transformed_depth_image()
+    transform_time = time.perf_counter() - start
+    if not ret_depth or not ret_transformed:
+        print("No depth image")
+        return
+
+    height, width = transformed_depth_image.shape[:2]
+    pix_x = np.random.randint(0, width, point_count)
+    pix_y = np.random.randint(0, height, point_count)
+    errors = []
+    lookup_time = 0
+    for x, y in zip(pix_x, pix_y):
+        start = time.perf_counter()
+        pos3d = depth_lookup.color_pixel_to_3d(depth_image, x, y)
+        lookup_time += time.perf_counter() - start
+
+        rgb_depth = transformed_depth_image[y, x]
+        if rgb_depth == 0 or pos3d[2, 0] == 0:
+            continue
+        pos3d_color = device.calibration.convert_2d_to_3d(k4a_float2_t((x, y)), rgb_depth, K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_COLOR)
+        errors.append(np.linalg.norm(pos3d.ravel() - np.array([pos3d_color.xyz.x, pos3d_color.xyz.y, pos3d_color.xyz.z])))
+
+    print(f"Full frame transform (ms): {1000 * transform_time:.3f}, sparse lookup per pixel (ms): {1000 * lookup_time / point_count:.3f}")
+    if len(errors) > 0:
+        print(f"Compared {len(errors)} pixels, median error (mm): {np.median(errors):.3f}, max error (mm): {np.max(errors):.3f}")
+
+
+if __name__ == "__main__":
+    import pykinect_azure as pykinect
+
+    pykinect.initialize_libraries()
+    device_config = pykinect.default_configuration
+    device_config.color_format = pykinect.K4A_IMAGE_FORMAT_COLOR_MJPG
+    device_config.color_resolution = pykinect.K4A_COLOR_RESOLUTION_720P
+    device_config.depth_mode = pykinect.K4A_DEPTH_MODE_NFOV_2X2BINNED
+    device = pykinect.start_device(config=device_config)
+
+    test_color_pixels_to_3d(device)
+    test_sparse_depth_lookup(device)
@@ -4,7 +4,7 @@ from pykinect_azure.k4a.transformation import Transformation
 from pykinect_azure import Image
 from pykinect_azure.k4a import _k4a
 import time
-from circle_detector_library.circle_detector_module import *
+from circle_detector_library.circle_detector import *
 
 
 DOWNSAMPLE = 4
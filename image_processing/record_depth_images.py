@@ -3,31 +3,36 @@ import pykinect_azure as pykinect
 from pykinect_azure import K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_DEPTH, k4a_float2_t
 import numpy as np
 import time
-from PIL import Image
+from image_processing.capture_source import KinectSource, save_calibration
+from image_processing.chunked_recording import ChunkedRecorder
 
 
+# Parameters
+SAVE_PATH = f"recordings/session_{time.strftime('%Y%m%d_%H%M%S')}" # session directory, can be played with image_processing.capture_source.ReplaySource
+COLOR_ENCODING = "raw" # "raw", "png" (lossless, needs several cores at 30 fps) or "jpg"
+COLOR_RESOLUTION = pykinect.K4A_COLOR_RESOLUTION_720P # 720P for pywhycon_track_target_with_laser.py, 1080P for calibrate.py. saved in calibration.json
+# Parameters
+
 
 def main():            
    
-
-    # Initialize the library, if the library is not found, add the library path as argument
-    pykinect.initialize_libraries()
-
     # Modify camera configuration
     device_config = pykinect.default_configuration
     device_config.color_format = pykinect.K4A_IMAGE_FORMAT_COLOR_YUY2
-    device_config.color_resolution = pykinect.K4A_COLOR_RESOLUTION_720P
+    device_config.color_resolution = COLOR_RESOLUTION
     device_config.depth_mode = pykinect.K4A_DEPTH_MODE_WFOV_2X2BINNED
     # print(device_config)
 
     # Start device
-    device = pykinect.start_device(config=device_config)
-
+    device = KinectSource(device_config)
 
+    # calibration is saved with the images so that depth can be deprojected during replay
+    save_calibration(SAVE_PATH, device.calibration)
+    # frames are encoded and written to memory-mapped chunk files by background threads
+    recorder = ChunkedRecorder(SAVE_PATH, {"color": COLOR_ENCODING, "depth": "raw", "transformed_depth": "raw", "colored_depth": COLOR_ENCODING})
 
     cv2.namedWindow('Depth Image',cv2.WINDOW_NORMAL)
 
-    i = 0
     while True:
         start = time.time()
         # Get capture
@@ -39,33 +44,33 @@ def main():
         ret_color, color_image = capture.get_color_image()
         print("Time until color image (s): ", time.time() - start)
 
+        # native depth is used by the tracking scripts (SparseDepthLookup)
+        ret_depth, depth_image = capture.get_depth_image()
+        print("Time until depth image (s): ", time.time() - start)
+
         # Get the colored depth
         ret_colored_depth, colored_depth_image = capture.get_transformed_colored_depth_image()
         print("Time until colored depth image (s): ", time.time() - start)
+
+        # depth in color camera geometry is used by calibrate.py
+        ret_transformed_depth, transformed_depth_image = capture.get_transformed_depth_image()
+        print("Time until transformed depth image (s): ", time.time() - start)
         
-        # Get the colored depth
-        ret_depth, depth_image = capture.get_transformed_depth_image()
-        print("Time until depth image (s): ", time.time() - start)
-        
-        if not ret_color or not ret_colored_depth or not ret_depth:
+        if not ret_color or not ret_colored_depth or not ret_depth or not ret_transformed_depth:
             continue
         
-        im_color = Image.fromarray(color_image)
-        im_color.save(f"image_processing/sphere_ims/color_{i}.png")
-        im_colored_depth = Image.fromarray(colored_depth_image)
-        im_colored_depth.save(f"image_processing/sphere_ims/colored_depth_image_{i}.png")
-        np.save(f"image_processing/sphere_ims/depth_image_{i}.npy", depth_image)
-        
-        i+=1
+        recorder.write(capture.timestamp, color=color_image, depth=depth_image, transformed_depth=transformed_depth_image, colored_depth=colored_depth_image)
         
         cv2.imshow('Depth Image',colored_depth_image)
         # Press q key to stop
         if cv2.waitKey(1) == ord('q'):
             break
 
-    print("done")
+    recorder.close()
+    print(f"{recorder.frame_count} frames saved to: ", SAVE_PATH)
+    print("Dropped frames: ", recorder.dropped)
 
 
 
 if __name__ == "__main__":
-     main()
\ No newline at end of file
+     main()
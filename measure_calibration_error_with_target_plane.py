@@ -4,13 +4,16 @@ import pykinect_azure as pykinect
 from pykinect_azure import K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_DEPTH, k4a_float2_t
 import numpy as np
 from image_processing.circle_detector import detect_circle_position
+from image_processing.depth_deprojection import SparseDepthLookup
 import optoMDC
 from mirror.coordinate_transformation import CoordinateTransform
 import pickle
 import time
 import os
-from circle_detector_library.circle_detector_module import *
+from circle_detector_library.circle_detector import *
 from utils import optimal_rotation_and_translation
+from tracking.display import open_display
+from photodiode.client import SensorClient
 import matplotlib.pyplot as plt
 
 
@@ -20,7 +23,9 @@ MIRROR_ROTATION_DEG = 45 # incidence angle of incoming laser ray (degree)
 CALIBRATION_SAVE_PATH = "calibration_parameters" # calibration result save path
 SENSOR_POS_WRT_MARKER=-30 # position of middle sensor with respect to marker position (mm)
 PI_COM_PORT = "COM6" # COM port used by raspberry pi pico
+SENSOR_TIMEOUT = 0.1 # time to wait for a photodiode reading before the pico is considered stuck (s)
 CALIBRATION_ITER = 10 # number of calibration points used during tests
+DISPLAY_MODE = "process" # "window": imshow/waitKey in this process, "process": separate low priority display process, "headless": no display, keys are typed into the console
 # Parameters
 
 
@@ -79,17 +84,8 @@ def search_for_laser_position(initial_position_mm, width_mm, height_mm, delta_mm
         y_t, x_t
     )  # order is changed in order to change x and y axis
 
-    sensor_readings = []
-
-    for i in range(len(x_m)):
-        # Point the laser
-        si_0.SetXY(y_m[i])
-        si_1.SetXY(x_m[i])
-
-        time.sleep(0.001)
-        sensor_readings.append(get_sensor_reading(sensor_id))
-
-    sensor_readings = np.array(sensor_readings)
+    # the next point is moved to while the reply of the previous point is in flight
+    sensor_readings = np.array(sensor_client.read_at_points(lambda i: (si_0.SetXY(y_m[i]), si_1.SetXY(x_m[i])), len(x_m), [sensor_id]))[:, 0]
     max_idx = np.argmax(sensor_readings)
 
     sensor_data = np.reshape(sensor_readings, (sample_y, sample_x))
@@ -100,16 +96,6 @@ def search_for_laser_position(initial_position_mm, width_mm, height_mm, delta_mm
 
     return sensor_data, coordinate_axes, max_position_mm, target_coordinates
 
-def get_sensor_reading(sensor_id): 
-    """
-    sensor_id: int
-    """   
-    s.flush()
-    s.write(f"pd_{sensor_id}\n".encode())
-    mes = s.read_until()
-    return float(mes.decode().strip("\r\n"))
-
-
 # initialize mirrors
 mre2 = optoMDC.connect()
 mre2.reset()
@@ -143,11 +129,16 @@ device_config.synchronized_images_only = False
 # Start device
 device = pykinect.start_device(config=device_config)
 
-cv2.namedWindow('Laser Detector',cv2.WINDOW_NORMAL)
+# intrinsics, extrinsics and depth pixel rays are cached, only the depth pixels around the target are transformed
+depth_lookup = SparseDepthLookup.from_calibration(device.calibration)
+
+# gui event handling is kept out of the measurement loop, keys are polled without blocking
+display = open_display(DISPLAY_MODE, 'Laser Detector')
 font = cv2.FONT_HERSHEY_SIMPLEX
 
 # initilaize serial port to PICO
 s = serial.Serial(port=PI_COM_PORT, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE, timeout=1)
+sensor_client = SensorClient(s, timeout=SENSOR_TIMEOUT)
 
 def main():
     # gives undefined warning but works (pybind11 c++ module) change import *
@@ -165,19 +156,13 @@ def main():
 
         new_circle = circle_detector.detect_np(color_image, prevCircle)    
         prevCircle = new_circle
-        ret_depth, transformed_depth_image = capture.get_transformed_depth_image()        
+        ret_depth, depth_image = capture.get_depth_image()
         if not ret_depth:
             continue  
         
         pix_x = int(new_circle.x)
         pix_y = int(new_circle.y)
-        rgb_depth = transformed_depth_image[pix_y, pix_x]
-
-        pixels = k4a_float2_t((pix_x, pix_y))
-
-        pos3d_color = device.calibration.convert_2d_to_3d(pixels, rgb_depth, K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_COLOR)
-
-        target_in_camera_coordinates = np.array([pos3d_color.xyz.x, pos3d_color.xyz.y, pos3d_color.xyz.z]).reshape((3, 1))
+        target_in_camera_coordinates = depth_lookup.color_pixel_to_3d(depth_image, pix_x, pix_y)
 
 
         # point to target 
@@ -201,10 +186,11 @@ def main():
 
             
         # Show detected target position
-        cv2.imshow('Laser Detector',color_image)
-        # Press q key to stop
+        display.show(color_image)
+        key = display.get_key()
 
-        if cv2.waitKey(1) == ord("m"):
+        # Press m key to measure the error at the current target position
+        if key == ord("m"):
             sensor_data, (width_range, height_range), max_pos, _ = search_for_laser_position(initial_position_mm=target_in_laser_coordinates.reshape((-1)), width_mm=10, height_mm=10, delta_mm=0.2, sensor_id=2)
             max_pos = np.array(max_pos).reshape(3,1)
             l2norm = np.linalg.norm(max_pos - target_in_laser_coordinates) 
@@ -218,10 +204,12 @@ def main():
             plt.plot()
 
 
-        if cv2.waitKey(1) == ord('q'):
+        # Press q key to stop
+        if key == ord('q'):
             break
 
         
+    display.close()
     mre2.disconnect()
     print("done")
 
@@ -9,6 +9,96 @@ Based on MR-E-2 Development Kit Operation Manual sample script
 
 import numpy as np
 import sympy as sy
+import pickle
+import os
+from functools import lru_cache
+
+
+@lru_cache(maxsize=16)
+def get_rotation_matrices(rotation_degree):
+    # rotation between target plane (T) and inertial (I) coordinate systems, shared by all transforms
+    alpha = np.deg2rad(rotation_degree)
+    A_TI = np.array([[ 1, 0 ,0], 
+                    [ 0, np.cos(alpha), -np.sin(alpha)], 
+                    [ 0, np.sin(alpha), np.cos(alpha)]])
+    A_IT = np.transpose(A_TI)
+    A_TI.flags.writeable = False
+    A_IT.flags.writeable = False
+    return A_TI, A_IT
+
+
+@lru_cache(maxsize=16)
+def get_numeric_solver(d, rotation_degree):
+    """
+        compiled residual and jacobian functions for the d != 0 model, keyed by mirror geometry.
+        D is an argument of the compiled functions so that one solver serves every target distance.
+    """
+    D = sy.symbols("D")
+    T_r_TP_2, n_m_symbols = CoordinateTransform(d, 1, rotation_degree).sy_getTargetPlaneSpot(D)
+    spot = [T_r_TP_2[0], T_r_TP_2[1]]
+    jacobian = sy.matrices.Matrix(spot).jacobian(n_m_symbols)
+
+    spot_functions = [sy.lambdify((*n_m_symbols, D), f, "numpy") for f in spot]
+    jacobian_functions = [sy.lambdify((*n_m_symbols, D), f, "numpy") for f in jacobian]
+    return spot_functions, jacobian_functions
+
+
+@lru_cache(maxsize=16)
+def get_mirror_xy_solver(d):
+    """
+        compiled mirror xy and jacobian functions for the d != 0 model, used to get the normal vector from
+        mirror coordinates (inverse of getXYFromNormalVector).
+    """
+    coordinate_transform = CoordinateTransform(d, 1, 0)
+    n_m1, n_m2 = sy.symbols("n_m1 n_m2")
+    n_m = sy.matrices.Matrix([n_m1, n_m2, -sy.sqrt(1-(n_m1**2+n_m2**2))])
+    # parameters as used in getXYFromNormalVector
+    D = 90
+    r_OP_2 = coordinate_transform.sy_getSpotOnTargetPlane(n_m, [0, 0, d], d, [0, 0, 1], [0, 0, -1], [0, 0, -D], [0, 0, 1])
+    scaling = D*np.tan(np.deg2rad(50))
+    xy = [r_OP_2[0]/scaling, r_OP_2[1]/scaling]
+    jacobian = sy.matrices.Matrix(xy).jacobian((n_m1, n_m2))
+
+    xy_functions = [sy.lambdify((n_m1, n_m2), f, "numpy") for f in xy]
+    jacobian_functions = [sy.lambdify((n_m1, n_m2), f, "numpy") for f in jacobian]
+    return xy_functions, jacobian_functions
+
+
+def newton_solve_normal_vectors(functions, jacobian_functions, n, x, y, args=(), tol=1e-13, max_iter=50):
+    """
+        functions: compiled [f_x(n_m1, n_m2, *args), f_y(n_m1, n_m2, *args)]
+        jacobian_functions: compiled jacobian of functions with respect to (n_m1, n_m2), row major
+        n: (N,3) initial normal vectors
+        x, y: (N,) values functions should reach
+
+        vectorized newton iteration, returns (N,3) normal vectors, rows that did not converge are nan.
+    """
+    n_1 = n[:, 0].copy()
+    n_2 = n[:, 1].copy()
+
+    converged = np.zeros(len(n_1), dtype=bool)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for i in range(max_iter):
+            f_0 = functions[0](n_1, n_2, *args) - x
+            f_1 = functions[1](n_1, n_2, *args) - y
+            # constant entries of the jacobian are returned as scalars
+            a, b, c, e = [np.broadcast_to(f(n_1, n_2, *args), n_1.shape) for f in jacobian_functions]
+
+            det = a*e - b*c
+            dn_1 = (e*f_0 - b*f_1) / det
+            dn_2 = (a*f_1 - c*f_0) / det
+            n_1 = n_1 - dn_1
+            n_2 = n_2 - dn_2
+
+            converged = np.abs(dn_1) + np.abs(dn_2) < tol
+            if np.all(converged | ~np.isfinite(n_1) | ~np.isfinite(n_2)):
+                break
+
+        n_3 = -np.sqrt(1-n_1**2-n_2**2)
+
+    n = np.stack([n_1, n_2, n_3], axis=1)
+    n[~converged] = np.nan
+    return n
 
 
 class CoordinateTransform():
@@ -30,11 +120,7 @@ class CoordinateTransform():
         # target plane
         
         
-        alpha = np.deg2rad(self.rotation_degree)
-        self.A_TI = np.array([[ 1, 0 ,0], 
-                        [ 0, np.cos(alpha), -np.sin(alpha)], 
-                        [ 0, np.sin(alpha), np.cos(alpha)]])
-        self.A_IT = np.transpose(self.A_TI)
+        self.A_TI, self.A_IT = get_rotation_matrices(self.rotation_degree)
         self.n_t = np.dot(self.A_IT, np.array([0,0,1]))
         self.r_OT = np.dot(self.A_IT, np.array([0,0,-D]))
         
@@ -61,6 +147,30 @@ class CoordinateTransform():
         y = r_OP_2[1]/scaling
         return x,y
     
+    def normalize_rows(self, v):
+        # same as normalize but for (N,3) arrays, zero rows are returned unchanged
+        norm = np.linalg.norm(v, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        return v / norm
+
+    def getXYFromNormalVectors(self, n, d, D):
+        # same as getXYFromNormalVector but for (N,3) normal vectors
+        r_C = np.array([0, 0, d]) # center of rotation
+        # xy coordinate system defined with respect to 90° incidence angle
+        n_0 = np.array([0,0,1])
+        r_OP_0 = np.array([0,0, -1])
+
+        # target plane
+        n_t = np.array([0,0,1])
+        r_OT = np.array([0,0,-D])
+
+        scaling = D*np.tan(np.deg2rad(50))
+
+        r_OP_2, _ = self.getSpotsOnTargetPlane(n, r_C, d, n_0, r_OP_0, r_OT, n_t)
+        x = r_OP_2[:, 0]/scaling
+        y = r_OP_2[:, 1]/scaling
+        return x,y
+
     def getNormalVectorFromXY(self, x,y, d):
         #distance d between center of rotation and mirror surface (mm)
         if d==0:
@@ -115,7 +225,18 @@ class CoordinateTransform():
         
         n_m = self.normalize(n_1-n0)
         return n_m
-    
+
+    def getNormalVectorsFromTargetXY_d0(self, x_t, y_t, A_IT, D, n0):
+        # same as getNormalVectorFromTargetXY_d0 but for (N,) target coordinates
+        r_OT = np.dot(A_IT, np.array([0,0,-D]))
+        T_r_TP_2 = np.stack([x_t, y_t, np.zeros_like(x_t)], axis=1)
+        I_r_TP_2 = T_r_TP_2 @ A_IT.T
+        r_OP_2 = r_OT + I_r_TP_2
+        n_1 = self.normalize_rows(r_OP_2)
+
+        n_m = self.normalize_rows(n_1-n0)
+        return n_m
+
     def getSpotOnTargetPlane(self, n_m, r_C, d, n_0, r_OP_0, r_OT, n_t):
         #r_M = r_C + d * n_m # center of mirror surface
         
@@ -132,7 +253,18 @@ class CoordinateTransform():
             print('Warning: intersection in wrong half-space')
         r_OP_2 = r_OP_1 + t_2 * n_1
         return r_OP_2
-    
+
+    def getSpotsOnTargetPlane(self, n_m, r_C, d, n_0, r_OP_0, r_OT, n_t):
+        # same as above but for (N,3) normal vectors, t_2 is returned instead of printing a warning
+        t_1 = ((r_C-r_OP_0) @ n_m.T + d) / (n_m @ n_0)
+        r_OP_1 = r_OP_0 + t_1[:, np.newaxis] * n_0
+
+        n_1 = n_0 - 2*(n_m @ n_0)[:, np.newaxis]*n_m # reflected beams
+
+        t_2 = np.sum((r_OT-r_OP_1) * n_t, axis=1) / (n_1 @ n_t)
+        r_OP_2 = r_OP_1 + t_2[:, np.newaxis] * n_1
+        return r_OP_2, t_2
+
     def sy_getSpotOnTargetPlane(self, n_m, r_C, d, n_0, r_OP_0, r_OT, n_t):
         # same as above but for symbolic calculations
         #r_M = r_C + d * n_m # center of mirror surface
@@ -154,63 +286,450 @@ class CoordinateTransform():
     
      
     
+    def isSimpleMode(self):
+        # calculation is simple if d is 0 and incoming beam hits mirror in the center (origin)
+        return self.d==0 and abs(np.dot(self.r_OP_0, self.n_0)/np.linalg.norm(self.r_OP_0) + 1) < 1e-9
+
+    def sy_getTargetPlaneSpot(self, D=None):
+        # spot position in target plane coordinates as a function of the mirror normal (n_m1, n_m2)
+        # D can be given as a symbol, default is the distance of this transform
+        if D is None:
+            r_OT = self.r_OT
+        else:
+            r_OT = sy.matrices.Matrix(self.A_IT) * sy.matrices.Matrix([0, 0, -D])
+        n_m1, n_m2 = sy.symbols("n_m1 n_m2")
+        n_m = sy.matrices.Matrix([n_m1, n_m2, -sy.sqrt(1-(n_m1**2+n_m2**2))])
+        r_OP_2 = self.sy_getSpotOnTargetPlane(n_m, self.r_C, self.d, self.n_0, self.r_OP_0, r_OT, self.n_t)
+        I_r_TP_2 = r_OP_2 - sy.matrices.Matrix(r_OT)
+        T_r_TP_2 = sy.matrices.Matrix(self.A_TI) * I_r_TP_2
+        return T_r_TP_2, (n_m1, n_m2)
+
+    def build_numeric_solver(self):
+        """
+            lambdified target plane spot (residuals) and its analytic jacobian with respect to
+            the mirror normal so that newton iterations can run on numpy arrays.
+            compiled once per (d, rotation_degree), see get_numeric_solver.
+        """
+        self.spot_functions, self.jacobian_functions = get_numeric_solver(self.d, self.rotation_degree)
+
+    def solve_normal_vectors(self, x_target, y_target, tol=1e-13, max_iter=50):
+        """
+            x_target: (N,) array, x coordinates on target plane (mm)
+            y_target: (N,) array, y coordinates on target plane (mm)
+
+            vectorized newton iteration for the mirror normal vectors (d != 0), warm-started from the d == 0 solution.
+            returns (N,3) normal vectors, rows that did not converge are nan.
+        """
+        if not hasattr(self, "spot_functions"):
+            self.build_numeric_solver()
+
+        # d == 0 solution is exact for a mirror surface through the center of rotation
+        n = self.getNormalVectorsFromTargetXY_d0(x_target, y_target, self.A_IT, self.D, self.n_0)
+        return newton_solve_normal_vectors(self.spot_functions, self.jacobian_functions, n, x_target, y_target,
+                                           args=(self.D,), tol=tol, max_iter=max_iter)
+
+    def getNormalVectorsFromXY(self, x, y, d):
+        # same as getNormalVectorFromXY but for (N,) mirror coordinates, rows that did not converge are nan
+        n0 = np.array([0,0, 1]) # xy coordinate system defined with respect to 90° incidence angle
+        r = self.normalize_rows(np.stack([x, y, np.full_like(x, -1/np.tan(np.deg2rad(50)))], axis=1)) # direction of reflected beam
+        n = self.normalize_rows(r - n0)
+        if d==0:
+            return n
+
+        # d == 0 solution as initial guess
+        xy_functions, jacobian_functions = get_mirror_xy_solver(d)
+        return newton_solve_normal_vectors(xy_functions, jacobian_functions, n, x, y)
+
+    def mirror_to_target(self, x_m, y_m, D=None):
+        """
+            x_m: (N,) array, mirror x coordinates
+            y_m: (N,) array, mirror y coordinates
+            D: distance of target plane (mm), default is the distance of this transform
+
+            returns spot positions x_t, y_t on target plane (mm) and a boolean mask of the points
+            that hit the target plane in the correct half-space.
+        """
+        if D is None:
+            D = self.D
+        x_m = np.asarray(x_m, dtype=float).reshape((-1))
+        y_m = np.asarray(y_m, dtype=float).reshape((-1))
+
+        n = self.getNormalVectorsFromXY(x_m, y_m, self.d)
+        r_OT = np.dot(self.A_IT, np.array([0,0,-D]))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r_OP_2, t_2 = self.getSpotsOnTargetPlane(n, self.r_C, self.d, self.n_0, self.r_OP_0, r_OT, self.n_t)
+            T_r_TP_2 = (r_OP_2 - r_OT) @ self.A_TI.T
+            valid = (t_2 > 0) & np.all(np.isfinite(T_r_TP_2), axis=1)
+
+        return T_r_TP_2[:, 0], T_r_TP_2[:, 1], valid
+
+    def target_to_mirror_batch(self, x_target, y_target):
+        """
+            x_target: (N,) array, x coordinates on target plane (mm)
+            y_target: (N,) array, y coordinates on target plane (mm)
+
+            returns mirror coordinates x_m, y_m for all N points and a boolean mask of the
+            feasible points (inside unit circle and, for d != 0, solver converged).
+        """
+        x_target = np.asarray(x_target, dtype=float).reshape((-1))
+        y_target = np.asarray(y_target, dtype=float).reshape((-1))
+
+        if self.isSimpleMode():
+            n = self.getNormalVectorsFromTargetXY_d0(x_target, y_target, self.A_IT, self.D, self.n_0)
+            x_m, y_m = self.getXYFromNormalVectors(n, 0, 90) # D is arbitrary for d==0
+        else:
+            n = self.solve_normal_vectors(x_target, y_target)
+            x_m, y_m = self.getXYFromNormalVectors(n, self.d, 90)
+
+        with np.errstate(invalid="ignore"):
+            feasible = x_m**2 + y_m**2 <= 1
+        return x_m, y_m, feasible
+
     def target_to_mirror(self, x_target, y_target):
+        x_input, y_input, feasible = self.target_to_mirror_batch(x_target, y_target)
+        return x_input[feasible], y_input[feasible]
+
+    def target_to_mirror_sympy(self, x_target, y_target):
+        # reference implementation for d != 0 using sympy nsolve, one point at a time (slow)
         x_input = [] # to be calculated mirror coordinates
         y_input = [] # to be calculated mirror coordinates
-        
-        if self.d==0 and abs(np.dot(self.r_OP_0, self.n_0)/np.linalg.norm(self.r_OP_0) + 1) < 1e-9:
-            # calculation is simple if d is 0 and incoming beam hits mirror in the center (origin)
-            simpleMode = True
-            # print("Using simple mode")
-        else:
-            simpleMode = False
-            n_m1, n_m2 = sy.symbols("n_m1 n_m2")
-            n_m = sy.matrices.Matrix([n_m1, n_m2, -sy.sqrt(1-(n_m1**2+n_m2**2))])
-            r_OP_2 = self.sy_getSpotOnTargetPlane(n_m, self.r_C, self.d, self.n_0, self.r_OP_0, self.r_OT, self.n_t)
-            I_r_TP_2 = r_OP_2 - sy.matrices.Matrix(self.r_OT)
-            T_r_TP_2 = np.dot(self.A_TI, I_r_TP_2)
-            T_r_TP_2 = sy.simplify(T_r_TP_2)
-            # print("Not using simple mode")
-        
-            
-            
-        
-        progress = 0
-        n_target = len(x_target)
-        
-        for i, (x_t, y_t) in enumerate(zip(x_target, y_target)):
-            if simpleMode:
-                n = self.getNormalVectorFromTargetXY_d0(x_t, y_t, self.A_IT, self.D, self.n_0)
-                x,y = self.getXYFromNormalVector(n, 0, 90) # D is arbitrary for d==0
-            
-            else:
-                res = sy.solvers.solvers.nsolve((T_r_TP_2[0][0]-x_t,
-                                                 T_r_TP_2[1][0]-y_t),
-                                                (n_m1, n_m2), (0, 0))
-                n_x = float(res[0])
-                n_y = float(res[1])
-        
-                n = np.array([n_x, n_y, -np.sqrt(1-n_x**2-n_y**2)])
-                x,y = self.getXYFromNormalVector(n, self.d, 90)
-                
+
+        T_r_TP_2, (n_m1, n_m2) = self.sy_getTargetPlaneSpot()
+        T_r_TP_2 = sy.simplify(T_r_TP_2)
+
+        for x_t, y_t in zip(x_target, y_target):
+            res = sy.solvers.solvers.nsolve((T_r_TP_2[0]-x_t,
+                                             T_r_TP_2[1]-y_t),
+                                            (n_m1, n_m2), (0, 0))
+            n_x = float(res[0])
+            n_y = float(res[1])
+
+            n = np.array([n_x, n_y, -np.sqrt(1-n_x**2-n_y**2)])
+            x,y = self.getXYFromNormalVector(n, self.d, 90)
+
             x_input.append(x)
             y_input.append(y)
-            
-            if (i+1)/n_target> progress+0.1:
-                progress = i/n_target
-                #print(int(round(progress,1)*100), '%')
-        
-        # get indices for feasible points:
-        i_feasible = []    
-        # discard grid-points outside unit circle
-        for i, (x,y) in enumerate(zip(x_input, y_input)):
-            if x**2+y**2 <= 1:
-                i_feasible.append(i)
-        
+
         x_input = np.array(x_input)
         y_input = np.array(y_input)
-    
-        
-        return x_input[i_feasible], y_input[i_feasible]
+
+        # discard grid-points outside unit circle
+        feasible = x_input**2 + y_input**2 <= 1
+
+        return x_input[feasible], y_input[feasible]
+
+
+class TargetToMirrorLookupTable():
+    """
+        precomputed target to mirror mapping on a regular (D, y_t, x_t) grid for fixed d and rotation_degree.
+        queries are answered by trilinear interpolation, error_bound is the interpolation error estimated
+        from second differences of the grid: (max|d2f/dx2| hx^2 + max|d2f/dy2| hy^2 + max|d2f/dD2| hD^2) / 8
+        cells with an infeasible corner (outside unit circle) are infeasible.
+    """
+
+    def __init__(self, d, rotation_degree, x_axis, y_axis, D_axis, grid, error_bound):
+        self.d = d
+        self.rotation_degree = rotation_degree
+        self.x_axis = x_axis
+        self.y_axis = y_axis
+        self.D_axis = D_axis
+        self.grid = grid # (len(D_axis), len(y_axis), len(x_axis), 2), last axis is (x_m, y_m)
+        self.error_bound = error_bound
+
+        self.origin = np.array([D_axis[0], y_axis[0], x_axis[0]])
+        self.step = np.array([D_axis[1]-D_axis[0], y_axis[1]-y_axis[0], x_axis[1]-x_axis[0]])
+        self.shape = np.array(grid.shape[:3])
+        self.upper = (self.shape - 1).astype(float) # largest fractional index inside the grid
+        self.max_index = (self.shape - 2).astype(float) # first corner of the last cell
+
+        # the 8 corners of a cell are gathered from the flattened grid, corner order is (D, y, x) bits
+        self.flat_grid = grid.reshape((-1, 2))
+        self.strides = np.array([grid.shape[1] * grid.shape[2], grid.shape[2], 1], dtype=np.intp)
+        self.corner_offsets = np.array([dD * self.strides[0] + dy * self.strides[1] + dx
+                                        for dD in (0, 1) for dy in (0, 1) for dx in (0, 1)])
+
+        # interpolation buffers, grown to the largest query so far
+        self.capacity = 0
+        self.reserve(64)
+
+    @classmethod
+    def build(cls, d, rotation_degree, x_range, y_range, D_range, step_mm, D_step_mm):
+        """
+            x_range, y_range, D_range: (min, max) in mm
+            step_mm: grid spacing in target plane
+            D_step_mm: grid spacing along D
+        """
+        x_axis = np.arange(x_range[0], x_range[1] + step_mm/2, step_mm)
+        y_axis = np.arange(y_range[0], y_range[1] + step_mm/2, step_mm)
+        D_axis = np.arange(D_range[0], D_range[1] + D_step_mm/2, D_step_mm)
+        x_t = np.tile(x_axis, len(y_axis))
+        y_t = np.repeat(y_axis, len(x_axis))
+
+        grid = np.empty((len(D_axis), len(y_axis), len(x_axis), 2))
+        for i, D in enumerate(D_axis):
+            x_m, y_m, feasible = CoordinateTransform(d, D, rotation_degree).target_to_mirror_batch(x_t, y_t)
+            # infeasible nodes are nan so that cells touching them are reported as infeasible
+            x_m[~feasible] = np.nan
+            y_m[~feasible] = np.nan
+            grid[i, :, :, 0] = x_m.reshape((len(y_axis), len(x_axis)))
+            grid[i, :, :, 1] = y_m.reshape((len(y_axis), len(x_axis)))
+
+        error_bound = 0
+        for axis in range(3):
+            second_difference = np.abs(np.diff(grid, n=2, axis=axis))
+            error_bound += np.nanmax(second_difference) / 8
+
+        return cls(d, rotation_degree, x_axis, y_axis, D_axis, grid, error_bound)
+
+    def save(self, path):
+        """
+            path: file name without extension, grid is saved to path.npy and the axes to path.pkl
+        """
+        np.save(f"{path}.npy", self.grid)
+        with open(f"{path}.pkl", "wb") as f:
+            pickle.dump({"d": self.d,
+                         "rotation_degree": self.rotation_degree,
+                         "x_axis": self.x_axis,
+                         "y_axis": self.y_axis,
+                         "D_axis": self.D_axis,
+                         "error_bound": self.error_bound}, f)
+
+    @staticmethod
+    def path(directory, d, rotation_degree):
+        # file name used by build_lookup_table.py, without extension
+        return f"{directory}/lookup_table_d{d}_{rotation_degree}deg"
+
+    @classmethod
+    def load_if_exists(cls, directory, d, rotation_degree):
+        """
+            table built by build_lookup_table.py for this mirror geometry, None if there is none in directory
+        """
+        path = cls.path(directory, d, rotation_degree)
+        if not os.path.exists(f"{path}.npy"):
+            return None
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        # grid is memory-mapped, only the cells that are queried are read from disk
+        grid = np.load(f"{path}.npy", mmap_mode="r")
+        with open(f"{path}.pkl", "rb") as f:
+            axes = pickle.load(f)
+        return cls(axes["d"], axes["rotation_degree"], axes["x_axis"], axes["y_axis"], axes["D_axis"], grid, axes["error_bound"])
+
+    def reserve(self, point_count):
+        """
+            allocates the interpolation buffers for queries of up to point_count points
+        """
+        if point_count <= self.capacity:
+            return
+        self.capacity = point_count
+        self.position = np.empty((point_count, 3))
+        self.corner = np.empty((point_count, 3))
+        self.weight = np.empty((point_count, 3))
+        self.index = np.empty((point_count, 3), dtype=np.intp)
+        self.flat_index = np.empty(point_count, dtype=np.intp)
+        self.corner_index = np.empty((point_count, 8), dtype=np.intp)
+        self.values = np.empty((point_count, 8, 2))
+        self.values_y = np.empty((point_count, 4, 2))
+        self.values_D = np.empty((point_count, 2, 2))
+        self.mirror = np.empty((point_count, 2))
+        self.squared = np.empty((point_count, 2))
+        self.radius = np.empty(point_count)
+        self.bounds = np.empty((point_count, 3), dtype=bool)
+        self.bounds_upper = np.empty((point_count, 3), dtype=bool)
+        self.feasible = np.empty(point_count, dtype=bool)
+
+    def target_to_mirror_batch(self, x_target, y_target, D):
+        """
+            same outputs as CoordinateTransform.target_to_mirror_batch, D can be a scalar or (N,) array.
+            points outside of the grid are infeasible.
+            the returned arrays are views of the interpolation buffers, they are overwritten by the next query
+            (copy them to keep them, one table should not be queried from several threads).
+        """
+        x_target = np.asarray(x_target, dtype=float).reshape((-1))
+        n = len(x_target)
+        self.reserve(n)
+        position = self.position[:n]
+        corner = self.corner[:n]
+        weight = self.weight[:n]
+        index = self.index[:n]
+        flat_index = self.flat_index[:n]
+        corner_index = self.corner_index[:n]
+        values = self.values[:n]
+        values_y = self.values_y[:n]
+        values_D = self.values_D[:n]
+        mirror = self.mirror[:n]
+        squared = self.squared[:n]
+        radius = self.radius[:n]
+        bounds = self.bounds[:n]
+        bounds_upper = self.bounds_upper[:n]
+        feasible = self.feasible[:n]
+
+        # fractional grid indices
+        position[:, 0] = np.reshape(D, (-1))
+        position[:, 1] = np.reshape(y_target, (-1))
+        position[:, 2] = x_target
+        position -= self.origin
+        position /= self.step
+        np.greater_equal(position, 0, out=bounds)
+        np.less_equal(position, self.upper, out=bounds_upper)
+        bounds &= bounds_upper
+        np.all(bounds, axis=1, out=feasible)
+
+        # first corner of the cell and weights inside the cell, nan positions end in a nan weight
+        np.floor(position, out=corner)
+        np.clip(corner, 0, self.max_index, out=corner)
+        np.nan_to_num(corner, copy=False)
+        np.subtract(position, corner, out=weight)
+        index[:] = corner
+        np.dot(index, self.strides, out=flat_index)
+        np.add(flat_index[:, None], self.corner_offsets, out=corner_index)
+        np.take(self.flat_grid, corner_index, axis=0, out=values, mode="clip")
+
+        # trilinear interpolation, x, y and then D
+        np.subtract(values[:, 1::2], values[:, 0::2], out=values_y)
+        values_y *= weight[:, 2, None, None]
+        values_y += values[:, 0::2]
+        np.subtract(values_y[:, 1::2], values_y[:, 0::2], out=values_D)
+        values_D *= weight[:, 1, None, None]
+        values_D += values_y[:, 0::2]
+        np.subtract(values_D[:, 1], values_D[:, 0], out=mirror)
+        mirror *= weight[:, 0, None]
+        mirror += values_D[:, 0]
+
+        x_m = mirror[:, 0]
+        y_m = mirror[:, 1]
+        np.multiply(mirror, mirror, out=squared)
+        np.add(squared[:, 0], squared[:, 1], out=radius)
+        with np.errstate(invalid="ignore"):
+            np.less_equal(radius, 1, out=bounds[:, 0])
+        feasible &= bounds[:, 0]
+        return x_m, y_m, feasible
+
+    def target_to_mirror(self, x_target, y_target, D):
+        x_m, y_m, feasible = self.target_to_mirror_batch(x_target, y_target, D)
+        return x_m[feasible], y_m[feasible]
+
+    def max_error(self, sample_count=10000, D_count=50):
+        """
+            maximum interpolation error against the exact transform at random points inside the grid.
+            the points are spread over D_count random distances, so only D_count exact transforms are built.
+            raises ValueError if no sample point is feasible
+        """
+        x_t = np.random.uniform(self.x_axis[0], self.x_axis[-1], sample_count)
+        y_t = np.random.uniform(self.y_axis[0], self.y_axis[-1], sample_count)
+        D_values = np.random.uniform(self.D_axis[0], self.D_axis[-1], D_count)
+        D_index = np.random.randint(D_count, size=sample_count)
+        D = D_values[D_index]
+
+        x_m, y_m, feasible = self.target_to_mirror_batch(x_t, y_t, D)
+        if not np.any(feasible):
+            raise ValueError(f"none of the {sample_count} sample points is inside a feasible cell of the lookup table")
+
+        error = np.zeros(sample_count)
+        for i in np.unique(D_index[feasible]):
+            points = feasible & (D_index == i)
+            x_exact, y_exact, _ = CoordinateTransform(self.d, D_values[i], self.rotation_degree).target_to_mirror_batch(x_t[points], y_t[points])
+            error[points] = np.maximum(np.abs(x_m[points] - x_exact), np.abs(y_m[points] - y_exact))
+        return np.max(error[feasible])
+
+
+def target_to_mirror_point(x_target, y_target, D, d, rotation_degree, lookup_table=None):
+    """
+        mirror coordinates of one target point for the tracking loops, None if the point cannot be reached.
+        the lookup table is used when given, points it does not cover fall back to the exact transform.
+    """
+    if lookup_table is not None:
+        x_m, y_m, feasible = lookup_table.target_to_mirror_batch(x_target, y_target, D)
+        if feasible[0]:
+            return x_m[0].item(), y_m[0].item()
+    x_m, y_m = CoordinateTransform(d=d, D=D, rotation_degree=rotation_degree).target_to_mirror(x_target, y_target)
+    if len(x_m) > 0 and len(y_m) > 0:
+        return x_m[0], y_m[0]
+    return None
+
+
+def test_solve_normal_vectors(d=5, D=500, rotation_degree=45, point_count=10000, reference_count=20):
+    import time
+
+    coordinate_transform = CoordinateTransform(d=d, D=D, rotation_degree=rotation_degree)
+    x_t = np.random.uniform(-D/2, D/2, point_count)
+    y_t = np.random.uniform(-D/2, D/2, point_count)
+
+    start = time.time()
+    coordinate_transform.build_numeric_solver()
+    print("Solver build time (s): ", time.time() - start)
+
+    start = time.time()
+    x_m, y_m, feasible = coordinate_transform.target_to_mirror_batch(x_t, y_t)
+    newton_time = time.time() - start
+    print(f"Newton time for {point_count} points (s): ", newton_time)
+
+    start = time.time()
+    x_ref, y_ref = coordinate_transform.target_to_mirror_sympy(x_t[:reference_count], y_t[:reference_count])
+    sympy_time = (time.time() - start) / reference_count * point_count
+    print(f"Estimated sympy time for {point_count} points (s): ", sympy_time)
+    print("Speedup: ", sympy_time / newton_time)
+    assert sympy_time / newton_time > 10
+
+    feasible_ref = feasible[:reference_count]
+    assert np.any(feasible_ref) and len(x_ref) == np.sum(feasible_ref)
+    error = max(np.max(np.abs(x_m[:reference_count][feasible_ref] - x_ref)),
+                np.max(np.abs(y_m[:reference_count][feasible_ref] - y_ref)))
+    print("Maximum difference to sympy: ", error)
+    assert error < 1e-9
+
+
+def test_mirror_to_target(d=0, D=500, rotation_degree=45, point_count=10000):
+    # round trip target -> mirror -> target
+    coordinate_transform = CoordinateTransform(d=d, D=D, rotation_degree=rotation_degree)
+    x_t = np.random.uniform(-D/2, D/2, point_count)
+    y_t = np.random.uniform(-D/2, D/2, point_count)
+
+    x_m, y_m, feasible = coordinate_transform.target_to_mirror_batch(x_t, y_t)
+    x_r, y_r, valid = coordinate_transform.mirror_to_target(x_m[feasible], y_m[feasible])
+
+    print("Valid points: ", np.sum(valid), "/", np.sum(feasible))
+    assert np.any(feasible) and np.all(valid)
+    error = np.max(np.hypot(x_r[valid] - x_t[feasible][valid], y_r[valid] - y_t[feasible][valid]))
+    print("Maximum round trip error (mm): ", error)
+    assert error < 1e-9
+
+
+def test_lookup_table(d=0, rotation_degree=45, point_count=1000):
+    lookup_table = TargetToMirrorLookupTable.build(d, rotation_degree, (-200, 200), (-200, 200), (400, 600), 10, 20)
+
+    # grid nodes are exact
+    D = lookup_table.D_axis[1]
+    x_t = np.repeat(lookup_table.x_axis[1:-1], 3)
+    y_t = np.tile(lookup_table.y_axis[1:4], len(lookup_table.x_axis) - 2)
+    x_m, y_m, feasible = lookup_table.target_to_mirror_batch(x_t, y_t, D)
+    x_exact, y_exact, feasible_exact = CoordinateTransform(d, D, rotation_degree).target_to_mirror_batch(x_t, y_t)
+    assert np.any(feasible) and np.all(feasible_exact[feasible])
+    assert np.max(np.abs(x_m[feasible] - x_exact[feasible])) < 1e-9
+    assert np.max(np.abs(y_m[feasible] - y_exact[feasible])) < 1e-9
+
+    # results are views of the buffers, a smaller query overwrites the start of the previous one
+    x_m = x_m.copy()
+    x_single, _, _ = lookup_table.target_to_mirror_batch(x_t[:1], y_t[:1], D)
+    assert np.array_equal(x_single, x_m[:1], equal_nan=True)
+
+    # points outside of the grid are infeasible, target_to_mirror_point uses the exact transform for them
+    _, _, feasible = lookup_table.target_to_mirror_batch(np.array([0, 210]), np.array([0, 0]), 500)
+    assert feasible[0] and not feasible[1]
+    x_point, y_point = target_to_mirror_point(np.array([210]), np.array([0]), 500, d, rotation_degree, lookup_table)
+    x_exact, y_exact = CoordinateTransform(d, 500, rotation_degree).target_to_mirror(np.array([210]), np.array([0]))
+    assert x_point == x_exact[0] and y_point == y_exact[0]
+
+    error = lookup_table.max_error(point_count)
+    print("Estimated interpolation error bound: ", lookup_table.error_bound)
+    print("Maximum interpolation error: ", error)
+    # error_bound is estimated from second differences of the grid, not from the exact derivatives
+    assert error <= 1.5 * lookup_table.error_bound
 
 
+if __name__ == "__main__":
+    test_solve_normal_vectors()
+    test_mirror_to_target()
+    test_lookup_table()
@@ -0,0 +1,228 @@
+"""
+    request/response client for the photodiode commands of raspberry_pi_pico/main.py ("pd_...", "oversample_...").
+
+    every command is sent as "#<request id> <command>" and the pico answers "#<request id> <reply>". a reader thread
+    matches the replies to the futures of the waiting requests, so a request can be sent before the reply of the
+    previous one arrived and a pico that does not answer raises TimeoutError after a bounded time.
+"""
+
+import sys
+import time
+import threading
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+def parse_readings(reply):
+    """
+        "v1,v2" -> ([v1, v2], None), "v1,v2;var1,var2" -> ([v1, v2], [var1, var2])
+    """
+    values = reply.split(";")
+    readings = [float(reading) for reading in values[0].split(",")]
+    if len(values) == 1:
+        return readings, None
+    return readings, [float(variance) for variance in values[1].split(",")]
+
+
+def parse_ok(reply):
+    if reply != "ok":
+        raise ValueError(f"unexpected reply {reply}")
+
+
+class SensorClient:
+    """
+        shares the serial port of the pico between the callers of a script.
+
+        usage:
+            sensor_client = SensorClient(s)
+            reading = sensor_client.get_sensor_reading(1)
+            future = sensor_client.request_readings([1, 2, 3]) # returns immediately
+            readings, variances = sensor_client.result(future)
+    """
+
+    def __init__(self, serial_port, timeout=0.1, poll_interval=0.01):
+        """
+            serial_port: opened serial.Serial of the pico, its read timeout is set to poll_interval so that the
+                         reader thread can be suspended and closed
+            timeout: time to wait for a reply (s)
+        """
+        self.serial_port = serial_port
+        self.serial_port.timeout = poll_interval
+        self.timeout = timeout
+        self.request_ids = itertools.count()
+        self.pending = {} # request id -> (future, parse)
+        self.lock = threading.Lock()
+        self.late_replies = 0 # replies after their request timed out, or without request id
+        self.suspend_event = threading.Event()
+        self.idle = threading.Event()
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sensor client", daemon=True)
+        self.thread.start()
+
+    def request(self, command, parse=lambda reply: reply):
+        """
+            sends command and returns a future with parse(reply), ValueError if the pico answers "error"
+        """
+        future = Future()
+        with self.lock:
+            request_id = next(self.request_ids)
+            future.request_id = request_id
+            self.pending[request_id] = (future, parse)
+            self.serial_port.write(f"#{request_id} {command}\n".encode())
+        return future
+
+    def result(self, future, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                self.pending.pop(future.request_id, None)
+            raise TimeoutError(f"no reply from the pico to request {future.request_id} in {timeout} s")
+
+    def request_readings(self, sensor_ids):
+        """
+            future with (readings, variances) of the sensors, variances is None without oversampling variance
+        """
+        return self.request(f"pd_{','.join(str(id) for id in sensor_ids)}", parse_readings)
+
+    def get_sensor_reading(self, sensor_id):
+        readings, variances = self.result(self.request_readings([sensor_id]))
+        return readings[0]
+
+    def get_sensor_readings(self, sensor_ids, return_variance=False):
+        """
+            sensor_ids: list of int
+            all sensors are sampled by the pico in one command, returns one reading per id in the same order
+            return_variance: also returns the variance of the samples of each reading, oversampling has to be set
+                             with variance=True
+        """
+        readings, variances = self.result(self.request_readings(sensor_ids))
+        if return_variance:
+            return readings, variances
+        return readings
+
+    def read_at_points(self, move, point_count, sensor_ids, settle_time=0.001, sample_time=0.0005):
+        """
+            move(i): points the laser at point i
+            the reading of point i is requested settle_time (s) after the move, the laser is moved to the next point
+            sample_time (s) after the request while the reply is still in flight
+            returns point_count lists with one reading per sensor id
+        """
+        readings = []
+        previous = None
+        for i in range(point_count):
+            move(i)
+            time.sleep(settle_time)
+            future = self.request_readings(sensor_ids)
+            # the pico samples when the request arrives, only the reply is overlapped with the next move
+            time.sleep(sample_time)
+            if previous is not None:
+                readings.append(self.result(previous)[0])
+            previous = future
+        if previous is not None:
+            readings.append(self.result(previous)[0])
+        return readings
+
+    def set_oversampling(self, sample_count, method="mean", variance=False):
+        """
+            sample_count: samples the pico takes for every reading
+            method: "mean" or "median" of the samples
+            variance: readings are sent together with the variance of the samples
+            the setting is kept by the pico until it is restarted
+        """
+        self.result(self.request(f"oversample_{sample_count}_{method}{'_var' if variance else ''}", parse_ok))
+
+    @contextmanager
+    def suspended(self, timeout=1.0):
+        """
+            the reader thread does not read from the port inside the with block, e.g. while the pico streams.
+            raises RuntimeError if the reader thread stopped (e.g. serial exception) and TimeoutError if it did not
+            pause within timeout (s)
+        """
+        self.idle.clear()
+        self.suspend_event.set()
+        try:
+            if not self.idle.wait(timeout):
+                if not self.thread.is_alive():
+                    raise RuntimeError("reader thread of the sensor client is not running")
+                raise TimeoutError(f"reader thread of the sensor client did not pause in {timeout} s")
+            yield
+        finally:
+            self.suspend_event.clear()
+
+    def run(self):
+        # reads return after poll_interval with whatever arrived, replies are only handled once their newline is in
+        # the buffer (the pico may send a reply and its newline separately)
+        buffer = bytearray()
+        while not self.closing.is_set():
+            if self.suspend_event.is_set():
+                # a reply cut off by the suspension can not be completed by the data read after it
+                buffer.clear()
+                self.idle.set()
+                time.sleep(self.serial_port.timeout)
+                continue
+            buffer += self.serial_port.read(max(1, self.serial_port.in_waiting))
+            end = buffer.find(b"\n")
+            while end >= 0:
+                line = bytes(buffer[:end])
+                del buffer[:end + 1]
+                self.handle_reply(line.decode(errors="replace").strip("\r"))
+                end = buffer.find(b"\n")
+
+    def handle_reply(self, line):
+        request_id, _, reply = line.partition(" ")
+        with self.lock:
+            try:
+                future, parse = self.pending.pop(int(request_id.lstrip("#")))
+            except (ValueError, KeyError):
+                self.late_replies += 1
+                return
+        if reply == "error":
+            future.set_exception(ValueError(f"pico could not execute request {future.request_id}"))
+            return
+        try:
+            future.set_result(parse(reply))
+        except ValueError as e:
+            future.set_exception(e)
+
+    def close(self):
+        self.closing.set()
+        self.thread.join()
+
+
+def test_sensor_client(port, sample_count=1000):
+    """
+        time per reading when every request waits for its reply, and when all requests are sent at once
+    """
+    import serial
+    import numpy as np
+    serial_port = serial.Serial(port=port, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE, timeout=1)
+    sensor_client = SensorClient(serial_port)
+
+    times = []
+    for i in range(sample_count):
+        start = time.perf_counter()
+        readings = sensor_client.get_sensor_readings([1, 2, 3])
+        times.append(time.perf_counter() - start)
+    print("Last readings: ", readings)
+    print(f"blocking reading (ms) p50: {1000 * np.median(times):.3f} max: {1000 * np.max(times):.3f}")
+
+    start = time.perf_counter()
+    futures = [sensor_client.request_readings([1, 2, 3]) for i in range(sample_count)]
+    for future in futures:
+        sensor_client.result(future, timeout=5)
+    print(f"pipelined reading (ms): {1000 * (time.perf_counter() - start) / sample_count:.3f}")
+
+    start = time.perf_counter()
+    try:
+        sensor_client.result(sensor_client.request("unknown_command"))
+    except ValueError:
+        print(f"error reply after (ms): {1000 * (time.perf_counter() - start):.3f}")
+    print("Late replies: ", sensor_client.late_replies)
+    sensor_client.close()
+
+
+if __name__ == "__main__":
+    test_sensor_client(sys.argv[1])
@@ -0,0 +1,359 @@
+"""
+    host side of the photodiode streaming mode of raspberry_pi_pico/main.py ("stream_<rate>" ... "stop").
+
+    the pico sends fixed-size binary frames (FRAME_DTYPE): sequence number, time.ticks_us() of the sample and the
+    raw readings of all channels. PhotodiodeStream decodes them on a reader thread into a ring buffer of device
+    times, PhotodiodeStream.snapshot converts them to host time (time.perf_counter(), time.time() only has a
+    resolution of ~16 ms on windows) for the calibration code.
+"""
+
+import sys
+import time
+import threading
+from collections import deque
+import numpy as np
+
+
+FRAME_DTYPE = np.dtype([("magic", "<u2"), ("sequence", "<u4"), ("timestamp", "<u4"), ("readings", "<u2", (3,)), ("checksum", "<u2")])
+FRAME_SIZE = FRAME_DTYPE.itemsize
+MAGIC = 0x5aa5 # bytes 0xa5 0x5a
+MAGIC_BYTES = b"\xa5\x5a"
+TICKS_PERIOD = 2**30 # time.ticks_us() of the rp2 port wraps at 2**30 us
+SEQUENCE_PERIOD = 2**32
+CONVERSION_FACTOR = 3.3 / 65535 # raw reading to voltage, same as the pd_N replies
+MAX_STREAM_RATE = 20000 # Hz, same limit as the pico
+
+
+def frame_checksum(frames):
+    readings = frames["readings"].astype(np.uint64).sum(axis=1)
+    return (frames["sequence"].astype(np.uint64) + frames["timestamp"] + readings) & 0xffff
+
+
+def decode_frames(data):
+    """
+        data: bytes received from the pico
+        returns (frames, used) with the valid frames in data and the number of bytes consumed. bytes after the last
+        complete frame are not consumed. corrupted frames are skipped by searching for the next magic number.
+    """
+    blocks = []
+    position = 0
+    while len(data) - position >= FRAME_SIZE:
+        count = (len(data) - position) // FRAME_SIZE
+        block = np.frombuffer(data, dtype=FRAME_DTYPE, count=count, offset=position)
+        valid = (block["magic"] == MAGIC) & (block["checksum"] == frame_checksum(block))
+        if valid.all():
+            blocks.append(block)
+            position += count * FRAME_SIZE
+            break
+        first_invalid = int(np.argmin(valid))
+        blocks.append(block[:first_invalid])
+        position += first_invalid * FRAME_SIZE
+        next_magic = data.find(MAGIC_BYTES, position + 1)
+        if next_magic == -1:
+            # the last byte can be the first half of the next magic number
+            position = len(data) - 1
+            break
+        position = next_magic
+    if not blocks:
+        return np.zeros(0, dtype=FRAME_DTYPE), position
+    return np.concatenate(blocks), position
+
+
+class SensorRingBuffer:
+    """
+        the last capacity samples: device time (s), sequence number (unwrapped) and voltage of every channel
+    """
+
+    def __init__(self, capacity, channel_count=3):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.sequences = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros((capacity, channel_count))
+        self.count = 0 # samples appended in total
+        self.lock = threading.Lock()
+
+    def append(self, times, sequences, values):
+        times = times[-self.capacity:]
+        sequences = sequences[-self.capacity:]
+        values = values[-self.capacity:]
+        indices = (self.count + np.arange(len(times))) % self.capacity
+        with self.lock:
+            self.times[indices] = times
+            self.sequences[indices] = sequences
+            self.values[indices] = values
+            self.count += len(times)
+
+    def snapshot(self):
+        """
+            returns (times, sequences, values) of all samples in the buffer, oldest first
+        """
+        with self.lock:
+            if self.count <= self.capacity:
+                order = np.arange(self.count)
+            else:
+                order = (self.count + np.arange(self.capacity)) % self.capacity
+            return self.times[order], self.sequences[order], self.values[order]
+
+    def between(self, start, end):
+        """
+            returns (times, values) of the samples taken in [start, end) (device time)
+        """
+        times, sequences, values = self.snapshot()
+        first, last = np.searchsorted(times, [start, end])
+        return times[first:last], values[first:last]
+
+    def at(self, t):
+        """
+            readings of the last sample taken at or before device time t, None if there is none in the buffer
+        """
+        times, sequences, values = self.snapshot()
+        i = int(np.searchsorted(times, t, side="right")) - 1
+        if i < 0:
+            return None
+        return values[i]
+
+    def latest_time(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.times[(self.count - 1) % self.capacity]
+
+
+class PhotodiodeStream:
+    """
+        streams the photodiodes of the pico into a SensorRingBuffer (buffer).
+
+        the buffer keeps device times. usb latency only makes (receive time - device time) of a read larger than the
+        real clock offset, so the smallest difference is close to it. snapshot converts the device times after
+        the reads around each sample are known (to_host_times): samples received before the latency was low are
+        not shifted by it, and slow drift of the pico clock is followed.
+
+        usage:
+            stream = PhotodiodeStream(s, rate=2000)
+            stream.start()
+            time.sleep(0.1)
+            stream.stop()
+            times, sequences, values = stream.snapshot()
+    """
+
+    def __init__(self, serial_port, rate=1000, buffer_seconds=60, offset_window=500, offset_interval=1.0):
+        """
+            serial_port: opened serial.Serial of the pico, it can not be used for other commands while streaming
+            rate: samples per second per channel
+            offset_window: reads used for the current clock offset of wait_until
+            offset_interval: snapshot takes the smallest clock offset of every interval of this length (s)
+        """
+        if not 0 < rate <= MAX_STREAM_RATE:
+            raise ValueError(f"stream rate {rate} Hz is not in (0, {MAX_STREAM_RATE}]")
+        self.serial_port = serial_port
+        self.rate = rate
+        self.buffer_seconds = buffer_seconds
+        self.offset_window = offset_window
+        self.offset_interval = offset_interval
+        self.offset_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        # the pico starts a new sequence with every stream command
+        self.buffer = SensorRingBuffer(int(self.rate * self.buffer_seconds))
+        self.offsets = deque(maxlen=self.offset_window)
+        self.read_device_times = [] # device time (s) of the last sample of every read
+        self.read_offsets = [] # receive time - device time of every read
+        self.device_time = None # unwrapped device time of the last sample (us)
+        self.sequence = None # unwrapped sequence number of the last sample
+        self.last_ticks = None
+        self.last_sequence = None
+        self.lost = 0 # frames missing in the sequence
+        self.corrupted_bytes = 0 # bytes skipped while searching for frames
+
+    def start(self):
+        """
+            clears the buffer and starts streaming
+        """
+        self.reset()
+        self.serial_port.reset_input_buffer()
+        self.serial_port.write(f"stream_{self.rate}\n".encode())
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="photodiode stream", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.serial_port.write(b"stop\n")
+        # frames sent before the pico read the command
+        time.sleep(0.05)
+        self.serial_port.reset_input_buffer()
+
+    def wait_until(self, t, timeout=1.0):
+        """
+            blocks until a sample taken after host time t is in the buffer, returns False on timeout
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            latest = self.buffer.latest_time()
+            if latest is not None:
+                with self.offset_lock:
+                    offset = min(self.offsets)
+                if latest + offset > t:
+                    return True
+            if time.perf_counter() > deadline:
+                return False
+            time.sleep(0.0005)
+
+    def run(self):
+        data = bytearray()
+        while not self.stop_event.is_set():
+            chunk = self.serial_port.read(max(FRAME_SIZE, self.serial_port.in_waiting))
+            receive_time = time.perf_counter()
+            if not chunk:
+                continue
+            data += chunk
+            frames, used = decode_frames(bytes(data))
+            self.corrupted_bytes += used - len(frames) * FRAME_SIZE
+            del data[:used]
+            if len(frames):
+                self.add_frames(frames, receive_time)
+
+    def add_frames(self, frames, receive_time):
+        ticks = frames["timestamp"].astype(np.int64)
+        sequences = frames["sequence"].astype(np.int64)
+        if self.last_ticks is None:
+            self.device_time = int(ticks[0])
+            self.sequence = int(sequences[0]) - 1
+            self.last_ticks = int(ticks[0])
+            self.last_sequence = int(sequences[0]) - 1
+        tick_steps = np.diff(ticks, prepend=self.last_ticks) % TICKS_PERIOD
+        sequence_steps = np.diff(sequences, prepend=self.last_sequence) % SEQUENCE_PERIOD
+        self.lost += int(np.sum(sequence_steps - 1))
+        device_times = self.device_time + np.cumsum(tick_steps)
+        unwrapped_sequences = self.sequence + np.cumsum(sequence_steps)
+        self.device_time = int(device_times[-1])
+        self.sequence = int(unwrapped_sequences[-1])
+        self.last_ticks = int(ticks[-1])
+        self.last_sequence = int(sequences[-1])
+
+        # every frame was received at receive_time or earlier
+        device_times = device_times * 1e-6
+        offset = receive_time - device_times[-1]
+        with self.offset_lock:
+            self.offsets.append(offset)
+            self.read_device_times.append(device_times[-1])
+            self.read_offsets.append(offset)
+        self.buffer.append(device_times, unwrapped_sequences, frames["readings"] * CONVERSION_FACTOR)
+
+    def to_host_times(self, device_times):
+        """
+            device_times: (N,) device times (s) of samples in the buffer
+            the smallest offset of the reads in every offset_interval is interpolated between the intervals
+        """
+        with self.offset_lock:
+            read_times = np.array(self.read_device_times)
+            read_offsets = np.array(self.read_offsets)
+        if len(read_times) == 0:
+            raise RuntimeError("photodiode stream has no reads to estimate the clock offset")
+        intervals = ((read_times - read_times[0]) // self.offset_interval).astype(np.int64)
+        # reads sorted by interval, the smallest offset first in each interval
+        order = np.lexsort((read_offsets, intervals))
+        smallest = order[np.flatnonzero(np.diff(intervals[order], prepend=-1))]
+        return device_times + np.interp(device_times, read_times[smallest], read_offsets[smallest])
+
+    def snapshot(self):
+        """
+            returns (host times, sequences, values) of all samples in the buffer, oldest first
+        """
+        device_times, sequences, values = self.buffer.snapshot()
+        return self.to_host_times(device_times), sequences, values
+
+
+def match_setpoints(times, values, start_times, end_times):
+    """
+        times, values: samples of the stream (SensorRingBuffer.snapshot)
+        start_times, end_times: (N,) host times between which the samples belong to each setpoint
+        returns (N, channels) mean of the samples of each setpoint (nan without samples) and (N,) sample counts
+    """
+    first = np.searchsorted(times, start_times)
+    last = np.searchsorted(times, end_times)
+    counts = np.maximum(last - first, 0)
+    sums = np.concatenate((np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (sums[np.maximum(last, first)] - sums[first]) / counts[:, np.newaxis]
+    return means, counts
+
+
+def encode_frames(sequences, timestamps, readings):
+    """
+        frames as sent by the pico, used for testing the decoder
+    """
+    frames = np.zeros(len(sequences), dtype=FRAME_DTYPE)
+    frames["magic"] = MAGIC
+    frames["sequence"] = np.asarray(sequences) % SEQUENCE_PERIOD
+    frames["timestamp"] = np.asarray(timestamps) % TICKS_PERIOD
+    frames["readings"] = readings
+    frames["checksum"] = frame_checksum(frames)
+    return frames.tobytes()
+
+
+def test_decode_frames():
+    rng = np.random.default_rng(0)
+    count = 1000
+    sequences = np.arange(count)
+    timestamps = TICKS_PERIOD - 500 * 1000 + 1000 * np.arange(count) # wraps in the middle
+    readings = rng.integers(0, 65535, (count, 3))
+    data = bytearray(encode_frames(sequences, timestamps, readings))
+    data[100 * FRAME_SIZE + 3] ^= 0xff # corrupt frame 100
+    del data[500 * FRAME_SIZE:500 * FRAME_SIZE + 5] # lose part of frame 500
+    data = b"\x00\x5a" + bytes(data) # garbage before the first frame
+
+    stream = PhotodiodeStream(None, rate=1000, buffer_seconds=10, offset_interval=0.5)
+    received = bytearray()
+    for i in range(0, len(data), 61): # arrives in pieces that do not line up with the frames
+        received += data[i:i + 61]
+        frames, used = decode_frames(bytes(received))
+        del received[:used]
+        if len(frames):
+            # 2 ms usb latency, 8 ms more in the first 50 ms of each interval (e.g. at the start of the stream)
+            delay = 0.002 + (0.008 if frames["sequence"][-1] % 500 < 50 else 0)
+            stream.add_frames(frames, receive_time=1000.0 + 0.001 * frames["sequence"][-1] + delay)
+
+    times, sequences, values = stream.snapshot()
+    assert stream.lost == 2 and len(times) == count - 2
+    # the larger latency at the start does not shift the first samples
+    assert np.allclose(times, 1000.002 + 0.001 * sequences)
+    assert np.allclose(values, readings[np.isin(np.arange(count), [100, 500], invert=True)] * CONVERSION_FACTOR)
+    print(f"Decoded {len(times)} of {count} frames, lost: {stream.lost}")
+
+    # a setpoint every 2 samples, the second half of each setpoint is used
+    set_times = 1000.002 + 0.002 * np.arange(count // 2)
+    means, counts = match_setpoints(times, values, set_times + 0.0005, set_times + 0.002)
+    assert np.array_equal(counts == 0, np.isin(2 * np.arange(count // 2) + 1, [100, 500]))
+    assert np.allclose(means[counts == 1], readings[2 * np.arange(count // 2) + 1][counts == 1] * CONVERSION_FACTOR)
+
+    start = time.perf_counter()
+    frames, used = decode_frames(encode_frames(np.arange(100000), np.arange(100000), readings[np.arange(100000) % count]))
+    print(f"decode time per frame (us): {1e6 * (time.perf_counter() - start) / len(frames):.3f}")
+
+
+def test_photodiode_stream(port, rate=1000, duration=5):
+    """
+        sample rate and lost frames on the pico connected to port
+    """
+    import serial
+    serial_port = serial.Serial(port=port, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE, timeout=0.1)
+    stream = PhotodiodeStream(serial_port, rate=rate)
+    stream.start()
+    time.sleep(duration)
+    stream.stop()
+    times, sequences, values = stream.buffer.snapshot()
+    print(f"Samples: {len(times)} ({len(times) / duration:.1f} per second), lost: {stream.lost}, corrupted bytes: {stream.corrupted_bytes}")
+    print("Mean voltage: ", values.mean(axis=0))
+    print(f"Sample interval (ms) p50: {1000 * np.median(np.diff(times)):.3f} max: {1000 * np.max(np.diff(times)):.3f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        test_photodiode_stream(sys.argv[1])
+    else:
+        test_decode_frames()
@@ -3,11 +3,13 @@ import pykinect_azure as pykinect
 from pykinect_azure import K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_DEPTH, k4a_float2_t
 import numpy as np
 from image_processing.circle_detector import detect_circle_position
+from image_processing.depth_deprojection import SparseDepthLookup
 import optoMDC
-from mirror.coordinate_transformation import CoordinateTransform
+from mirror.coordinate_transformation import TargetToMirrorLookupTable, target_to_mirror_point
 import pickle
 import time
 from pykinect_azure.k4a.transformation import Transformation
+from tracking.stage_timer import StageTimer
 
 
 
@@ -23,6 +25,9 @@ with open('{}/parameters.pkl'.format(CALIBRATION_SAVE_PATH), 'rb') as f:
     R = loaded_dict["R"]
     t = loaded_dict["t"]
 
+# target to mirror table of build_lookup_table.py, the exact transform is used if it has not been built
+lookup_table = TargetToMirrorLookupTable.load_if_exists(CALIBRATION_SAVE_PATH, d, MIRROR_ROTATION_DEG)
+
 # initial mouse position
 mouse_x = 0
 mouse_y = 0
@@ -69,24 +74,31 @@ def main():
     # Start device
     device = pykinect.start_device(config=device_config)
 
+    # intrinsics, extrinsics and depth pixel rays are cached, only the depth pixels around the target are transformed
+    depth_lookup = SparseDepthLookup.from_calibration(device.calibration)
+
     cv2.namedWindow('Laser Detector',cv2.WINDOW_NORMAL)
     cv2.setMouseCallback('Laser Detector', onMousemove)
 
 
+    # per-stage latencies are written to code_profiling_results on exit
+    timer = StageTimer()
+    timer.dump_on_exit()
+
     while True:
         start = time.time()
+        stamps = timer.start()
         # Get capture
         
         capture = device.update()
-        #print("Time until capture (s): ", time.time() - start)
+        timer.mark(stamps, "capture")
 
         # Get the color image from the capture
         ret_color, color_image = capture.get_color_image()
-        #print("Time until color image (s): ", time.time() - start)
+        timer.mark(stamps, "color")
 
-        # Get the colored depth
-        ret_depth, transformed_depth_image = capture.get_transformed_depth_image()
-        #print("Time until depth image (s): ", time.time() - start)
+        # Get the native depth, only the mouse pixel is transformed into the color camera
+        ret_depth, depth_image = capture.get_depth_image()
 
         if not ret_color or not ret_depth:
             continue  
@@ -94,28 +106,22 @@ def main():
         
         pix_x = mouse_x
         pix_y = mouse_y
-        rgb_depth = transformed_depth_image[pix_y, pix_x]
-
-        pixels = k4a_float2_t((pix_x, pix_y))
-
-        pos3d_color = device.calibration.convert_2d_to_3d(pixels, rgb_depth, K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_COLOR)
-        
-
-        camera_coordinates = np.array([pos3d_color.xyz.x, pos3d_color.xyz.y, pos3d_color.xyz.z]).reshape((3, 1))  
+        camera_coordinates = depth_lookup.color_pixel_to_3d(depth_image, pix_x, pix_y)
+        timer.mark(stamps, "depth")
         
         # rotate and translate
 
         camera_coordinates_in_laser_coordinates =  R @ camera_coordinates + t
        
-        coordinate_transform = CoordinateTransform(d=d, D=camera_coordinates_in_laser_coordinates[2].item(), rotation_degree=MIRROR_ROTATION_DEG)
-
-        y_m, x_m = coordinate_transform.target_to_mirror(camera_coordinates_in_laser_coordinates[1], camera_coordinates_in_laser_coordinates[0]) # order is changed in order to change x and y axis
-        print("Time until completing calculations (s): ", time.time() - start)
+        mirror_coor = target_to_mirror_point(camera_coordinates_in_laser_coordinates[1], camera_coordinates_in_laser_coordinates[0], camera_coordinates_in_laser_coordinates[2].item(), d, MIRROR_ROTATION_DEG, lookup_table) # order is changed in order to change x and y axis
+        timer.mark(stamps, "transform")
         
         
-        if(len(y_m) > 0 and len(x_m) > 0):
-            si_0.SetXY(y_m[0])        
-            si_1.SetXY(x_m[0]) 
+        if mirror_coor is not None:
+            si_0.SetXY(mirror_coor[0])        
+            si_1.SetXY(mirror_coor[1]) 
+        timer.mark(stamps, "actuate")
+        timer.finish(stamps)
 
 
         
@@ -1,4 +1,5 @@
 #include <cstdio>
+#include <stdexcept>
 #include "circle_detector.h"
 #include "config.h"
 
@@ -13,10 +14,16 @@ using namespace std;
 #define MAX_SEGMENTS 10000 // TODO: necessary?
 #define CIRCULARITY_TOLERANCE 0.02
 
-cv::CircleDetector::CircleDetector(int _width,int _height, float _diameter_ratio) 
+cv::CircleDetector::CircleDetector(int _width,int _height, float _diameter_ratio) :
+  CircleDetector(_width, _height, new cv::CircleDetector::Context(_width, _height), _diameter_ratio)
 {
-  // initialize context
-  context = new cv::CircleDetector::Context(_width, _height);
+  own_context = true;
+}
+
+cv::CircleDetector::CircleDetector(int _width,int _height, Context* _context, float _diameter_ratio) 
+{
+  context = _context;
+  own_context = false;
 
 	minSize = 10;
   maxSize = 100*100; // TODO: test!
@@ -26,8 +33,8 @@ cv::CircleDetector::CircleDetector(int _width,int _height, float _diameter_ratio
 	ratioTolerance = 1.0;
 	
 	//initialization - fixed params
-	width = _width;
-	height = _height;
+	width = full_width = _width;
+	height = full_height = _height;
 	len = width*height;
 	siz = len*3;
   diameterRatio = _diameter_ratio;
@@ -39,11 +46,14 @@ cv::CircleDetector::CircleDetector(int _width,int _height, float _diameter_ratio
 
   threshold = (3 * 256) / 2;
   threshold_counter = 0;
+
+  pixel_step = 3;
+  continuous = true;
 }
 
 cv::CircleDetector::~CircleDetector()
 {
-  delete context;
+  if (own_context) delete context;
 }
 
 int cv::CircleDetector::get_threshold(void) const
@@ -106,7 +116,7 @@ bool cv::CircleDetector::examineCircle(const cv::Mat& image, cv::CircleDetector:
     pos = position+1;
     pixel_class = buffer[pos];
     if (pixel_class == 0) {
-      uchar* ptr = &image.data[pos*3];
+      const uchar* ptr = pixel(image, pos);
       pixel_class = ((ptr[0]+ptr[1]+ptr[2]) > threshold)-2;
       if (pixel_class != type) buffer[pos] = pixel_class;
     }
@@ -119,7 +129,7 @@ bool cv::CircleDetector::examineCircle(const cv::Mat& image, cv::CircleDetector:
 		pos = position-1;
 		pixel_class = buffer[pos];
     if (pixel_class == 0) {
-      uchar* ptr = &image.data[pos*3];
+      const uchar* ptr = pixel(image, pos);
       pixel_class = ((ptr[0]+ptr[1]+ptr[2]) > threshold)-2;
       if (pixel_class != type) buffer[pos] = pixel_class;
     }
@@ -132,7 +142,7 @@ bool cv::CircleDetector::examineCircle(const cv::Mat& image, cv::CircleDetector:
     pos = position-width;
 		pixel_class = buffer[pos];
     if (pixel_class == 0) {
-      uchar* ptr = &image.data[pos*3];
+      const uchar* ptr = pixel(image, pos);
       pixel_class = ((ptr[0]+ptr[1]+ptr[2]) > threshold)-2;
       if (pixel_class != type) buffer[pos] = pixel_class;
     }
@@ -145,7 +155,7 @@ bool cv::CircleDetector::examineCircle(const cv::Mat& image, cv::CircleDetector:
 		pos = position+width;
 		pixel_class = buffer[pos];
     if (pixel_class == 0) {
-      uchar* ptr = &image.data[pos*3];
+      const uchar* ptr = pixel(image, pos);
       pixel_class = ((ptr[0]+ptr[1]+ptr[2]) > threshold)-2;
       if (pixel_class != type) buffer[pos] = pixel_class;
     }
@@ -182,7 +192,8 @@ bool cv::CircleDetector::examineCircle(const cv::Mat& image, cv::CircleDetector:
 			circle.mean = 0;
 			for (int p = queueOldStart;p<queueEnd;p++){
 				pos = queue[p];
-				circle.mean += image.data[pos*3]+image.data[pos*3+1]+image.data[pos*3+2];
+				const uchar* ptr = pixel(image, pos);
+				circle.mean += ptr[0]+ptr[1]+ptr[2];
 			}
 			circle.mean = circle.mean/circle.size;
 			result = true;
@@ -197,17 +208,126 @@ bool cv::CircleDetector::examineCircle(const cv::Mat& image, cv::CircleDetector:
 }
 
 
-cv::CircleDetector::Circle cv::CircleDetector::detect_np(py::array_t<uint8_t, py::array::c_style | py::array::forcecast> array, const Circle& previous_circle ){
-    // std::cout << "C++ First array element: " << static_cast<int>(array.at(0, 0, 0)) << std::endl; 
-		 
-		// auto dim = array.ndim();
-		// std::cout << "C++ Array dim: " << dim << std::endl;
-		// std::cout << "C++ Array dtype: " << array.dtype() << std::endl;
+// wraps a (height, width, channels) uint8 numpy image as cv::Mat without copying. row padding and pixel strides of
+// 3 or more bytes (e.g. bgra[:, :, :3] views) are supported, any other layout or dtype is copied into array first.
+// (height, width) gray images are converted to BGR.
+cv::Mat cv::numpy_to_mat(py::array& array, int full_width, int full_height)
+{
+  if (array.ndim() == 2) {
+    array = py::array_t<uint8_t, py::array::c_style | py::array::forcecast>::ensure(array);
+    if (array.shape(0) != full_height || array.shape(1) != full_width) throw std::invalid_argument("image size does not match detector size");
+    cv::Mat bgr;
+    cv::cvtColor(cv::Mat(array.shape(0), array.shape(1), CV_8UC1, (void*)array.data()), bgr, cv::COLOR_GRAY2BGR);
+    return bgr;
+  }
+
+  bool wrappable = py::isinstance<py::array_t<uint8_t>>(array) && array.ndim() == 3 && array.shape(2) >= 3 &&
+                   array.strides(2) == 1 && array.strides(1) >= 3 && array.strides(0) >= array.shape(1) * array.strides(1);
+  if (!wrappable) {
+    array = py::array_t<uint8_t, py::array::c_style | py::array::forcecast>::ensure(array);
+    if (!array || array.ndim() != 3 || array.shape(2) < 3) throw std::invalid_argument("image must have shape (height, width), (height, width, 3) or (height, width, 4)");
+  }
+  if (array.shape(0) != full_height || array.shape(1) != full_width) throw std::invalid_argument("image size does not match detector size");
+
+  return cv::Mat(array.shape(0), array.shape(1), CV_8UC((int)array.strides(1)), (void*)array.data(), array.strides(0));
+}
+
+cv::CircleDetector::Circle cv::CircleDetector::detect_np(py::array array, const Circle& previous_circle){
+  auto mat = numpy_to_mat(array, full_width, full_height);
+  Circle circle;
+  {
+    // other python threads (capture, mirror control) keep running during detection
+    py::gil_scoped_release release;
+    set_frame_size(full_width, full_height);
+    circle = this->detect(mat, previous_circle);
+  }
+  return circle;
+}
 
-		
-		auto mat = cv::Mat(array.shape()[0], array.shape()[1], CV_8UC3, (void*)array.data());
-		
-    return this->detect(mat, previous_circle);
+cv::CircleDetector::Circle cv::CircleDetector::detect_roi_np(py::array array, const Circle& previous_circle,
+                                                             float predicted_x, float predicted_y, int roi_size, float roi_growth)
+{
+  // only the searched windows are copied in detect_roi
+  auto mat = numpy_to_mat(array, full_width, full_height);
+  Circle circle;
+  {
+    py::gil_scoped_release release;
+    circle = this->detect_roi(mat, previous_circle, predicted_x, predicted_y, roi_size, roi_growth);
+  }
+  return circle;
+}
+
+// window sides are rounded up to powers of two. windows are moved inside the image instead of being clipped,
+// so the buffer layout (and its cleanup in set_frame_size) only changes when the marker size changes a lot.
+float cv::CircleDetector::window_side(float side)
+{
+  float rounded = 16;
+  while (rounded < side) rounded *= 2;
+  return rounded;
+}
+
+void cv::CircleDetector::set_frame_size(int _width, int _height)
+{
+  if (_width == width && _height == height) return;
+  width = context->width = _width;
+  height = context->height = _height;
+  len = width*height;
+  siz = len*3;
+  context->cleanup(Circle(), false);
+}
+
+cv::CircleDetector::Circle cv::CircleDetector::detect_roi(const cv::Mat& image, const cv::CircleDetector::Circle& previous_circle,
+                                                          float predicted_x, float predicted_y, int roi_size, float roi_growth)
+{
+  if (previous_circle.valid || (predicted_x >= 0 && predicted_y >= 0)) {
+    if (predicted_x < 0 || predicted_y < 0) {
+      predicted_x = previous_circle.x;
+      predicted_y = previous_circle.y;
+    }
+    int cx = min(max((int)predicted_x, 0), full_width - 1);
+    int cy = min(max((int)predicted_y, 0), full_height - 1);
+
+    // window should contain the whole marker with some margin for motion
+    float side = max(roi_size, 16);
+    if (previous_circle.valid) side = max(side, 3.0f * max(previous_circle.maxx - previous_circle.minx, previous_circle.maxy - previous_circle.miny));
+    side = window_side(side);
+
+    // failed window searches must not change the threshold search of the full frame detection
+    int saved_threshold = threshold;
+    int saved_threshold_counter = threshold_counter;
+
+    cv::Mat roi_image;
+    while (side < full_width || side < full_height) {
+      int x0 = min(max(cx - (int)side / 2, 0), max(full_width - (int)side, 0));
+      int y0 = min(max(cy - (int)side / 2, 0), max(full_height - (int)side, 0));
+      cv::Rect roi(x0, y0, min((int)side, full_width - x0), min((int)side, full_height - y0));
+      image(roi).copyTo(roi_image);
+
+      // start the search at the predicted position
+      Circle seed;
+      seed.valid = true;
+      seed.x = cx - roi.x;
+      seed.y = cy - roi.y;
+
+      set_frame_size(roi.width, roi.height);
+      Circle circle = detect(roi_image, seed);
+      if (circle.valid) {
+        circle.x += roi.x;
+        circle.y += roi.y;
+        circle.minx += roi.x;
+        circle.maxx += roi.x;
+        circle.miny += roi.y;
+        circle.maxy += roi.y;
+        return circle;
+      }
+      threshold = saved_threshold;
+      threshold_counter = saved_threshold_counter;
+      side = window_side(side * max(roi_growth, 1.1f));
+    }
+  }
+
+  set_frame_size(full_width, full_height);
+  return detect(image, previous_circle);
 }
 
 // get numpy array instead of 
@@ -216,6 +336,9 @@ cv::CircleDetector::Circle cv::CircleDetector::detect(const cv::Mat& image, cons
   vector<int>& buffer = context->buffer;
   vector<int>& queue = context->queue;
 
+  pixel_step = image.elemSize();
+  continuous = image.isContinuous();
+
 	int pos = (height-1)*width;
   int ii = 0;
 	int start = 0;
@@ -238,7 +361,7 @@ cv::CircleDetector::Circle cv::CircleDetector::detect(const cv::Mat& image, cons
     // if current position needs to be thresholded
     int pixel_class = buffer[ii];
 		if (pixel_class == 0){
-			uchar* ptr = &image.data[ii*3];
+			const uchar* ptr = pixel(image, ii);
       //cout << "value: " << (ptr[0]+ptr[1]+ptr[2]) << endl;
       pixel_class = ((ptr[0]+ptr[1]+ptr[2]) > threshold)-2;
       if (pixel_class == -2) buffer[ii] = pixel_class; // only tag black pixels, to avoid dirtying the buffer outside the ellipse
@@ -260,7 +383,7 @@ cv::CircleDetector::Circle cv::CircleDetector::detect(const cv::Mat& image, cons
         // treshold the middle of the ring and check if it is detected as "white"
         pixel_class = buffer[pos];
 				if (pixel_class == 0){
-					uchar* ptr = &image.data[pos*3];
+					const uchar* ptr = pixel(image, pos);
 					pixel_class = ((ptr[0]+ptr[1]+ptr[2]) > threshold)-2;
           buffer[pos] = pixel_class;
 				}
@@ -399,13 +522,19 @@ void cv::CircleDetector::cover_last_detected(cv::Mat& image)
   const vector<int>& queue = context->queue;
   for (int i = queueOldStart; i < queueEnd; i++) {
     int pos = queue[i];
-    uchar* ptr = image.data + 3*pos;
+    uchar* ptr = image.data + (pos / width) * image.step[0] + (pos % width) * image.elemSize();
     *ptr = 255; ptr++;
     *ptr = 255; ptr++;
     *ptr = 255;
   }
 }
 
+void cv::CircleDetector::get_last_detected(std::vector<int>& positions) const
+{
+  const vector<int>& queue = context->queue;
+  positions.insert(positions.end(), queue.begin() + queueOldStart, queue.begin() + queueEnd);
+}
+
 void cv::CircleDetector::improveEllipse(const cv::Mat& image, Circle& c)
 {
   cv::Mat subimg;
@@ -459,6 +588,8 @@ void cv::CircleDetector::improveEllipse(const cv::Mat& image, Circle& c)
 cv::CircleDetector::Circle::Circle(void)
 {
   x = y = 0;
+  m0 = m1 = v0 = v1 = 0;
+  size = 0;
   round = valid = false;
 }
 
@@ -538,8 +669,7 @@ void cv::CircleDetector::Context::cleanup(const Circle& c, bool fast_cleanup) {
 		}    
   }
   else {
-    cout << "clean whole buffer" << endl;
-		memset(&buffer[0], 0, sizeof(int)*buffer.size());
+		memset(&buffer[0], 0, sizeof(int)*width*height); // only the part used by the current frame (or roi) size
 
     //image delimitation
 		for (int i = 0;i<width;i++){
@@ -19,6 +19,8 @@ namespace py = pybind11;
 #define WHYCON_DEFAULT_OUTER_DIAMETER 0.122
 #define WHYCON_DEFAULT_INNER_DIAMETER 0.050
 #define WHYCON_DEFAULT_DIAMETER_RATIO (WHYCON_DEFAULT_INNER_DIAMETER/WHYCON_DEFAULT_OUTER_DIAMETER)
+#define WHYCON_DEFAULT_ROI_SIZE 128
+#define WHYCON_DEFAULT_ROI_GROWTH 2.0f
 
 namespace cv {
   class CircleDetector
@@ -28,13 +30,25 @@ namespace cv {
       class Context;
       
       CircleDetector(int width, int height, float diameter_ratio = WHYCON_DEFAULT_DIAMETER_RATIO);
+      // detectors that share a context (ManyCircleDetector), context is not deleted by the detector
+      CircleDetector(int width, int height, Context* context, float diameter_ratio = WHYCON_DEFAULT_DIAMETER_RATIO);
       ~CircleDetector();
       
-      Circle detect_np(py::array_t<uint8_t, py::array::c_style | py::array::forcecast> array, const Circle& previous_circle = cv::CircleDetector::Circle());
+      // not thread safe, every thread needs its own detector. the GIL is released while detecting
+      Circle detect_np(py::array array, const Circle& previous_circle = cv::CircleDetector::Circle());
 
       Circle detect(const cv::Mat& image, const Circle& previous_circle = cv::CircleDetector::Circle());
+
+      // search a window around the predicted position (previous circle position if not given) first,
+      // grow the window on failure and fall back to the full frame
+      Circle detect_roi_np(py::array array, const Circle& previous_circle = cv::CircleDetector::Circle(),
+                           float predicted_x = -1, float predicted_y = -1, int roi_size = WHYCON_DEFAULT_ROI_SIZE, float roi_growth = WHYCON_DEFAULT_ROI_GROWTH);
+      Circle detect_roi(const cv::Mat& image, const Circle& previous_circle = cv::CircleDetector::Circle(),
+                        float predicted_x = -1, float predicted_y = -1, int roi_size = WHYCON_DEFAULT_ROI_SIZE, float roi_growth = WHYCON_DEFAULT_ROI_GROWTH);
       bool examineCircle(const cv::Mat& image, Circle& circle, int ii, float areaRatio);
       void cover_last_detected(cv::Mat& image);
+      // buffer positions (y * width + x) of the pixels of the last detected circle
+      void get_last_detected(std::vector<int>& positions) const;
       
       void improveEllipse(const cv::Mat& image, Circle& c);
       int get_threshold(void) const;
@@ -51,6 +65,18 @@ namespace cv {
 
       float outerAreaRatio,innerAreaRatio,areasRatio;
       int width,height,len,siz;
+      int full_width,full_height; // frame size, width and height are the roi size while searching in a roi
+      void set_frame_size(int _width, int _height);
+      static float window_side(float side);
+
+      // layout of the image that is being searched
+      int pixel_step;
+      bool continuous;
+      // pointer to the pixel at buffer position pos, rows of strided images may be padded
+      inline const uchar* pixel(const cv::Mat& image, int pos) const {
+        if (continuous) return image.data + pos * pixel_step;
+        return image.data + (pos / width) * image.step[0] + (pos % width) * pixel_step;
+      }
 
       int threshold, threshold_counter;
       void change_threshold(void);
@@ -58,6 +84,7 @@ namespace cv {
       int queueStart,queueEnd,queueOldStart,numSegments;
 
       Context* context;
+      bool own_context;
       
     public:
       class Circle {
@@ -95,6 +122,9 @@ namespace cv {
           friend class CircleDetector;
       };
   };
+
+  // wraps a uint8 numpy image of the given size as cv::Mat, copies only if the layout can not be wrapped
+  cv::Mat numpy_to_mat(py::array& array, int width, int height);
 }
 
 
@@ -3,28 +3,36 @@
 #include <pybind11/numpy.h>
 #include <iostream>
 #include "circle_detector.h"
+#include "many_circle_detector.h"
 
 
 namespace py = pybind11;
 
 
+// one row of the structured array returned by ManyCircleDetectorClass.detect_np
+struct CircleRecord {
+    float x, y;
+    float m0, m1;
+    float v0, v1;
+    int size;
+    bool valid;
+};
+
+
 
 
 
 
 PYBIND11_MODULE(circle_detector_module, module_handle)
 {
+    PYBIND11_NUMPY_DTYPE(CircleRecord, x, y, m0, m1, v0, v1, size, valid);
+
 	module_handle.doc() = "I'm a docstring hehe";
 	// module_handle.def("some_fn_python_name", &some_fn);
 	// module_handle.def("some_class_factory", &some_class_factory);
 	// module_handle.def("get_nparray", &get_nparray);
 
-	py::class_<cv::CircleDetector>(
-		module_handle, "CircleDetectorClass")
-		.def(py::init<int, int, float >(), py::arg("width"), py::arg("height"), py::arg("diameter_ratio") = WHYCON_DEFAULT_DIAMETER_RATIO)
-        .def("detect_np", &cv::CircleDetector::detect_np);
-
-
+    // CircleClass is registered first, it is used as default argument of CircleDetectorClass methods
     py::class_<cv::CircleDetector::Circle>(module_handle, "CircleClass").def(py::init<>())
     .def_property_readonly("x", [](cv::CircleDetector::Circle &self)  
     {
@@ -45,6 +53,36 @@ PYBIND11_MODULE(circle_detector_module, module_handle)
     }).def_property_readonly("m1", [](cv::CircleDetector::Circle &self)  
     {
         return self.m1;
+    }).def_property_readonly("valid", [](cv::CircleDetector::Circle &self)  
+    {
+        return self.valid;
     });
-		
-}
\ No newline at end of file
+
+	py::class_<cv::CircleDetector>(
+		module_handle, "CircleDetectorClass")
+		.def(py::init<int, int, float >(), py::arg("width"), py::arg("height"), py::arg("diameter_ratio") = WHYCON_DEFAULT_DIAMETER_RATIO)
+        .def("detect_np", &cv::CircleDetector::detect_np)
+        .def("detect_roi_np", &cv::CircleDetector::detect_roi_np, py::arg("image"), py::arg("previous_circle") = cv::CircleDetector::Circle(),
+             py::arg("predicted_x") = -1, py::arg("predicted_y") = -1, py::arg("roi_size") = WHYCON_DEFAULT_ROI_SIZE, py::arg("roi_growth") = WHYCON_DEFAULT_ROI_GROWTH);
+
+
+    // finds number_of_circles markers in one call, detected circles are excluded from the following searches
+    py::class_<cv::ManyCircleDetector>(
+        module_handle, "ManyCircleDetectorClass")
+        .def(py::init<int, int, int, float>(), py::arg("number_of_circles"), py::arg("width"), py::arg("height"), py::arg("diameter_ratio") = WHYCON_DEFAULT_DIAMETER_RATIO)
+        .def("detect_np", [](cv::ManyCircleDetector &self, py::array image, bool reset, int max_attempts, int refine_max_step)
+        {
+            self.detect_np(image, reset, max_attempts, refine_max_step);
+
+            // the search stops at the first circle that is not found, the following circles are from older calls
+            py::array_t<CircleRecord> result(self.circles.size());
+            auto records = result.mutable_unchecked<1>();
+            bool detected = true;
+            for (size_t i = 0; i < self.circles.size(); i++) {
+                const cv::CircleDetector::Circle& circle = self.circles[i];
+                detected = detected && circle.valid;
+                records(i) = CircleRecord{circle.x, circle.y, circle.m0, circle.m1, circle.v0, circle.v1, circle.size, detected};
+            }
+            return result;
+        }, py::arg("image"), py::arg("reset") = false, py::arg("max_attempts") = 1, py::arg("refine_max_step") = 1);
+}
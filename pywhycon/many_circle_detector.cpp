@@ -1,6 +1,4 @@
-#include <iostream>
 #include "many_circle_detector.h"
-using namespace std;
 
 cv::ManyCircleDetector::ManyCircleDetector(int _number_of_circles, int _width, int _height, float _diameter_ratio) : 
   context(_width, _height), width(_width), height(_height), number_of_circles(_number_of_circles)
@@ -12,33 +10,33 @@ cv::ManyCircleDetector::ManyCircleDetector(int _number_of_circles, int _width, i
 cv::ManyCircleDetector::~ManyCircleDetector(void) {
 }
 
-bool cv::ManyCircleDetector::detect(const cv::Mat& image, bool reset, int max_attempts, int refine_max_step) {
-  bool all_detected = true;
+bool cv::ManyCircleDetector::detect_np(py::array array, bool reset, int max_attempts, int refine_max_step) {
+  auto mat = numpy_to_mat(array, width, height);
+  py::gil_scoped_release release;
+  return detect(mat, reset, max_attempts, refine_max_step);
+}
+
+// marks the pixels of already detected circles in the shared buffer. the detectors neither start a search on
+// nor grow a segment into marked pixels (-1000 like the image border), so the image does not need to be painted over.
+void cv::ManyCircleDetector::cover(int value) {
+  for (size_t i = 0; i < covered.size(); i++) context.buffer[covered[i]] = value;
+}
 
-  cv::Mat input;
-  if (reset) image.copyTo(input); // image will be modified on reset
-  else input = image;
+bool cv::ManyCircleDetector::detect(const cv::Mat& input, bool reset, int max_attempts, int refine_max_step) {
+  bool all_detected = true;
+  covered.clear();
   
   for (int i = 0; i < number_of_circles && all_detected; i++) {    
-    cout << "detecting circle " << i << endl;
-    
     for (int j = 0; j < max_attempts; j++) {
-      cout << "attempt " << j << endl;
-
       for (int refine_counter = 0; refine_counter < refine_max_step; refine_counter++)
       {
-        if (refine_counter > 0) cout << "refining step " << refine_counter << "/" << refine_max_step << endl;
         int prev_threshold = detectors[i].get_threshold();
 
-        int64_t ticks = cv::getTickCount();
-        
+        cover(-1000); // detect cleans the buffer when it is done
         if (refine_counter == 0 && reset)
           circles[i] = detectors[i].detect(input, (i == 0 ? CircleDetector::Circle() : circles[i-1]));
         else
           circles[i] = detectors[i].detect(input, circles[i]);
-          
-        double delta = (double)(cv::getTickCount() - ticks) / cv::getTickFrequency();
-        cout << "t: " << delta << " " << " fps: " << 1/delta << endl;
 
         if (!circles[i].valid) break;
 
@@ -47,8 +45,7 @@ bool cv::ManyCircleDetector::detect(const cv::Mat& image, bool reset, int max_at
       }
 
       if (circles[i].valid) {
-        cout << "detection of circle " << i << " ok" << endl;
-        if (reset) detectors[i].cover_last_detected(input);
+        detectors[i].get_last_detected(covered);
         break; // detection was successful, dont keep trying
       }
     }
@@ -56,6 +53,8 @@ bool cv::ManyCircleDetector::detect(const cv::Mat& image, bool reset, int max_at
     // detection was not possible for this circle, abort search
     if (!circles[i].valid) { all_detected = false; break; }
   }
-  
+
+  // leave a clean buffer for the next call
+  cover(0);
   return all_detected;
 }
@@ -11,6 +11,7 @@ namespace cv {
       ~ManyCircleDetector(void);
       
       bool detect(const cv::Mat& image, bool reset = false, int max_attempts = 1, int refine_max_step = 1);
+      bool detect_np(py::array array, bool reset = false, int max_attempts = 1, int refine_max_step = 1);
       
       std::vector<CircleDetector::Circle> circles;
 
@@ -19,6 +20,8 @@ namespace cv {
     private:
       int width, height, number_of_circles;
       std::vector<CircleDetector> detectors;
+      std::vector<int> covered; // buffer positions of the circles found in the current detect call
+      void cover(int value);
   };
 }
 
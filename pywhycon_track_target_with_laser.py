@@ -4,20 +4,39 @@ import pykinect_azure as pykinect
 from pykinect_azure import K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_DEPTH, k4a_float2_t
 import numpy as np
 from image_processing.circle_detector import detect_circle_position
-import optoMDC
-from mirror.coordinate_transformation import CoordinateTransform
+from image_processing.depth_deprojection import SparseDepthLookup
+from image_processing.capture_source import open_capture_source
+from mirror.coordinate_transformation import TargetToMirrorLookupTable, target_to_mirror_point
 import pickle
 import time
 import os
-from circle_detector_library.circle_detector_module import *
-
-
-# Parameters 
+import queue
+import threading
+from circle_detector_library.circle_detector import *
+from tracking.pipeline import DropOldestQueue, StageThread
+from tracking.stage_timer import StageTimer
+from tracking.predictor import create_predictor, save_trajectory
+from tracking.mirror_streamer import MirrorStreamer, MirrorTrajectory
+from tracking.video_writer import AsyncVideoWriter
+from tracking.display import open_display
+
+
+# Parameters
 d = 0 # distance between mirror surface and rotation center
 MIRROR_ROTATION_DEG = 45 # incidence angle of incoming laser ray (degree)
 CALIBRATION_SAVE_PATH = "calibration_parameters" # calibration result save path
 CAPTURE_VIDEO = False # select whether video recording is active or not
-# Parameters 
+CAPTURE_RAW_VIDEO = False # additionally record the camera frames without overlay to output_raw.avi
+DISPLAY_MODE = "process" # "window": imshow/waitKey in this process, "process": separate low priority display process, "headless": no display, keys are typed into the console
+PREDICTION_MODEL = "average_velocity" # "average_velocity", or "constant_velocity" / "constant_acceleration" kalman filter, None disables prediction
+PREDICTION_LATENCY = 0.035 # latency (s) not covered by the capture timestamps: exposure, usb transfer and mirror settling
+MIRROR_STREAM_RATE = 1000 # mirror setpoints per second interpolated along the predicted trajectory, None sends one setpoint per frame (needs PREDICTION_MODEL)
+MIRROR_STREAM_HORIZON = 0.1 # length (s) of the predicted trajectory sent to the streaming thread, the mirrors stop at its end if no frame arrives
+RECORD_TRAJECTORY = False # save measured target positions for offline evaluation of the predictor (tracking/predictor.py)
+REPLAY_PATH = None # session recorded by image_processing/record_depth_images.py, None uses the azure kinect
+REPLAY_REALTIME = True # replay at the recorded frame rate, False replays as fast as the pipeline runs
+MIRRORS_CONNECTED = True # False runs the pipeline without sending setpoints, e.g. when benchmarking a replay without hardware
+# Parameters
 
 
 with open('{}/parameters.pkl'.format(CALIBRATION_SAVE_PATH), 'rb') as f:
@@ -25,9 +44,15 @@ with open('{}/parameters.pkl'.format(CALIBRATION_SAVE_PATH), 'rb') as f:
     R = loaded_dict["R"]
     t = loaded_dict["t"]
 
+# target to mirror table of build_lookup_table.py, the exact transform is used if it has not been built
+lookup_table = TargetToMirrorLookupTable.load_if_exists(CALIBRATION_SAVE_PATH, d, MIRROR_ROTATION_DEG)
+if lookup_table is not None:
+    print("Using lookup table, interpolation error bound: ", lookup_table.error_bound)
 
 
-def main():
+def connect_mirrors():
+    import optoMDC
+
     # initialize mirrors
     mre2 = optoMDC.connect()
     mre2.reset()
@@ -35,20 +60,27 @@ def main():
     # Set up mirror in closed loop control mode(XY)
     ch_0 = mre2.Mirror.Channel_0
     ch_0.StaticInput.SetAsInput()                       # (1) here we tell the Manager that we will use a static input
-    ch_0.SetControlMode(optoMDC.Units.XY)           
+    ch_0.SetControlMode(optoMDC.Units.XY)
     ch_0.Manager.CheckSignalFlow()                       # This is a useful method to make sure the signal flow is configured correctly.
     si_0 = mre2.Mirror.Channel_0.StaticInput
 
 
     ch_1 = mre2.Mirror.Channel_1
     ch_1.StaticInput.SetAsInput()                        # (1) here we tell the Manager that we will use a static input
-    ch_1.SetControlMode(optoMDC.Units.XY)           
+    ch_1.SetControlMode(optoMDC.Units.XY)
     ch_1.Manager.CheckSignalFlow()                       # This is a useful method to make sure the signal flow is configured correctly.
     si_1 = mre2.Mirror.Channel_1.StaticInput
+    return mre2, si_0, si_1
 
 
-    # Initialize the library, if the library is not found, add the library path as argument
-    pykinect.initialize_libraries()
+def main():
+    if MIRRORS_CONNECTED:
+        mre2, si_0, si_1 = connect_mirrors()
+
+    def set_mirror(y_m, x_m):
+        if MIRRORS_CONNECTED:
+            si_0.SetXY(y_m)
+            si_1.SetXY(x_m)
 
     # Modify camera configuration
     device_config = pykinect.default_configuration
@@ -58,98 +90,182 @@ def main():
     device_config.synchronized_images_only = False
     # print(device_config)
 
-    # Start device
-    device = pykinect.start_device(config=device_config)
+    # Start device, or the recorded session if REPLAY_PATH is set
+    device = open_capture_source(device_config, REPLAY_PATH, realtime=REPLAY_REALTIME)
+
+    # intrinsics, extrinsics and depth pixel rays are cached, only the depth pixels around the target are transformed
+    depth_lookup = SparseDepthLookup.from_calibration(device.calibration)
 
-    cv2.namedWindow('Laser Detector',cv2.WINDOW_NORMAL)
+    # color resolution of the camera configuration, or of the replayed session (saved in its calibration.json)
+    color_camera_calibration = device.calibration.handle().color_camera_calibration
+    color_size = (color_camera_calibration.resolution_width, color_camera_calibration.resolution_height)
+
+    display = open_display(DISPLAY_MODE, 'Laser Detector')
     font = cv2.FONT_HERSHEY_SIMPLEX
 
+    # videos are encoded on background threads, frames are dropped instead of delaying the tracking
     if CAPTURE_VIDEO:
-        fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        out = cv2.VideoWriter('output.avi', fourcc, 30.0, (1280,720))
+        out = AsyncVideoWriter('output.avi', 'XVID', 30.0, color_size)
+        if CAPTURE_RAW_VIDEO:
+            out_raw = AsyncVideoWriter('output_raw.avi', 'XVID', 30.0, color_size)
 
     # gives undefined warning but works (pybind11 c++ module) change import *
-    prevCircle = CircleClass()
-    circle_detector = CircleDetectorClass(1280, 720) # K4A_COLOR_RESOLUTION_720P
-
-    prev_3d_coor = 0
-    speed_timer = 1
-    while True:
-        start = time.time()
+    circle_detector = CircleDetectorClass(*color_size)
+
+    # pipeline: capture thread -> detection thread -> actuation thread, display runs in main thread
+    # queues keep only the newest frame so that a slow stage never works on old frames
+    frame_queue = DropOldestQueue(maxsize=1)
+    target_queue = DropOldestQueue(maxsize=1)
+    display_queue = DropOldestQueue(maxsize=1)
+    stop_event = threading.Event()
+
+    # per-stage latencies are written to code_profiling_results on exit
+    # stage durations include the time the frame waited in the queue before the stage
+    timer = StageTimer()
+    timer.dump_on_exit()
+
+    def capture_stage():
+        stamps = timer.start()
         # Get capture
         capture = device.update()
-        print("Time until capture (s): ", time.time() - start)
+        if capture is None:
+            # end of the replayed session
+            stop_event.set()
+            return None
+        capture_time = capture.timestamp
+        timer.mark(stamps, "capture")
 
         # Get the color image from the capture
         ret_color, color_image = capture.get_color_image()
-        print("Time until color image (s): ", time.time() - start)
-
         if not ret_color:
-            continue
+            return None
+        timer.mark(stamps, "color")
+        return capture_time, stamps, capture, color_image
 
-        new_circle = circle_detector.detect_np(color_image, prevCircle)    
-        prevCircle = new_circle
-        print("Time until circle detection (s): ", time.time() - start)
+    prev_circle = [CircleClass()]
+    prev_depth = [None] # depth of the target in the previous frame, narrows the depth search
+    def detection_stage(frame):
+        capture_time, stamps, capture, color_image = frame
 
-        # Get the colored depth
-        ret_depth, transformed_depth_image = capture.get_transformed_depth_image()
-        print("Time until depth image (s): ", time.time() - start)
+        # searches a window around the previous detection first, full frame only if the target is lost
+        new_circle = circle_detector.detect_roi_np(color_image, prev_circle[0])
+        prev_circle[0] = new_circle
+        timer.mark(stamps, "detect")
 
-        
+        # display is updated even if depth is missing
+        display_queue.put((capture_time, color_image, new_circle))
+
+        # Get the native depth, only the target pixel is transformed into the color camera
+        ret_depth, depth_image = capture.get_depth_image()
         if not ret_depth:
-            continue  
-        
+            timer.finish(stamps)
+            return None
+
         pix_x = int(new_circle.x)
         pix_y = int(new_circle.y)
-        rgb_depth = transformed_depth_image[pix_y, pix_x]
-
-        pixels = k4a_float2_t((pix_x, pix_y))
-
-        pos3d_color = device.calibration.convert_2d_to_3d(pixels, rgb_depth, K4A_CALIBRATION_TYPE_COLOR, K4A_CALIBRATION_TYPE_COLOR)
-        
-
-        camera_coordinates = np.array([pos3d_color.xyz.x, pos3d_color.xyz.y, pos3d_color.xyz.z]).reshape((3, 1))
-
-        # rotate and translate  
+        camera_coordinates = depth_lookup.color_pixel_to_3d(depth_image, pix_x, pix_y, z_hint=prev_depth[0])
+        timer.mark(stamps, "depth")
+        if camera_coordinates[2, 0] <= 0:
+            # no depth around the target, the predictor keeps extrapolating the last measurements
+            timer.finish(stamps)
+            return None
+        prev_depth[0] = camera_coordinates[2, 0]
+
+        # rotate and translate
         camera_coordinates_in_laser_coordinates =  R @ camera_coordinates + t
-    
-
-        coordinate_transform = CoordinateTransform(d=d, D=camera_coordinates_in_laser_coordinates[2].item(), rotation_degree=MIRROR_ROTATION_DEG)
-        y_m, x_m = coordinate_transform.target_to_mirror(camera_coordinates_in_laser_coordinates[1], camera_coordinates_in_laser_coordinates[0]) # order is changed in order to change x and y axis
-        print("Time until completing calculations (s): ", time.time() - start)
-
-        
-        if(len(y_m) > 0 and len(x_m) > 0):
-            si_0.SetXY(y_m[0])        
-            si_1.SetXY(x_m[0])        
-
-
-       
-        dt = time.time() - speed_timer
-        speed_timer = time.time()
+        return capture_time, stamps, camera_coordinates_in_laser_coordinates
+
+    predictor = create_predictor(PREDICTION_MODEL, latency=PREDICTION_LATENCY) if PREDICTION_MODEL else None
+    trajectory = ([], []) # capture times and laser coordinates of the target
+    streamer = None
+    if predictor is not None and MIRROR_STREAM_RATE:
+        # mirrors are commanded from their own thread between camera frames
+        streamer = MirrorStreamer(set_mirror, stop_event, rate=MIRROR_STREAM_RATE, latency=PREDICTION_LATENCY)
+    def actuation_stage(target):
+        capture_time, stamps, camera_coordinates_in_laser_coordinates = target
+        if RECORD_TRAJECTORY:
+            trajectory[0].append(capture_time)
+            trajectory[1].append(camera_coordinates_in_laser_coordinates[:, 0])
+
+        # aim at the position the target will have when the mirrors move, the time since capture is measured per frame
+        prediction_coor = camera_coordinates_in_laser_coordinates
+        if predictor is not None:
+            predictor.update(camera_coordinates_in_laser_coordinates, capture_time)
+            if streamer is not None:
+                # mirror coordinates along the trajectory, the streaming thread interpolates between them
+                mirror_trajectory = MirrorTrajectory.from_predictor(predictor, time.time(), MIRROR_STREAM_HORIZON, 0.01, d, MIRROR_ROTATION_DEG, lookup_table)
+                timer.mark(stamps, "transform")
+                streamer.set_trajectory(mirror_trajectory)
+                timer.mark(stamps, "actuate")
+                timer.finish(stamps)
+                return None
+            prediction_coor = predictor.predict(time.time() + predictor.latency)
+
+        mirror_coor = target_to_mirror_point(prediction_coor[1], prediction_coor[0], prediction_coor[2].item(), d, MIRROR_ROTATION_DEG, lookup_table) # order is changed in order to change x and y axis
+        timer.mark(stamps, "transform")
+
+        if mirror_coor is not None:
+            set_mirror(*mirror_coor)
+        timer.mark(stamps, "actuate")
+        timer.finish(stamps)
+        return None
+
+    stages = [StageThread(capture_stage, None, [frame_queue], stop_event, name="capture"),
+              StageThread(detection_stage, frame_queue, [target_queue], stop_event, name="detection"),
+              StageThread(actuation_stage, target_queue, [], stop_event, name="actuation")]
+    if streamer is not None:
+        stages.append(streamer)
+    for stage in stages:
+        stage.start()
+
+    prev_display_time = time.time()
+    while not stop_event.is_set():
+        try:
+            capture_time, color_image, new_circle = display_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
 
-        speed = (camera_coordinates_in_laser_coordinates - prev_3d_coor) / dt
-        prev_3d_coor = camera_coordinates_in_laser_coordinates
-        
+        if CAPTURE_VIDEO and CAPTURE_RAW_VIDEO:
+            # overlay is drawn into color_image below
+            out_raw.write(color_image.copy())
 
-        end = time.time()
-        print("elapsed time: ", (end - start))    
-        cv2.putText(color_image, f"fps: {1 / (end - start)}", (10, 20), font, 0.5, (0, 255, 0), 1, cv2.LINE_AA)       
+        if DISPLAY_MODE != "headless" or CAPTURE_VIDEO:
+            now = time.time()
+            fps = 1 / (now - prev_display_time)
+            prev_display_time = now
+            cv2.putText(color_image, f"fps: {fps:.1f} latency (ms): {1000 * (now - capture_time):.1f}", (10, 20), font, 0.5, (0, 255, 0), 1, cv2.LINE_AA)
 
-        color_image = cv2.circle(color_image, (int(new_circle.x), int(new_circle.y)), radius=10, color=(0, 255, 0), thickness=2)
+            color_image = cv2.circle(color_image, (int(new_circle.x), int(new_circle.y)), radius=10, color=(0, 255, 0), thickness=2)
 
         if CAPTURE_VIDEO:
             out.write(color_image)
-            
+
         # Show detected target position
-        cv2.imshow('Laser Detector',color_image)
+        display.show(color_image)
         # Press q key to stop
-        if cv2.waitKey(1) == ord('q'):
+        if display.get_key() == ord('q'):
             break
 
-        
-    out.release()
-    mre2.disconnect()
+    stop_event.set()
+    for stage in stages:
+        stage.join()
+    display.close()
+
+    print("Dropped frames (capture, detection, display): ", frame_queue.dropped, target_queue.dropped, display_queue.dropped)
+    if streamer is not None:
+        print("Mirror setpoints sent, late ticks: ", streamer.setpoint_count, streamer.late_count)
+
+    if RECORD_TRAJECTORY:
+        save_trajectory(f"trajectory_{time.strftime('%Y%m%d_%H%M%S')}.npz", *trajectory)
+
+    if CAPTURE_VIDEO:
+        out.release()
+        print("Dropped video frames: ", out.dropped)
+        if CAPTURE_RAW_VIDEO:
+            out_raw.release()
+            print("Dropped raw video frames: ", out_raw.dropped)
+    if MIRRORS_CONNECTED:
+        mre2.disconnect()
     print("done")
 
 
@@ -1,4 +1,7 @@
 import sys
+import time
+import struct
+import select
 import machine
 
 led = machine.Pin("LED", machine.Pin.OUT)
@@ -9,31 +12,141 @@ sensor_light_1 = machine.ADC(0)
 sensor_light_2 = machine.ADC(1)
 sensor_light_3 = machine.ADC(2)
 
-def read_photodiode_1():
-    reading_voltage = sensor_light_1.read_u16() * conversion_factor
-    print(reading_voltage)
-    
-def read_photodiode_2():
-    reading_voltage = sensor_light_2.read_u16() * conversion_factor
-    print(reading_voltage)
-    
-def read_photodiode_3():
-    reading_voltage = sensor_light_3.read_u16() * conversion_factor
-    print(reading_voltage)
+sensors = [sensor_light_1, sensor_light_2, sensor_light_3]
+
+# oversampling, set once per session with "oversample_<n>_<mean|median>" or "oversample_<n>_<mean|median>_var"
+oversampling = 1 # samples per reading
+oversampling_method = "mean"
+oversampling_variance = False # replies are followed by ";" and the variance of the samples of each sensor
+
+def sample_photodiodes(sensor_ids):
+    """
+        returns (values, variances) in raw adc units. the sensors are sampled in turns, so the samples of all
+        sensors are taken over the same time
+    """
+    samples = [[] for i in sensor_ids]
+    for n in range(oversampling):
+        for k in range(len(sensor_ids)):
+            samples[k].append(sensors[sensor_ids[k] - 1].read_u16())
+
+    values = []
+    variances = []
+    for channel in samples:
+        mean = sum(channel) / oversampling
+        if oversampling_method == "median":
+            channel.sort()
+            middle = oversampling // 2
+            values.append(channel[middle] if oversampling % 2 else (channel[middle - 1] + channel[middle]) / 2)
+        else:
+            values.append(mean)
+        if oversampling_variance:
+            variances.append(sum((x - mean) ** 2 for x in channel) / oversampling)
+    return values, variances
+
+def read_photodiodes(sensor_ids):
+    # all channels are sampled back-to-back before anything is sent, returns one reply line "v1,v2,v3"
+    values, variances = sample_photodiodes(sensor_ids)
+    reply = ",".join(str(value * conversion_factor) for value in values)
+    if oversampling_variance:
+        reply += ";" + ",".join(str(variance * conversion_factor ** 2) for variance in variances)
+    return reply
+
+def set_oversampling(command):
+    """
+        "oversample_16_median" or "oversample_16_mean_var"
+    """
+    global oversampling, oversampling_method, oversampling_variance
+    arguments = command.split("_")[1:]
+    sample_count = int(arguments[0])
+    if sample_count < 1 or arguments[1] not in ("mean", "median") or arguments[2:] not in ([], ["var"]):
+        raise ValueError("unknown oversampling")
+    oversampling = sample_count
+    oversampling_method = arguments[1]
+    oversampling_variance = arguments[2:] == ["var"]
+
+def parse_sensor_ids(command):
+    """
+        "pd_1" -> [1], "pd_all" -> [1, 2, 3], "pd_1,3" -> [1, 3]
+    """
+    if command == "pd_all":
+        return [1, 2, 3]
+    sensor_ids = [int(i) for i in command[3:].split(",")]
+    for i in sensor_ids:
+        if i < 1 or i > len(sensors):
+            raise ValueError("unknown sensor")
+    return sensor_ids
+
+# streaming frame: magic (0xa5 0x5a), sequence number, time.ticks_us() (wraps at 2**30), pd_1, pd_2, pd_3 (raw u16),
+# checksum (sum of sequence, timestamp and readings mod 2**16), 18 bytes little endian. readings are oversampled like
+# the pd_ replies, without variance
+STREAM_FORMAT = "<BBIIHHHH"
+MAX_STREAM_RATE = 20000 # Hz, a frame period below 50 us can not be kept
+
+def stream_photodiodes(rate):
+    """
+        sends binary frames at rate (Hz) until the host sends "stop". samples that are late are sent late, not
+        skipped, their timestamp is the time they were actually taken
+    """
+    period_us = int(1000000 / rate)
+    out = sys.stdout.buffer
+    commands = select.poll()
+    commands.register(sys.stdin, select.POLLIN)
+    sequence = 0
+    next_time = time.ticks_us()
+    while True:
+        if commands.poll(0) and sys.stdin.readline().strip().lower() == "stop":
+            break
+        while time.ticks_diff(next_time, time.ticks_us()) > 0:
+            pass
+        timestamp = time.ticks_us()
+        values, variances = sample_photodiodes([1, 2, 3])
+        reading_1, reading_2, reading_3 = [int(value + 0.5) for value in values]
+        checksum = (sequence + timestamp + reading_1 + reading_2 + reading_3) & 0xffff
+        out.write(struct.pack(STREAM_FORMAT, 0xa5, 0x5a, sequence, timestamp, reading_1, reading_2, reading_3, checksum))
+        sequence = (sequence + 1) & 0xffffffff
+        next_time = time.ticks_add(next_time, period_us)
+        if time.ticks_diff(timestamp, next_time) > 10 * period_us:
+            # fell far behind (e.g. usb stalled), restart the schedule instead of sending a burst
+            next_time = time.ticks_add(timestamp, period_us)
 
 
 
 while True:
     # read a command from the host
     v = sys.stdin.readline().strip()
+
+    # "#<request id> <command>" is answered with "#<request id> <reply>", commands without id with "<reply>"
+    request_id = ""
+    if v.startswith("#") and " " in v:
+        request_id, v = v.split(" ", 1)
+        request_id += " "
     
     # perform the requested action
     
-    if v.lower() == "pd_1":
-        read_photodiode_1()
-    elif v.lower() == "pd_2":
-        read_photodiode_2()
-    elif v.lower() == "pd_3":
-        read_photodiode_3()  
-
-
+    if v.lower().startswith("oversample_"):
+        try:
+            set_oversampling(v.lower())
+        except (ValueError, IndexError):
+            print(request_id + "error")
+        else:
+            print(request_id + "ok")
+    elif v.lower().startswith("stream_"):
+        try:
+            rate = float(v[7:])
+        except ValueError:
+            rate = 0
+        if 0 < rate <= MAX_STREAM_RATE:
+            stream_photodiodes(rate)
+        else:
+            # also stream_0 and negative rates, the period could not be computed
+            print(request_id + "error")
+    elif v.lower().startswith("pd_"):
+        try:
+            sensor_ids = parse_sensor_ids(v.lower())
+        except ValueError:
+            # the host gets a reply it can not parse instead of waiting for the serial timeout
+            print(request_id + "error")
+        else:
+            print(request_id + read_photodiodes(sensor_ids))
+    elif request_id:
+        print(request_id + "error")
@@ -0,0 +1,223 @@
+"""
+    visualization for the tracking scripts. all displays have the same interface:
+
+        display.show(frame)     never waits for the gui
+        display.get_key()       code of the last pressed key or -1 like cv2.waitKey, never blocks
+        display.close()
+
+    "window" is the previous behaviour (imshow + waitKey(1) in the calling thread), "process" shows the frames in a
+    separate low priority process that reads them from shared memory, "headless" shows nothing and reads keys from
+    the console (key + enter).
+"""
+
+import os
+import sys
+import time
+import atexit
+import queue
+import threading
+import json
+import subprocess
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+
+DISPLAY_MODES = ("window", "process", "headless")
+
+
+class WindowDisplay:
+
+    def __init__(self, window_name):
+        self.window_name = window_name
+        cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+
+    def show(self, frame):
+        cv2.imshow(self.window_name, frame)
+
+    def get_key(self):
+        return cv2.waitKey(1)
+
+    def close(self):
+        cv2.destroyWindow(self.window_name)
+
+
+class ConsoleKeys:
+    """
+        non-blocking key input from the console, a thread waits for lines on stdin and keeps their first character
+    """
+
+    def __init__(self):
+        self.keys = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="console keys", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for line in sys.stdin:
+            line = line.strip()
+            if line:
+                self.keys.put(ord(line[0]))
+
+    def get_key(self):
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return -1
+
+
+class HeadlessDisplay:
+
+    def __init__(self, window_name=None):
+        self.console_keys = ConsoleKeys()
+        print("Headless mode, type a key and press enter (e.g. q to stop)")
+
+    def show(self, frame):
+        pass
+
+    def get_key(self):
+        return self.console_keys.get_key()
+
+    def close(self):
+        pass
+
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 registers attached memory with the resource tracker, which would remove it on exit
+        shm = shared_memory.SharedMemory(name=name)
+        if sys.platform != "win32":
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def run_display_process(window_name, shm_name, shape, dtype):
+    """
+        display process: shows the newest frame in shared memory, pressed keys are written to stdout
+    """
+    try:
+        import psutil
+        process = psutil.Process()
+        process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if sys.platform == "win32" else 10)
+    except Exception:
+        pass # display runs at normal priority
+
+    shm = attach_shared_memory(shm_name)
+    header = np.ndarray((2,), dtype=np.int64, buffer=shm.buf) # sequence number, stop flag
+    slots = np.ndarray((2,) + tuple(shape), dtype=dtype, buffer=shm.buf, offset=header.nbytes)
+    cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+    shown = 0
+    while not header[1]:
+        current = header[0]
+        if current != shown:
+            # the writer fills the other slot, copying the frame out keeps it from changing while it is drawn
+            cv2.imshow(window_name, slots[current % 2].copy())
+            shown = current
+        key = cv2.waitKey(10)
+        if key != -1:
+            print(key, flush=True)
+    cv2.destroyWindow(window_name)
+    del header, slots
+    shm.close()
+
+
+class ProcessDisplay:
+    """
+        frames are copied into one of two shared memory slots, the display process shows the slot that was written
+        last. the process is started with the first frame because the frame size is not known before.
+
+        the display runs as "python -m tracking.display" instead of a multiprocessing child, so the calling script
+        (which connects to the camera and mirrors at import) is not imported again in the new process.
+    """
+
+    def __init__(self, window_name):
+        self.window_name = window_name
+        self.process = None
+        self.keys = queue.Queue()
+
+    def start(self, frame):
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.shm = shared_memory.SharedMemory(create=True, size=16 + 2 * frame.nbytes)
+        self.header = np.ndarray((2,), dtype=np.int64, buffer=self.shm.buf)
+        self.header[:] = 0
+        self.slots = np.ndarray((2,) + frame.shape, dtype=frame.dtype, buffer=self.shm.buf, offset=self.header.nbytes)
+        arguments = json.dumps([self.window_name, self.shm.name, frame.shape, frame.dtype.str])
+        repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = subprocess.Popen([sys.executable, "-m", "tracking.display", "--process", arguments],
+                                        stdout=subprocess.PIPE, text=True, cwd=repository)
+        atexit.register(self.close)
+        self.key_thread = threading.Thread(target=self.read_keys, name="display keys", daemon=True)
+        self.key_thread.start()
+
+    def read_keys(self):
+        for line in self.process.stdout:
+            self.keys.put(int(line))
+
+    def show(self, frame):
+        if self.process is None:
+            self.start(frame)
+        if frame.shape != self.shape or frame.dtype != self.dtype:
+            raise ValueError(f"display frame size changed from {self.shape} to {frame.shape}")
+        next_sequence = self.header[0] + 1
+        np.copyto(self.slots[next_sequence % 2], frame)
+        self.header[0] = next_sequence
+
+    def get_key(self):
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return -1
+
+    def close(self):
+        if self.process is None:
+            return
+        self.header[1] = 1
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        del self.header, self.slots
+        self.shm.close()
+        self.shm.unlink()
+        self.process = None
+
+
+def open_display(mode, window_name):
+    if mode == "window":
+        return WindowDisplay(window_name)
+    if mode == "process":
+        return ProcessDisplay(window_name)
+    if mode == "headless":
+        return HeadlessDisplay(window_name)
+    raise ValueError(f"unknown display mode {mode}, expected one of {DISPLAY_MODES}")
+
+
+def test_display_cost(mode="process", frame_count=300):
+    """
+        time spent in show + get_key by the calling thread for 720p frames
+    """
+    display = open_display(mode, "Display Test")
+    frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+    times = []
+    for i in range(frame_count):
+        frame[:] = i % 256
+        start = time.perf_counter()
+        display.show(frame)
+        key = display.get_key()
+        times.append(time.perf_counter() - start)
+        if key == ord('q'):
+            break
+        time.sleep(1 / 30)
+    display.close()
+    print(f"{mode}: show + get_key (ms) p50: {1000 * np.median(times):.3f} max: {1000 * np.max(times):.3f}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--process"]:
+        run_display_process(*json.loads(sys.argv[2]))
+    else:
+        for mode in sys.argv[1:] or DISPLAY_MODES:
+            test_display_cost(mode)
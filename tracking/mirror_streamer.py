@@ -0,0 +1,219 @@
+import sys
+import threading
+import time
+import numpy as np
+from mirror.coordinate_transformation import CoordinateTransform
+
+
+class MirrorTrajectory:
+    """
+        mirror setpoints of a predicted target trajectory. the trajectory is transformed to mirror coordinates at
+        knot times once per camera frame, setpoints in between are linearly interpolated in mirror coordinates so
+        that the streaming thread does not run the coordinate transform.
+
+        channel_0 / channel_1 follow the tracking scripts: channel_0 is the first output of
+        target_to_mirror(y_t, x_t) (si_0), channel_1 the second (si_1).
+    """
+
+    def __init__(self, times, channel_0, channel_1):
+        self.times = times # (N,) knot times (s), increasing
+        self.channel_0 = channel_0 # (N,) mirror coordinates, nan where the target cannot be reached
+        self.channel_1 = channel_1
+
+    @classmethod
+    def from_predictor(cls, predictor, start, horizon, step, d, rotation_degree, lookup_table=None):
+        """
+            predictor: TargetPredictor or AverageVelocityPredictor with at least one measurement
+            start: time (s) of the first knot, horizon: length (s) of the trajectory, step: knot spacing (s)
+            lookup_table: optional TargetToMirrorLookupTable, transforms all knots in one call
+        """
+        times = start + np.arange(0, horizon + step / 2, step)
+        positions = predictor.predict(times)
+        if lookup_table is not None:
+            channel_0, channel_1, feasible = lookup_table.target_to_mirror_batch(positions[1], positions[0], positions[2])
+        else:
+            # distance changes along the trajectory, one transform per knot
+            channel_0 = np.empty(len(times))
+            channel_1 = np.empty(len(times))
+            feasible = np.empty(len(times), dtype=bool)
+            for i in range(len(times)):
+                coordinate_transform = CoordinateTransform(d=d, D=positions[2, i].item(), rotation_degree=rotation_degree)
+                x_m, y_m, f = coordinate_transform.target_to_mirror_batch(positions[1, i:i+1], positions[0, i:i+1]) # order is changed in order to change x and y axis
+                channel_0[i], channel_1[i], feasible[i] = x_m[0], y_m[0], f[0]
+        channel_0 = np.where(feasible, channel_0, np.nan)
+        channel_1 = np.where(feasible, channel_1, np.nan)
+        return cls(times, channel_0, channel_1)
+
+    def at(self, t):
+        """
+            returns interpolated (channel_0, channel_1) at time t, clamped to the first/last knot
+        """
+        times = self.times
+        if t <= times[0]:
+            return self.channel_0[0], self.channel_1[0]
+        if t >= times[-1]:
+            return self.channel_0[-1], self.channel_1[-1]
+        # knots are evenly spaced
+        position = (t - times[0]) / (times[1] - times[0])
+        i = min(int(position), len(times) - 2)
+        w = position - i
+        return (self.channel_0[i] * (1 - w) + self.channel_0[i+1] * w,
+                self.channel_1[i] * (1 - w) + self.channel_1[i+1] * w)
+
+
+class MirrorStreamer(threading.Thread):
+    """
+        sends mirror setpoints at a fixed rate, independent of the camera frame rate. the tracker replaces the
+        trajectory once per frame with set_trajectory, the thread commands the setpoint of the current time plus
+        latency (mirror settling) at every tick.
+
+        set_mirror(channel_0, channel_1) sends one setpoint, e.g.
+            lambda y_m, x_m: (si_0.SetXY(y_m), si_1.SetXY(x_m))
+    """
+
+    def __init__(self, set_mirror, stop_event, rate=1000.0, latency=0.0, max_age=0.2, spin_time=None, idle_time=0.01,
+                 name="mirror streamer"):
+        """
+            rate: setpoints per second
+            latency: setpoints are taken from the trajectory this far (s) ahead of the current time
+            max_age: the mirrors hold their position if the trajectory was not replaced for this long (s),
+                     e.g. when the target is lost
+            spin_time: the thread sleeps until this long (s) before a tick and busy waits for the rest, default is
+                       a fifth of the period. the busy wait holds the GIL, a longer spin_time slows the other threads
+            idle_time: the thread sleeps this long (s) between checks while there is no recent trajectory
+        """
+        super().__init__(name=name, daemon=True)
+        self.set_mirror = set_mirror
+        self.stop_event = stop_event
+        self.period = 1 / rate
+        self.latency = latency
+        self.max_age = max_age
+        self.spin_time = 0.2 * self.period if spin_time is None else spin_time
+        self.idle_time = idle_time
+
+        self.trajectory = None
+        self.trajectory_time = 0
+        self.setpoint_count = 0 # number of setpoints sent
+        self.late_count = 0 # ticks that started more than one period late
+
+    def set_trajectory(self, trajectory):
+        # replacing the reference is atomic, no lock is needed
+        self.trajectory_time = time.time()
+        self.trajectory = trajectory
+
+    def wait_until(self, deadline):
+        # sleep for the coarse part of the wait, then spin on perf_counter until the deadline. sleep(0) releases
+        # the GIL on every iteration of the spin
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < deadline:
+            time.sleep(0)
+
+    def run(self):
+        # time.sleep resolves ~15 ms on windows by default, 1 ms with timeBeginPeriod(1)
+        winmm = None
+        if sys.platform == "win32":
+            import ctypes
+            winmm = ctypes.windll.winmm
+            winmm.timeBeginPeriod(1)
+
+        prev_setpoint = None
+        next_tick = time.perf_counter()
+        try:
+            while not self.stop_event.is_set():
+                trajectory = self.trajectory
+                if trajectory is None or time.time() - self.trajectory_time > self.max_age:
+                    # nothing to send, sleep instead of waiting for every tick
+                    self.stop_event.wait(self.idle_time)
+                    next_tick = time.perf_counter()
+                    continue
+
+                now = time.perf_counter()
+                if now < next_tick:
+                    self.wait_until(next_tick)
+                elif now - next_tick > self.period:
+                    # ticks that were missed are skipped instead of sent in a burst
+                    self.late_count += 1
+                    next_tick = now
+                next_tick += self.period
+
+                setpoint = trajectory.at(time.time() + self.latency)
+                if setpoint == prev_setpoint or np.isnan(setpoint[0]) or np.isnan(setpoint[1]):
+                    continue
+                self.set_mirror(*setpoint)
+                prev_setpoint = setpoint
+                self.setpoint_count += 1
+        finally:
+            if winmm is not None:
+                winmm.timeEndPeriod(1)
+            self.stop_event.set()
+
+
+def python_work_time(repeat=5):
+    """
+        median time (s) of a fixed pure python workload, slower when other threads hold the GIL
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        total = 0
+        for j in range(300000):
+            total += j * j
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def test_mirror_streamer(rate=1000.0, duration=2.0, fps=30.0):
+    """
+        streams a synthetic target moving at 400 mm/s, setpoints are recorded instead of sent to the mirrors.
+        also reports the cpu use of the process and how much the streamer slows python work in the main thread
+    """
+    from tracking.predictor import TargetPredictor
+
+    setpoints = []
+    def record_setpoint(channel_0, channel_1):
+        setpoints.append((time.perf_counter(), channel_0, channel_1))
+
+    work_time = python_work_time()
+
+    stop_event = threading.Event()
+    streamer = MirrorStreamer(record_setpoint, stop_event, rate=rate)
+    streamer.start()
+
+    # no trajectory yet
+    cpu_start = time.process_time()
+    time.sleep(1.0)
+    idle_cpu = time.process_time() - cpu_start
+
+    predictor = TargetPredictor()
+    build_times = []
+    start = time.time()
+    cpu_start = time.process_time()
+    while time.time() - start < duration:
+        now = time.time()
+        predictor.update(np.array([[-200 + 400 * (now - start)], [50], [800]]), now)
+        build_start = time.perf_counter()
+        streamer.set_trajectory(MirrorTrajectory.from_predictor(predictor, now, 3 / fps, 0.01, 0, 45))
+        build_times.append(time.perf_counter() - build_start)
+        time.sleep(1 / fps)
+    streaming_cpu = (time.process_time() - cpu_start) / (time.time() - start)
+
+    # trajectory long enough for the whole measurement
+    streamer.set_trajectory(MirrorTrajectory.from_predictor(predictor, time.time(), 1.0, 0.01, 0, 45))
+    streaming_work_time = python_work_time()
+    stop_event.set()
+    streamer.join()
+
+    setpoints = np.array(setpoints)
+    intervals = np.diff(setpoints[:, 0]) * 1000
+    print(f"Setpoints per frame: {len(setpoints) / len(build_times):.1f}, late ticks: {streamer.late_count}")
+    print(f"Setpoint interval (ms) p50: {np.percentile(intervals, 50):.3f} p99: {np.percentile(intervals, 99):.3f}")
+    print(f"Largest setpoint step: {np.max(np.abs(np.diff(setpoints[:, 1:], axis=0))):.5f}")
+    print(f"Trajectory build time per frame (ms): {1000 * np.mean(build_times):.3f}")
+    print(f"Process cpu without trajectory: {100 * idle_cpu:.1f} %, while streaming: {100 * streaming_cpu:.1f} %")
+    print(f"Main thread python work (ms) without streamer: {1000 * work_time:.1f}, while streaming: {1000 * streaming_work_time:.1f}")
+
+
+if __name__ == "__main__":
+    test_mirror_streamer()
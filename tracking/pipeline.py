@@ -0,0 +1,66 @@
+import threading
+import collections
+import queue
+
+
+class DropOldestQueue:
+    """
+        bounded queue between pipeline stages. put never blocks, when the queue is full the oldest item is
+        dropped so that the consumer always works on the most recent frame.
+    """
+
+    def __init__(self, maxsize=1):
+        self.items = collections.deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0 # number of items dropped since creation
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+            raises queue.Empty if no item arrives within timeout (s)
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0, timeout):
+                raise queue.Empty
+            return self.items.popleft()
+
+
+class StageThread(threading.Thread):
+    """
+        runs function(item) for every item of input_queue and puts the result into the output queues.
+        results that are None are not forwarded. stops when stop_event is set.
+    """
+
+    def __init__(self, function, input_queue, output_queues, stop_event, name=None):
+        super().__init__(name=name, daemon=True)
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queues = output_queues
+        self.stop_event = stop_event
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if self.input_queue is None:
+                    # source stage, e.g. camera capture
+                    result = self.function()
+                else:
+                    try:
+                        item = self.input_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    result = self.function(item)
+
+                if result is None:
+                    continue
+                for output_queue in self.output_queues:
+                    output_queue.put(result)
+        finally:
+            # one failing stage stops the whole pipeline
+            self.stop_event.set()
@@ -0,0 +1,269 @@
+import sys
+import time
+import numpy as np
+from filterpy.kalman import KalmanFilter
+from filterpy.common import Q_discrete_white_noise
+
+
+# fixed part of the end-to-end latency (s) that is not visible in the frame timestamps: exposure and usb transfer
+# before the capture is returned, mirror settling after SetXY. the part between capture and actuation is measured
+# per frame from the capture timestamp
+DEFAULT_LATENCY = 0.035
+
+MODEL_ORDERS = {"constant_velocity": 2, "constant_acceleration": 3}
+# lowest rms error on the synthetic trajectory of test_evaluate_predictor with measurement_noise=3
+DEFAULT_PROCESS_NOISE = {"constant_velocity": 1e7, "constant_acceleration": 1e6}
+
+# "average_velocity" is the predictor of constant_vel_test.py and the default of the scripts. on the synthetic
+# trajectory (test_evaluate_predictor, 85 ms latency) the tuned constant velocity filter is only on par with it
+# (rms 17.7 / 18.2 mm, p95 45.5 / 45.6 mm) and the constant acceleration filter is worse (rms 22.8, p95 49.7 mm)
+PREDICTION_MODELS = ("average_velocity",) + tuple(MODEL_ORDERS)
+
+
+class TargetPredictor:
+    """
+        kalman filter on the 3d target position (laser coordinates, mm) that predicts where the target is when
+        the mirrors actually move.
+
+        state is ordered by axis: [x, x', (x''), y, y', (y''), z, z', (z'')]. frames do not arrive at a fixed rate,
+        so the transition and process noise are rebuilt from the capture timestamps of consecutive frames.
+
+        usage:
+            predictor.update(position, capture_time)
+            position = predictor.predict(time.time() + predictor.latency)
+    """
+
+    def __init__(self, model="constant_velocity", process_noise=None, measurement_noise=3.0, latency=DEFAULT_LATENCY,
+                 reset_distance=150.0, max_gap=0.5):
+        """
+            process_noise: variance of the white noise acceleration (constant velocity, (mm/s^2)^2) or jerk
+                           (constant acceleration, (mm/s^3)^2), DEFAULT_PROCESS_NOISE of the model if None
+            measurement_noise: standard deviation of the measured position (mm)
+            reset_distance: the filter is restarted if a measurement is further than this from the prediction (mm),
+                            e.g. when the target is lost and found somewhere else
+            max_gap: the filter is restarted if no measurement arrived for this long (s)
+        """
+        if model not in MODEL_ORDERS:
+            raise ValueError(f"unknown model {model}, expected one of {list(MODEL_ORDERS)}")
+
+        self.model = model
+        self.order = MODEL_ORDERS[model]
+        self.process_noise = DEFAULT_PROCESS_NOISE[model] if process_noise is None else process_noise
+        self.measurement_noise = measurement_noise
+        self.latency = latency
+        self.reset_distance = reset_distance
+        self.max_gap = max_gap
+
+        dim = 3 * self.order
+        self.kf = KalmanFilter(dim_x=dim, dim_z=3)
+        self.kf.H = np.zeros((3, dim))
+        self.kf.H[[0, 1, 2], [0, self.order, 2 * self.order]] = 1
+        self.kf.R = np.eye(3) * measurement_noise ** 2
+        self.timestamp = None # capture time of the last measurement
+
+    def transition(self, dt):
+        """
+            state transition matrix for a time step of dt (s)
+        """
+        block = np.eye(self.order)
+        block[0, 1] = dt
+        if self.order == 3:
+            block[0, 2] = 0.5 * dt ** 2
+            block[1, 2] = dt
+        return np.kron(np.eye(3), block)
+
+    def reset(self, position, timestamp):
+        self.kf.x = np.zeros((3 * self.order, 1))
+        self.kf.x[::self.order] = position
+        # velocity and acceleration are unknown after a reset
+        P = np.diag([self.measurement_noise ** 2, 1000.0 ** 2, 10000.0 ** 2][:self.order])
+        self.kf.P = np.kron(np.eye(3), P)
+        self.timestamp = timestamp
+
+    def update(self, position, timestamp):
+        """
+            position: (3,1) measured target position, timestamp: capture time of the frame (s)
+        """
+        position = np.asarray(position, dtype=float).reshape((3, 1))
+        if self.timestamp is None or timestamp - self.timestamp > self.max_gap:
+            self.reset(position, timestamp)
+            return
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            # frame is not newer than the last measurement
+            return
+
+        self.kf.F = self.transition(dt)
+        self.kf.Q = Q_discrete_white_noise(dim=self.order, dt=dt, var=self.process_noise, block_size=3)
+        self.kf.predict()
+        if np.linalg.norm(position - self.kf.H @ self.kf.x) > self.reset_distance:
+            self.reset(position, timestamp)
+            return
+        self.kf.update(position)
+        self.timestamp = timestamp
+
+    def predict(self, timestamp):
+        """
+            returns (3,1) predicted position at timestamp (s) or (3,N) positions for (N,) timestamps,
+            the filter state is not changed
+        """
+        if self.timestamp is None:
+            return None
+        dt = np.asarray(timestamp, dtype=float) - self.timestamp
+        # same as H @ transition(dt) @ x, written out so that many timestamps can be predicted at once
+        state = self.kf.x.reshape((3, self.order))
+        position = state[:, 0:1] + state[:, 1:2] * dt
+        if self.order == 3:
+            position = position + 0.5 * state[:, 2:3] * dt ** 2
+        return position
+
+    def velocity(self):
+        """
+            returns (3,1) estimated velocity (mm/s)
+        """
+        if self.timestamp is None:
+            return None
+        return self.kf.x[1::self.order]
+
+
+class AverageVelocityPredictor:
+    """
+        previous hand written predictor of constant_vel_test.py with the interface of TargetPredictor: the velocity
+        is the average of the velocity between the last two measurements and the previous average
+    """
+
+    def __init__(self, latency=DEFAULT_LATENCY, max_gap=0.5):
+        self.latency = latency
+        self.max_gap = max_gap
+        self.position = None
+        self.average_velocity = None
+        self.timestamp = None # capture time of the last measurement
+
+    def update(self, position, timestamp):
+        """
+            position: (3,1) measured target position, timestamp: capture time of the frame (s)
+        """
+        position = np.asarray(position, dtype=float).reshape((3, 1))
+        if self.timestamp is None or timestamp - self.timestamp > self.max_gap:
+            self.average_velocity = np.zeros((3, 1))
+        else:
+            dt = timestamp - self.timestamp
+            if dt <= 0:
+                # frame is not newer than the last measurement
+                return
+            self.average_velocity = 0.5 * (position - self.position) / dt + 0.5 * self.average_velocity
+        self.position = position
+        self.timestamp = timestamp
+
+    def predict(self, timestamp):
+        """
+            returns (3,1) predicted position at timestamp (s) or (3,N) positions for (N,) timestamps
+        """
+        if self.timestamp is None:
+            return None
+        return self.position + self.average_velocity * (np.asarray(timestamp, dtype=float) - self.timestamp)
+
+    def velocity(self):
+        """
+            returns (3,1) estimated velocity (mm/s)
+        """
+        return self.average_velocity
+
+
+def create_predictor(model, latency=DEFAULT_LATENCY, **predictor_args):
+    """
+        model: one of PREDICTION_MODELS
+    """
+    if model == "average_velocity":
+        return AverageVelocityPredictor(latency=latency, **predictor_args)
+    return TargetPredictor(model=model, latency=latency, **predictor_args)
+
+
+def evaluate_predictor(timestamps, positions, latency=DEFAULT_LATENCY, model="constant_velocity", warmup=10,
+                       **predictor_args):
+    """
+        offline evaluation on a recorded trajectory. every measurement is used to predict the position latency
+        seconds after its capture, the prediction is compared with the trajectory interpolated at that time.
+
+        timestamps: (N,) capture times (s), positions: (N,3) measured target positions (mm)
+        model: "none" (last measurement) or one of PREDICTION_MODELS
+        returns dict of error statistics (mm) and the (N,3) predictions
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+
+    if model == "none":
+        predictions = positions.copy()
+    else:
+        predictor = create_predictor(model, latency=latency, **predictor_args)
+        predictions = np.zeros_like(positions)
+        for i in range(len(timestamps)):
+            predictor.update(positions[i], timestamps[i])
+            predictions[i] = predictor.predict(timestamps[i] + latency)[:, 0]
+
+    # only predictions that land inside the recording can be checked
+    target_times = timestamps + latency
+    valid = target_times <= timestamps[-1]
+    valid[:warmup] = False
+    truth = np.stack([np.interp(target_times[valid], timestamps, positions[:, axis]) for axis in range(3)], axis=1)
+    errors = np.linalg.norm(predictions[valid] - truth, axis=1)
+
+    return {"rms": np.sqrt(np.mean(errors ** 2)),
+            "p50": np.percentile(errors, 50),
+            "p95": np.percentile(errors, 95),
+            "max": np.max(errors),
+            "predictions": predictions}
+
+
+def save_trajectory(path, timestamps, positions):
+    np.savez(path, timestamps=np.asarray(timestamps), positions=np.asarray(positions).reshape((-1, 3)))
+    print("Trajectory saved to: ", path)
+
+
+def load_trajectory(path):
+    """
+        loads a trajectory saved by save_trajectory, returns (N,) timestamps and (N,3) positions
+    """
+    data = np.load(path)
+    return data["timestamps"], data["positions"]
+
+
+def synthetic_trajectory(duration=20.0, fps=30.0, speed=400.0, measurement_noise=2.0, seed=0):
+    """
+        target going back and forth between x = 200 and 600 (mm) like the mouse of constant_vel_test.py, with
+        frame time jitter and measurement noise
+    """
+    rng = np.random.default_rng(seed)
+    dts = np.clip(1 / fps + rng.normal(0, 0.003, int(duration * fps)), 0.005, None)
+    timestamps = np.cumsum(dts)
+    phase = (timestamps * speed) % 800
+    x = 200 + np.where(phase < 400, phase, 800 - phase)
+    positions = np.stack((x, 100 + 50 * np.sin(timestamps), 1000 + 100 * np.sin(0.5 * timestamps)), axis=1)
+    return timestamps, positions + rng.normal(0, measurement_noise, positions.shape)
+
+
+def test_evaluate_predictor(path=None, latency=0.085):
+    """
+        compares the predictors on a recorded trajectory, or on a synthetic one if no path is given
+    """
+    if path is None:
+        timestamps, positions = synthetic_trajectory()
+    else:
+        timestamps, positions = load_trajectory(path)
+
+    print(f"{len(timestamps)} frames, {timestamps[-1] - timestamps[0]:.1f} s, latency {1000 * latency:.0f} ms")
+    print("    rms(mm)     p50(mm)     p95(mm)     max(mm)  model")
+    for model in ["none", "average_velocity", "constant_velocity", "constant_acceleration"]:
+        result = evaluate_predictor(timestamps, positions, latency, model=model)
+        print(f"{result['rms']:11.3f} {result['p50']:11.3f} {result['p95']:11.3f} {result['max']:11.3f}  {model}")
+
+    predictor = TargetPredictor()
+    start = time.perf_counter()
+    for i in range(len(timestamps)):
+        predictor.update(positions[i], timestamps[i])
+        predictor.predict(timestamps[i] + latency)
+    print(f"update + predict (us): {1e6 * (time.perf_counter() - start) / len(timestamps):.1f}")
+
+
+if __name__ == "__main__":
+    test_evaluate_predictor(*sys.argv[1:2])
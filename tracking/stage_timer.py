@@ -0,0 +1,107 @@
+import time
+import threading
+import atexit
+import os
+import numpy as np
+
+
+TRACKING_STAGES = ("capture", "color", "detect", "depth", "transform", "actuate")
+
+
+class StageTimer:
+    """
+        per-stage latency measurement for the tracking loops.
+
+        usage (stamps can be passed between threads together with the frame):
+            stamps = timer.start()
+            ...
+            timer.mark(stamps, "capture")
+            ...
+            timer.finish(stamps)
+
+        the duration of a stage is the time since the previous mark (or start). durations are kept in a
+        ring buffer of the last `capacity` frames, percentiles are only computed in report/dump.
+    """
+
+    def __init__(self, stages=TRACKING_STAGES, capacity=4096):
+        self.stages = stages
+        self.stage_index = {stage: i+1 for i, stage in enumerate(stages)} # index 0 is start time
+        self.capacity = capacity
+        # plain lists are faster than numpy arrays for single element writes
+        self.durations = [[-1] * capacity for _ in range(len(stages) + 1)] # last row is total
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        stamps = [None] * (len(self.stages) + 1)
+        stamps[0] = time.perf_counter_ns()
+        return stamps
+
+    def mark(self, stamps, stage):
+        stamps[self.stage_index[stage]] = time.perf_counter_ns()
+
+    def elapsed(self, stamps, stage):
+        """
+            seconds since the mark of stage in this frame
+        """
+        return (time.perf_counter_ns() - stamps[self.stage_index[stage]]) / 1e9
+
+    def finish(self, stamps):
+        end = time.perf_counter_ns()
+        with self.lock:
+            i = self.count % self.capacity
+            self.count += 1
+        prev = stamps[0]
+        for j in range(1, len(stamps)):
+            stamp = stamps[j]
+            if stamp is None:
+                # stage skipped for this frame
+                self.durations[j-1][i] = -1
+            else:
+                self.durations[j-1][i] = stamp - prev
+                prev = stamp
+        self.durations[-1][i] = end - stamps[0]
+
+    def report(self):
+        """
+            returns text table with p50/p95/p99/max latency in ms for each stage
+        """
+        lines = [f"   {min(self.count, self.capacity)} frames (last {self.capacity} kept, {self.count} total)",
+                 "",
+                 "   ncalls     p50(ms)     p95(ms)     p99(ms)     max(ms)  stage"]
+        for name, durations in zip(self.stages + ("total",), self.durations):
+            durations = np.array(durations[:min(self.count, self.capacity)])
+            durations = durations[durations >= 0] / 1e6
+            if len(durations) == 0:
+                lines.append(f"{0:9d} {'-':>11} {'-':>11} {'-':>11} {'-':>11}  {name}")
+                continue
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            lines.append(f"{len(durations):9d} {p50:11.3f} {p95:11.3f} {p99:11.3f} {np.max(durations):11.3f}  {name}")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            f.write(self.report() + "\n")
+        print("Stage latencies saved to: ", path)
+
+    def dump_on_exit(self, directory="code_profiling_results", name="stage_latency"):
+        path = os.path.join(directory, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.txt")
+        atexit.register(self.dump, path)
+        return path
+
+
+def test_stage_timer_overhead(frame_count=100000):
+    timer = StageTimer()
+    start = time.perf_counter_ns()
+    for i in range(frame_count):
+        stamps = timer.start()
+        for stage in TRACKING_STAGES:
+            timer.mark(stamps, stage)
+        timer.finish(stamps)
+    overhead = (time.perf_counter_ns() - start) / frame_count / 1000
+    print(f"Overhead per frame (us): {overhead:.3f}")
+    print(timer.report())
+
+
+if __name__ == "__main__":
+    test_stage_timer_overhead()
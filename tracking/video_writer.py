@@ -0,0 +1,80 @@
+import threading
+import queue
+import time
+import cv2
+import numpy as np
+from tracking.pipeline import DropOldestQueue
+
+
+class AsyncVideoWriter:
+    """
+        cv2.VideoWriter that encodes on a background thread. write never blocks, when the encoder falls behind by
+        more than queue_size frames the oldest waiting frame is dropped and counted (dropped).
+        frames must not be modified after they are passed to write.
+    """
+
+    def __init__(self, path, fourcc="XVID", fps=30.0, size=(1280, 720), queue_size=8):
+        self.path = path
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        if not self.writer.isOpened():
+            raise IOError(f"video writer could not be opened: {path}")
+        self.queue = DropOldestQueue(maxsize=queue_size)
+        self.frame_count = 0 # frames encoded
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="video writer", daemon=True)
+        self.thread.start()
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def write(self, frame):
+        self.queue.put(frame)
+
+    def run(self):
+        while True:
+            try:
+                frame = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.closing.is_set():
+                    break
+                continue
+            self.writer.write(frame)
+            self.frame_count += 1
+
+    def release(self):
+        # frames already queued are encoded before the file is closed
+        self.closing.set()
+        self.thread.join()
+        self.writer.release()
+
+
+def test_async_video_writer(path="output_test.avi", frame_count=300, fps=30.0):
+    """
+        time spent in write by the calling thread, compared with encoding inline
+    """
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 255, (720, 1280, 3), dtype=np.uint8) for _ in range(4)]
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"XVID"), fps, (1280, 720))
+    start = time.perf_counter()
+    for i in range(frame_count // 10):
+        writer.write(frames[i % 4])
+    writer.release()
+    print(f"inline write (ms): {1000 * (time.perf_counter() - start) / (frame_count // 10):.3f}")
+
+    writer = AsyncVideoWriter(path, fps=fps)
+    write_times = []
+    start = time.perf_counter()
+    for i in range(frame_count):
+        write_start = time.perf_counter()
+        writer.write(frames[i % 4])
+        write_times.append(time.perf_counter() - write_start)
+        time.sleep(max(0, start + (i + 1) / fps - time.perf_counter()))
+    writer.release()
+    print(f"async write (ms) p50: {1000 * np.median(write_times):.3f} max: {1000 * np.max(write_times):.3f}")
+    print(f"frames encoded: {writer.frame_count}, dropped: {writer.dropped}")
+
+
+if __name__ == "__main__":
+    test_async_video_writer()